@@ -0,0 +1,716 @@
+from smart_house import *
+from smart_house_snapshot import save_snapshot, open_snapshot, close_snapshot, restore_snapshot
+from smart_house_async import make_async_management, make_fake_transport
+from smart_house_sharded import make_sharded_management, close_sharded_management
+from smart_house_metering import make_meter, sample, energy
+from smart_house_subscriptions import make_bus, subscribe, flush_subscriptions, close_bus
+from smart_house_alerts import make_alert_engine, add_rule, close_alert_engine
+from smart_house_scheduler import make_scheduler, schedule, cancel, run_due
+from smart_house_eventlog import open_event_log, checkpoint, close_event_log, recover
+import os
+import tempfile
+import json
+import platform
+import random
+import asyncio
+import threading
+import multiprocessing
+import time
+import sys
+import tracemalloc
+
+def bench_dispatch():
+    iterations = 200000
+    bench_management = {"devices": []}
+    thermostat = make(Thermostat, "Bench Thermostat", "Bedroom", 100, "on", 18, 21, management = bench_management)
+
+    cls = thermostat["_class"]
+    start = time.perf_counter()
+    for _ in range(iterations):
+        find(cls, "is_connected") # the walk call() did on every dispatch before the method cache
+    uncached = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for _ in range(iterations):
+        resolve(cls, "is_connected")
+    cached = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for _ in range(iterations):
+        call(thermostat, "is_connected")
+    full = time.perf_counter() - start
+
+    print(f"  lookup with find(): {uncached / iterations * 1e9:.0f}ns")
+    print(f"  lookup with resolve(): {cached / iterations * 1e9:.0f}ns ({uncached / cached:.1f}x faster)")
+    print(f"  full call(): {full / iterations * 1e9:.0f}ns per dispatch")
+
+def _plain_call(obj, method_name, *args, **kwargs): # call() as it was before the instrumentation check
+    if "_class" in obj:
+        if "_view" in obj:
+            obj.update(row_view(obj["_management"], obj["_id"]))
+        method = resolve(obj["_class"], method_name)
+    else:
+        method = obj.get(method_name)
+    if method is None:
+        raise NotImplementedError(f"Method {method_name} not implemented!")
+    return method(obj, *args, **kwargs)
+
+def bench_instrumentation():
+    iterations = 200000
+    bench_management = make_management("bench_management")
+    thermostat = make(Thermostat, "Bench Thermostat", "Bedroom", 100, "on", 18, 21, management = bench_management)
+    timings = {}
+    for label, sample_every in [("no instrumentation check", None), ("instrumentation disabled", None), ("instrumentation on, every call timed", 1), ("instrumentation on, 1 in 100 timed", 100)]:
+        dispatch = _plain_call if sample_every is None and label.startswith("no") else call
+        if sample_every is not None:
+            enable_instrumentation(sample_every = sample_every)
+        try:
+            best = None
+            for _ in range(3):
+                start = time.perf_counter()
+                for _ in range(iterations):
+                    dispatch(thermostat, "is_connected")
+                elapsed = time.perf_counter() - start
+                best = elapsed if best is None else min(best, elapsed)
+        finally:
+            disable_instrumentation()
+        timings[label] = best
+        print(f"  call(), {label}: {best / iterations * 1e9:.0f}ns ({best / timings['no instrumentation check'] - 1:+.1%})")
+
+def bench_device_types():
+    iterations = 200000
+    bench_management = make_management("bench_management")
+    thermostat = make(Thermostat, "Bench Thermostat", "Bedroom", 100, "on", 18, 21, management = bench_management)
+    start = time.perf_counter()
+    for _ in range(iterations):
+        call(thermostat, "get_power_consumption") # one DEVICE_TYPES lookup, no class name matching
+    print(f"  get_power_consumption() through the registry: {(time.perf_counter() - start) / iterations * 1e9:.0f}ns")
+
+    Heater = {"_parent": Device, "_classname": "Heater"}
+    register_device_type(Heater, ("target_temperature",), power = lambda base_power, target_temperature: base_power * target_temperature / 10)
+    try:
+        make_many(Heater, [(f"Heater {i}", f"Room {i % 50}", 100, "on", 20) for i in range(200000)], management = bench_management)
+        power_breakdown(bench_management)
+        start = time.perf_counter()
+        power_breakdown(bench_management, "room")
+        print(f"  power_breakdown() of 200000 devices of a newly registered type: {time.perf_counter() - start:.3f}s")
+    finally:
+        unregister_device_type("Heater")
+
+def bench_remove_devices():
+    for count in (10000, 100000):
+        bench_management = make_management("bench_management")
+        devices = make_many(Light, [(f"Lamp {i}", f"Room {i % 500}", 100, "on", 50) for i in range(count)], management = bench_management)
+        call(bench_management, "calculate_total_power_consumption", search_room = "Room 0") # indexes, totals
+        power_breakdown(bench_management) # columns
+        random.Random(1).shuffle(devices)
+        start = time.perf_counter()
+        for device in devices[:1000]:
+            call(device, "relocate", "Room 0")
+        relocated = time.perf_counter() - start
+        call(bench_management, "remove_device", devices[1000]) # the first removal builds the id -> position map
+        start = time.perf_counter()
+        for device in devices[:1000]:
+            call(bench_management, "remove_device", device)
+        removed = time.perf_counter() - start
+        print(f"  {count} devices: relocate {relocated / 1000 * 1e6:.1f}us, remove {removed / 1000 * 1e6:.1f}us per device")
+
+def bench_location_tree():
+    bench_management = make_management("bench_management")
+    rows = [(f"Lamp {i}", f"Site/Building {i % 5}/Floor {i // 5 % 10}/Room {i // 50 % 20}", 100, "on", 50) for i in range(100000)]
+    make_many(Light, rows, management = bench_management)
+    iterations = 100
+    start = time.perf_counter()
+    for _ in range(iterations):
+        sum(call(device, "get_power_consumption") for device in bench_management["devices"] if device["location"].startswith("Site/Building 3/Floor 7/"))
+    scan = time.perf_counter() - start
+    call(bench_management, "calculate_total_power_consumption", search_room = "Site", subtree = True) # builds the totals
+    start = time.perf_counter()
+    for _ in range(iterations):
+        call(bench_management, "calculate_total_power_consumption", search_room = "Site/Building 3/Floor 7", subtree = True)
+    rolled_up = time.perf_counter() - start
+    call(bench_management, "select_devices", within = "Site") # builds the index
+    start = time.perf_counter()
+    for _ in range(iterations):
+        call(bench_management, "select_devices", within = "Site/Building 3/Floor 7")
+    selected = time.perf_counter() - start
+    print(f"  power of one floor of 100000 devices, prefix scan: {scan / iterations * 1e3:.3f}ms")
+    print(f"  power of one floor from the roll-ups: {rolled_up / iterations * 1e6:.2f}us ({scan / rolled_up:.0f}x faster)")
+    print(f"  devices of one floor from the location index: {selected / iterations * 1e3:.3f}ms")
+
+def bench_room_query():
+    bench_management = make_management("bench_management")
+    for i in range(50000):
+        make(Light, f"Lamp {i}", f"Room {i % 500}", 100, "on", 50, management = bench_management)
+    iterations = 200
+
+    start = time.perf_counter()
+    for i in range(iterations):
+        filter_helper(bench_management, lambda x: x["location"] == f"Room {i}")
+    scan = time.perf_counter() - start
+
+    call(bench_management, "search_room", "Room 0") # builds the indexes
+    start = time.perf_counter()
+    for i in range(iterations):
+        call(bench_management, "search_room", f"Room {i}")
+    indexed = time.perf_counter() - start
+
+    print(f"  search_room over 50000 devices, full scan: {scan / iterations * 1e3:.3f}ms")
+    print(f"  search_room over 50000 devices, indexed: {indexed / iterations * 1e3:.3f}ms ({scan / indexed:.1f}x faster)")
+
+def bench_power_totals():
+    bench_management = make_management("bench_management")
+    lights = [make(Light, f"Lamp {i}", f"Room {i % 500}", 100, "on", 50, management = bench_management) for i in range(50000)]
+    iterations = 20
+
+    start = time.perf_counter()
+    for _ in range(iterations):
+        filter_helper(bench_management)[0]
+    scan = time.perf_counter() - start
+
+    call(bench_management, "calculate_total_power_consumption") # builds the running totals
+    start = time.perf_counter()
+    for i in range(iterations):
+        call(bench_management, "calculate_total_power_consumption")
+        call(bench_management, "calculate_total_power_consumption", search_room = f"Room {i}")
+    running = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for lamp in lights[:10000]:
+        call(lamp, "toggle_status")
+    toggle = time.perf_counter() - start
+
+    print(f"  house total over 50000 devices, full scan: {scan / iterations * 1e3:.3f}ms")
+    print(f"  house + room total from running totals: {running / iterations * 1e6:.2f}us")
+    print(f"  toggle_status with totals maintained: {toggle / 10000 * 1e6:.2f}us per device")
+
+def bench_power_breakdown():
+    bench_management = make_management("bench_management")
+    for i in range(100000):
+        cls, extra = [(Light, [50]), (Thermostat, [18, 21]), (Camera, [4])][i % 3]
+        make(cls, f"Device {i}", f"Room {i % 500}", 100, "on", *extra, management = bench_management)
+
+    start = time.perf_counter()
+    totals = {}
+    for device in bench_management["devices"]:
+        totals[device["location"]] = totals.get(device["location"], 0) + call(device, "get_power_consumption")
+    per_device = time.perf_counter() - start
+
+    start = time.perf_counter()
+    call(bench_management, "enable_columns")
+    build = time.perf_counter() - start
+
+    start = time.perf_counter()
+    call(bench_management, "power_breakdown", "room")
+    columnar = time.perf_counter() - start
+
+    print(f"  per-room totals over 100000 devices with call(): {per_device * 1e3:.1f}ms")
+    print(f"  building the columns: {build * 1e3:.1f}ms")
+    print(f"  per-room totals from the columns ({'numpy' if numpy is not None else 'array fallback'}): {columnar * 1e3:.1f}ms")
+
+def bench_memory():
+    count = 1000000
+    names = [f"Device {i}" for i in range(count)] # shared by both models, so only the device representation is measured
+    results = {}
+    for label, compact in [("dict", False), ("compact", True)]:
+        tracemalloc.start()
+        bench_management = make_management("bench_management", compact = compact)
+        start = time.perf_counter()
+        for i in range(count):
+            cls, extra = [(Light, [50]), (Thermostat, [18, 21]), (Camera, [4])][i % 3]
+            make(cls, names[i], f"Room {i % 500}", 100, "on", *extra, management = bench_management)
+        elapsed = time.perf_counter() - start
+        results[label] = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        print(f"  {count} devices, {label} model: {results[label] / 2**20:.1f}MiB ({results[label] / count:.0f} bytes per device, built in {elapsed:.1f}s)")
+        del bench_management
+    print(f"  compact model uses {results['dict'] / results['compact']:.1f}x less memory")
+
+def bench_query():
+    bench_management = make_management("bench_management")
+    for i in range(50000):
+        make(Light, f"Lamp {i}", f"Room {i % 500}", 100, "on", 50, management = bench_management)
+
+    start = time.perf_counter()
+    filter_helper(bench_management, lambda x: x["status"] == "on")[0]
+    helper = time.perf_counter() - start
+
+    start = time.perf_counter()
+    call(bench_management, "query", condition = lambda x: x["status"] == "on", outputs = ["power"])
+    power_only = time.perf_counter() - start
+
+    print(f"  power of 50000 devices via filter_helper (power + descriptions): {helper * 1e3:.1f}ms")
+    print(f"  power of 50000 devices via query(outputs = ['power']): {power_only * 1e3:.1f}ms ({helper / power_only:.1f}x faster)")
+
+def bench_descriptions():
+    bench_management = make_management("bench_management")
+    for i in range(50000):
+        make(Thermostat, f"Thermostat {i}", f"Room {i % 500}", 100, "on", 18, 21, management = bench_management)
+
+    start = time.perf_counter()
+    call(bench_management, "get_all_device_descriptions")
+    cold = time.perf_counter() - start
+
+    start = time.perf_counter()
+    call(bench_management, "get_all_device_descriptions")
+    warm = time.perf_counter() - start
+
+    print(f"  describing 50000 thermostats, cold cache: {cold * 1e3:.1f}ms")
+    print(f"  describing 50000 thermostats, warm cache: {warm * 1e3:.1f}ms ({cold / warm:.1f}x faster)")
+
+def bench_provisioning():
+    count = 100000
+    rows = [(f"Lamp {i}", f"Room {i % 500}", 100, "on", 50) for i in range(count)]
+    for label in ["make()", "make_many()"]:
+        bench_management = make_management("bench_management")
+        call(bench_management, "search_room", "Room 0") # indexes and totals are live, like in a running house
+        call(bench_management, "calculate_total_power_consumption")
+        start = time.perf_counter()
+        if label == "make()":
+            for row in rows:
+                make(Light, *row, management = bench_management)
+        else:
+            make_many(Light, rows, management = bench_management)
+        elapsed = time.perf_counter() - start
+        print(f"  {label}: {count / elapsed:.0f} devices/s")
+
+def bench_bulk_mutations():
+    bench_management = make_management("bench_management")
+    make_many(Light, [(f"Lamp {i}", f"Room {i % 10}", 100, "on", 50) for i in range(50000)], management = bench_management)
+    call(bench_management, "calculate_total_power_consumption")
+
+    start = time.perf_counter()
+    for device in select_devices(bench_management, room = "Room 0"):
+        call(device, "toggle_status")
+    one_by_one = time.perf_counter() - start
+
+    start = time.perf_counter()
+    call(bench_management, "set_status_many", "on", {"room": "Room 0"})
+    batched = time.perf_counter() - start
+
+    print(f"  switching 5000 lights one call() at a time: {one_by_one * 1e3:.1f}ms")
+    print(f"  switching 5000 lights with set_status_many(): {batched * 1e3:.1f}ms")
+
+def bench_snapshot():
+    count = 500000
+    rows = [(f"Lamp {i}", f"Room {i % 500}", 100, "on", 50) for i in range(count)]
+    bench_management = make_management("bench_management")
+    start = time.perf_counter()
+    make_many(Light, rows, management = bench_management)
+    rebuild = time.perf_counter() - start
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "house.snapshot")
+        start = time.perf_counter()
+        save_snapshot(bench_management, path)
+        save = time.perf_counter() - start
+
+        start = time.perf_counter()
+        snapshot = open_snapshot(path)
+        call(snapshot, "calculate_total_power_consumption")
+        mapped = time.perf_counter() - start
+        close_snapshot(snapshot)
+
+        start = time.perf_counter()
+        restore_snapshot(path)
+        restore = time.perf_counter() - start
+
+    print(f"  {count} devices, rebuilding with make_many(): {rebuild:.2f}s")
+    print(f"  save_snapshot(): {save:.2f}s")
+    print(f"  open_snapshot() + house total from the mapped records: {mapped:.2f}s")
+    print(f"  restore_snapshot() to device dicts: {restore:.2f}s")
+
+def bench_event_log():
+    count = 10000
+    iterations = 100000
+    rows = [(f"Lamp {i}", f"Room {i % 100}", 100, "on", 50) for i in range(count)]
+    bench_management = make_management("bench_management")
+    devices = make_many(Light, rows, management = bench_management)
+    start = time.perf_counter()
+    for i in range(iterations):
+        call(devices[i % count], "toggle_status")
+    plain = time.perf_counter() - start
+
+    with tempfile.TemporaryDirectory() as directory:
+        results = {}
+        for group_size in [1, 100, 10000]:
+            log = open_event_log(bench_management, directory, group_size = group_size)
+            if group_size == 1:
+                checkpoint(log) # the replayed updates need their devices
+            mutations = iterations if group_size > 1 else 2000 # an fsync per event is too slow for the full run
+            start = time.perf_counter()
+            for i in range(mutations):
+                call(devices[i % count], "toggle_status")
+            close_event_log(log)
+            results[group_size] = (time.perf_counter() - start) / mutations
+
+        events = sum(1 for _ in open(os.path.join(directory, "events.log")))
+        start = time.perf_counter()
+        recover(directory)
+        replay = time.perf_counter() - start
+
+    print(f"  toggle_status without a log: {plain / iterations * 1e6:.2f}us")
+    for group_size, duration in results.items():
+        print(f"  toggle_status with a log, group commit of {group_size}: {duration * 1e6:.2f}us")
+    print(f"  replaying {events} events: {replay:.2f}s ({events / replay:.0f} events/s)")
+
+def bench_async_connect():
+    count = 2000
+    latency = 0.01 # a 10ms handshake per device
+    bench_management = make_management("bench_management")
+    make_many(Camera, [(f"Camera {i}", f"Room {i % 50}", 120, "on", 5) for i in range(count)], management = bench_management)
+    serial_count = 100
+    start = time.perf_counter()
+    for device in select_devices(bench_management)[:serial_count]: # the serial loop, one handshake after another
+        time.sleep(latency)
+        call(device, "connect", "10.0.0.1")
+    serial = (time.perf_counter() - start) / serial_count * count
+
+    for concurrency in [10, 100, 1000]:
+        disconnect_many(bench_management)
+        house = make_async_management(bench_management, make_fake_transport(latency = latency), concurrency = concurrency)
+        start = time.perf_counter()
+        asyncio.run(call(house, "connect_many", "10.0.0.1"))
+        print(f"  async connect_many() of {count} devices, concurrency {concurrency}: {time.perf_counter() - start:.2f}s")
+    print(f"  serial loop (extrapolated from {serial_count} devices): {serial:.2f}s")
+
+def bench_thread_contention():
+    count = 20000
+    duration = 1.0
+    rooms = [f"Room {i}" for i in range(50)]
+    for mode in ["seqlock readers", "readers take the writer lock"]:
+        bench_management = make_management("bench_management", thread_safe = True)
+        devices = make_many(Light, [(f"Lamp {i}", rooms[i % 50], 100, "on", 50) for i in range(count)], management = bench_management)
+        call(bench_management, "calculate_total_power_consumption")
+        stop = threading.Event()
+        counts = {"reads": 0, "writes": 0}
+
+        def writer():
+            i = 0
+            while not stop.is_set():
+                call(devices[i % count], "toggle_status")
+                i += 1
+            counts["writes"] = i
+
+        def reader(seed):
+            reads = 0
+            while not stop.is_set():
+                room = rooms[(reads + seed) % 50]
+                if mode == "seqlock readers":
+                    call(bench_management, "calculate_total_power_consumption", search_room = room)
+                else:
+                    with bench_management["_lock"]:
+                        call(bench_management, "calculate_total_power_consumption", search_room = room)
+                reads += 1
+            counts["reads"] += reads
+
+        threads = [threading.Thread(target = writer)] + [threading.Thread(target = reader, args = (seed,)) for seed in range(4)]
+        for thread in threads:
+            thread.start()
+        time.sleep(duration)
+        stop.set()
+        for thread in threads:
+            thread.join()
+        print(f"  {mode}: {counts['reads'] / duration:.0f} reads/s, {counts['writes'] / duration:.0f} writes/s (4 readers, 1 writer)")
+
+def bench_sharded_queries():
+    count = 200000
+    rows = [(f"Lamp {i}", f"Room {i % 500}", 100, "on", 50) for i in range(count)]
+    print(f"  {multiprocessing.cpu_count()} cores available")
+    for shards in sorted({1, 2, 4, multiprocessing.cpu_count()}):
+        sharded = make_sharded_management(shards)
+        try:
+            start = time.perf_counter()
+            call(sharded, "make_many", Light, rows)
+            load = time.perf_counter() - start
+            start = time.perf_counter()
+            call(sharded, "get_all_device_descriptions") # cold description caches
+            describe = time.perf_counter() - start
+            start = time.perf_counter()
+            call(sharded, "search_type", "Light")
+            search = time.perf_counter() - start
+        finally:
+            close_sharded_management(sharded)
+        print(f"  {shards} shards: make_many() {load:.2f}s, cold descriptions {describe:.2f}s, search_type() {search:.2f}s")
+
+def bench_energy_metering():
+    count = 100000
+    bench_management = make_management("bench_management")
+    make_many(Light, [(f"Lamp {i}", f"Room {i % 500}", 100, "on", 50) for i in range(count)], management = bench_management)
+    meter = make_meter(bench_management, tick = 10, capacity = 360)
+    start = time.perf_counter()
+    for tick in range(10):
+        sample(meter, now = tick * 10)
+    print(f"  sample() of {count} devices: {(time.perf_counter() - start) / 10 * 1000:.1f}ms per tick, ring memory {len(meter['samples']) * 4 / 1e6:.0f}MB")
+
+    small_management = make_management("bench_management")
+    make_many(Light, [(f"Lamp {i}", f"Room {i % 50}", 100, "on", 50) for i in range(2000)], management = small_management)
+    meter = make_meter(small_management, tick = 60, capacity = 60)
+    for minute in range(24 * 60):
+        sample(meter, now = minute * 60)
+    end = 24 * 3600
+    iterations = 1000
+    start = time.perf_counter()
+    for _ in range(iterations):
+        energy(meter, 90, end, room = "Room 7")
+    rollups = time.perf_counter() - start
+    start = time.perf_counter()
+    for _ in range(iterations): # the same answer from the minute buckets only
+        sum(sum(bucket.get("Room 7", {}).values()) for bucket in meter["rollups"][60].values())
+    minutes = time.perf_counter() - start
+    print(f"  kWh of one room over 24h from hour + minute rollups: {rollups / iterations * 1e6:.0f}us")
+    print(f"  same from the 1440 minute buckets: {minutes / iterations * 1e6:.0f}us")
+
+def bench_subscriptions():
+    count = 100000
+    iterations = 100000
+    bench_management = make_management("bench_management")
+    devices = make_many(Light, [(f"Lamp {i}", f"Room {i % 500}", 100, "on", 50) for i in range(count)], management = bench_management)
+    start = time.perf_counter()
+    for i in range(iterations):
+        call(devices[i * 7 % count], "toggle_status")
+    plain = time.perf_counter() - start
+
+    bus = make_bus(bench_management, interval = 3600, max_pending = count + 1)
+    batches = []
+    for room in range(500):
+        subscribe(bus, batches.append, room = f"Room {room}")
+    start = time.perf_counter()
+    for i in range(iterations):
+        call(devices[i * 7 % count], "toggle_status")
+    routed = time.perf_counter() - start
+    start = time.perf_counter()
+    delivered = flush_subscriptions(bus)
+    flush = time.perf_counter() - start
+    close_bus(bus)
+
+    start = time.perf_counter()
+    for room in range(500): # what a polling dashboard does every second to find out the same
+        call(bench_management, "search_room", f"Room {room}")
+    poll = time.perf_counter() - start
+    print(f"  toggle_status without / with 500 room subscriptions: {plain / iterations * 1e6:.2f}us / {routed / iterations * 1e6:.2f}us")
+    print(f"  flushing {delivered} coalesced notifications in {len(batches)} batches: {flush * 1000:.1f}ms")
+    print(f"  one polling round of search_room() over the 500 rooms: {poll * 1000:.1f}ms")
+
+def bench_alert_rules():
+    count = 100000
+    iterations = 100000
+    bench_management = make_management("bench_management")
+    lights = make_many(Light, [(f"Lamp {i}", f"Room {i % 500}", 100, "on", 50) for i in range(count // 2)], management = bench_management)
+    thermostats = make_many(Thermostat, [(f"Thermostat {i}", f"Room {i % 500}", 10, "on", 20, 21) for i in range(count // 2)], management = bench_management)
+    start = time.perf_counter()
+    engine = make_alert_engine(bench_management)
+    for room in range(500):
+        for step in range(10):
+            add_rule(engine, 5000 + step * 500, room = f"Room {room}")
+        add_rule(engine, 2500, room = f"Room {room}", type = "Thermostat")
+        add_rule(engine, 2500, room = f"Room {room}", type = "Light")
+    for i in range(10000 - len(engine["rules"])):
+        add_rule(engine, 40, device = thermostats[i * 7 % len(thermostats)])
+    setup = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for i in range(iterations):
+        if i % 2:
+            call(lights[i * 13 % len(lights)], "toggle_status")
+        else:
+            call(thermostats[i * 13 % len(thermostats)], "set_target_temperature", 20 + i % 7)
+    incremental = time.perf_counter() - start
+    close_alert_engine(engine)
+
+    rules = list(engine["rules"].values())
+    devices = {device["_id"]: device for device in thermostats}
+    start = time.perf_counter()
+    for _ in range(10): # what re-evaluating every rule after a change costs
+        for rule in rules:
+            if rule["per_device"]:
+                call(devices[rule["scope"][1]], "get_power_consumption")
+            else:
+                call(bench_management, "calculate_total_power_consumption")
+    full = (time.perf_counter() - start) / 10
+    print(f"  {len(rules)} rules over {count} devices, set up in {setup:.2f}s, {len(engine['alerts'])} alerts")
+    print(f"  change + incremental evaluation: {incremental / iterations * 1e6:.1f}us")
+    print(f"  re-evaluating every rule after a change: {full * 1e6:.0f}us")
+
+def bench_scheduler():
+    count = 100000
+    actions = 1000000
+    bench_management = make_management("bench_management")
+    devices = make_many(Light, [(f"Lamp {i}", f"Room {i % 500}", 100, "on", 50) for i in range(count)], management = bench_management)
+    call(bench_management, "calculate_total_power_consumption")
+    scheduler = make_scheduler(bench_management, tick = 60)
+    start = time.perf_counter()
+    ids = [schedule(scheduler, i * 86400 / actions, "toggle_status", device = devices[i % count]) for i in range(actions)]
+    insert = time.perf_counter() - start
+    start = time.perf_counter()
+    for action in ids[::10]:
+        cancel(scheduler, action)
+    cancelled = time.perf_counter() - start
+    start = time.perf_counter()
+    calls = run_due(scheduler, 86400)
+    run = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for i in range(100000): # the device calls alone, the floor for running the actions
+        call(devices[i % count], "toggle_status")
+    loop = (time.perf_counter() - start) / 100000 * calls
+    print(f"  schedule() of {actions} actions: {insert / actions * 1e6:.2f}us each")
+    print(f"  cancel() of {len(ids[::10])}: {cancelled / len(ids[::10]) * 1e6:.2f}us each")
+    print(f"  run_due() over a simulated day, 1440 ticks, {calls} calls: {run:.2f}s (the calls alone: {loop:.2f}s)")
+
+# scaling suite: the core API timed on synthetic fleets of several sizes, written as JSON and compared with a stored
+# baseline. python benchmark_smart_house.py --suite [--sizes 1000,100000] [--select query] [--output results.json]
+# [--baseline baseline.json] [--tolerance 0.25] exits with 1 when a scenario got slower than baseline * (1 + tolerance)
+SUITE_SIZES = (1000, 10000, 100000) # add 1000000 with --sizes, building it takes a while
+FLEET_MIX = {"Light": 0.5, "Thermostat": 0.3, "Camera": 0.2}
+
+def make_fleet(count, rooms = None, mix = None, connected = 0.5, ips = 16, management = None, seed = 0):
+    # count devices over rooms (default one per 20 devices), classes by the mix weights, and that share of the
+    # connectable devices connected to one of ips addresses. The same arguments always give the same fleet
+    rng = random.Random(seed)
+    management = make_management("bench_management") if management is None else management
+    rooms = max(1, count // 20) if rooms is None else rooms
+    mix = FLEET_MIX if mix is None else mix
+    classnames = rng.choices(list(mix), weights = list(mix.values()), k = count)
+    rows = {classname: [] for classname in mix}
+    for i, classname in enumerate(classnames):
+        row = [f"{classname} {i}", f"Room {rng.randrange(rooms)}", rng.choice([50, 100, 150]), rng.choice(["on", "on", "off"])]
+        if classname == "Light":
+            row.append(rng.randrange(10, 101))
+        elif classname == "Thermostat":
+            row += [rng.randrange(15, 25), rng.randrange(17, 24)]
+        elif classname == "Camera":
+            row.append(rng.randrange(1, 15))
+        rows[classname].append(row)
+    devices = []
+    for classname, class_rows in rows.items():
+        devices += make_many(DEVICE_CLASSES[classname], class_rows, management = management)
+    with batch_updates(management):
+        for device in devices:
+            if "connected" in device and rng.random() < connected:
+                call(device, "connect", f"10.0.0.{rng.randrange(ips)}")
+    return management, devices
+
+def _scenarios(management, devices):
+    # name -> (function running some operations, how many). Mutations leave the fleet as big as it was
+    rng = random.Random(1)
+    sample = [devices[rng.randrange(len(devices))] for _ in range(1000)]
+    connectable = [device for device in sample if "connected" in device]
+    thermostats = [device for device in sample if device["_classname"] == "Thermostat"]
+    room = sample[0]["location"]
+
+    scratch = make_management("bench_management") # make() goes elsewhere, so the fleet doesn't grow run after run
+    call(scratch, "select_devices", room = room)
+
+    def make_lights():
+        for i in range(100):
+            make(Light, f"Bench Lamp {i}", room, 100, "on", 50, management = scratch)
+
+    def flip_connections(): # connect() prints for devices that already are connected, so alternate
+        for device in connectable:
+            if device["connected"]:
+                call(device, "disconnect")
+            else:
+                call(device, "connect", "10.0.0.2")
+    return {
+        "make": (make_lights, 100),
+        "dispatch": (lambda: [call(device, "get_power_consumption") for device in sample], len(sample)),
+        "describe_device": (lambda: [call(device, "describe_device") for device in sample], len(sample)),
+        "search_type": (lambda: call(management, "search_type", "Camera"), 1),
+        "search_room": (lambda: call(management, "search_room", room), 1),
+        "total_power": (lambda: call(management, "calculate_total_power_consumption"), 1),
+        "total_power_room": (lambda: call(management, "calculate_total_power_consumption", search_room = room), 1),
+        "descriptions": (lambda: call(management, "get_all_device_descriptions"), 1),
+        "descriptions_room": (lambda: call(management, "get_all_device_descriptions", search_room = room), 1),
+        "connected_devices": (lambda: call(management, "get_all_connected_devices"), 1),
+        "connected_devices_ip": (lambda: call(management, "get_all_connected_devices", ip = "10.0.0.1"), 1),
+        "select_devices_room": (lambda: call(management, "select_devices", room = room), 1),
+        "query_grouped": (lambda: call(management, "query", group_by = "room", outputs = ("power", "count")), 1),
+        "power_breakdown": (lambda: call(management, "power_breakdown", "room"), 1),
+        "toggle_status": (lambda: [call(device, "toggle_status") for device in sample], len(sample)),
+        "connect_disconnect": (flip_connections, max(len(connectable), 1)),
+        "set_target_temperature": (lambda: [call(device, "set_target_temperature", rng.randrange(17, 24)) for device in thermostats], max(len(thermostats), 1)),
+        "set_status_many_room": (lambda: call(management, "set_status_many", rng.choice(["on", "off"]), {"room": room}), 1),
+    }
+
+def _time_scenario(function, operations, budget = 0.2):
+    # best seconds per operation over at least 3 runs and about budget seconds
+    function() # warm-up: lazily built indexes, totals, columns and caches
+    best, spent, runs = None, 0.0, 0
+    while runs < 3 or spent < budget:
+        start = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+        spent += elapsed
+        runs += 1
+        if runs >= 1000:
+            break
+    return best / operations
+
+def run_suite(sizes = SUITE_SIZES, output = None, baseline = None, tolerance = 0.25):
+    results = {}
+    for size in sizes:
+        start = time.perf_counter()
+        management, devices = make_fleet(size)
+        results[f"make_fleet@{size}"] = (time.perf_counter() - start) / size
+        print(f"[SUITE] {size} devices (built in {time.perf_counter() - start:.2f}s)")
+        for name, (function, operations) in _scenarios(management, devices).items():
+            if select_param and select_param.lower() not in name.lower():
+                continue
+            results[f"{name}@{size}"] = _time_scenario(function, operations)
+            print(f"  {name}: {results[f'{name}@{size}'] * 1e6:.2f}us")
+    report = {"meta": {"python": platform.python_version(), "machine": platform.machine(), "numpy": numpy is not None,
+                       "time": time.strftime("%Y-%m-%dT%H:%M:%S")}, "results": results}
+    if output:
+        with open(output, "w") as file:
+            json.dump(report, file, indent = 2)
+    regressions = []
+    if baseline:
+        with open(baseline) as file:
+            previous = json.load(file)["results"]
+        print("\n[BASELINE] " + baseline)
+        for key in sorted(set(results) & set(previous)):
+            ratio = results[key] / previous[key] if previous[key] else 1.0
+            flag = ""
+            if ratio > 1 + tolerance:
+                regressions.append(key)
+                flag = "  <-- slower"
+            elif ratio < 1 / (1 + tolerance):
+                flag = "  faster"
+            print(f"  {key}: {ratio:.2f}x{flag}")
+        print(f"{len(regressions)} regressions beyond {tolerance:.0%}")
+    return report, regressions
+
+def _option(name, default = None):
+    if name in sys.argv:
+        index = sys.argv.index(name) + 1
+        if len(sys.argv) > index:
+            return sys.argv[index]
+    return default
+
+def run_benchmarks():
+    start_time = time.time()
+    for (name, bench) in list(globals().items()):
+        if not name.startswith("bench_") or not callable(bench):
+            continue
+        if select_param and select_param.lower() not in name.lower():
+            continue
+        print(f"[BENCH] {name}")
+        bench_start = time.time()
+        bench()
+        print(f"  ({time.time() - bench_start:.5f}s)")
+    print(f"\nTotal time: {time.time() - start_time:.5f}s")
+
+select_param = None
+
+if __name__ == "__main__":
+    if "--select" in sys.argv:
+        select_param_index = sys.argv.index("--select") + 1
+        if len(sys.argv) > select_param_index:
+            select_param = sys.argv[select_param_index]
+    if "--suite" in sys.argv:
+        sizes = tuple(int(size) for size in _option("--sizes").split(",")) if _option("--sizes") else SUITE_SIZES
+        _, regressions = run_suite(sizes, _option("--output"), _option("--baseline"), float(_option("--tolerance", 0.25)))
+        sys.exit(1 if regressions else 0)
+    run_benchmarks()
@@ -1,55 +1,101 @@
+import contextlib
+import csv
+import itertools
+import json
+import inspect
+import math
+import operator
+import string
+import threading
+import time
+from array import array
+
+try: # optional, only used to evaluate the columnar store in one vectorized pass
+    import numpy
+except ImportError:
+    numpy = None
+
 def toggle_status(obj):
+    _update_device_from(obj, _toggled_status)
+
+def _toggled_status(obj): # read under the same write as the change, see _update_device_from()
     current_status = obj.get("status","off")
     if current_status == "on":
-        obj["status"] = "off"
+        return {"status": "off"}
     else:
-        obj["status"] = "on"
-    
+        return {"status": "on"}
+
 def get_power_consumption(obj):
     if obj["status"] == "off":
         return f"No power is consumed, {obj['name']} is off!"
 
-    match obj["_classname"]:
-        case "Light":
-            consumption = round(obj["base_power"]*obj["brightness"]/100)
-        case "Thermostat":
-            consumption = obj["base_power"]*abs(obj["target_temperature"] - obj["room_temperature"])
-        case "Camera":
-             consumption = obj["base_power"] * obj["resolution_factor"]
-        case _:
-            print("Unknown device type")  
-            return 0          
-    
-    return consumption
+    device_type = DEVICE_TYPES.get(obj["_classname"]) # see register_device_type()
+    if device_type is None:
+        print("Unknown device type")
+        return 0
+    return device_type["power"](obj)
 
 def set_target_temperature(obj, temperature):
-    obj["target_temperature"] = temperature
+    _update_device(obj, target_temperature = temperature)
 
 def get_target_temperature(obj):
     return obj["target_temperature"]
 
+def set_room_temperature(obj, temperature):
+    _update_device(obj, room_temperature = temperature)
+
+def set_brightness(obj, brightness):
+    _update_device(obj, brightness = brightness)
+
+def set_resolution_factor(obj, resolution_factor):
+    _update_device(obj, resolution_factor = resolution_factor)
+
+def relocate(obj, location): # the device keeps its id, the room indexes and totals move with it
+    _update_device(obj, location = location)
+
+def rename(obj, name):
+    _update_device(obj, name = name)
+
+# description cache: a device's description only changes with these fields, so it's kept per device id until
+# _untrack() sees one of them change (or a class method changes). register_device_type() adds each type's fields
+DESCRIPTION_FIELDS = {"name", "location", "status", "brightness", "room_temperature", "target_temperature", "resolution_factor", "connected", "ip"}
+_BUILTIN_DESCRIPTION_FIELDS = frozenset(DESCRIPTION_FIELDS) # what's left once every registered type is unregistered
+
 def describe_device(obj):
-    classname = obj["_classname"]
-    name = obj.get("name")
-    location = obj.get("location")
-    status = obj.get("status")
-    connection = call(obj,"describe_connection") if classname != "Light" else None
-
-    match classname:
-        case "Light":
-            brightness = obj.get("brightness")
-            return f"The {name} {classname} is located in {location}, is currently {status}, and is currently set to {brightness}% brightness"
-        case "Thermostat":
-            room_temp = obj.get("room_temperature")
-            target_temp = obj.get("target_temperature")
-            return f"The {name} {classname} is located in {location}, is currently set to {target_temp} degree Celsius in a {room_temp} degree room. {connection}"
-        case "Camera":
-            if obj.get("resolution_factor") < 5: resolution = "low"
-            elif obj.get("resolution_factor") < 10: resolution = "medium"
-            else: resolution = "high"
-            return f"The {name} {classname} is located in {location}, is currently {status}, and has a {resolution} resolution sensor. {connection}"
-        case _:
-            raise ValueError("Unknown device type")  
+    management = obj.get("_management")
+    if management is None or management.get("_compact"): # compact managements don't cache, the strings would outweigh the rows
+        return _describe_device(obj)
+    cache = management.get("_descriptions")
+    if cache is None or cache["generation"] != _class_generation:
+        cache = management["_descriptions"] = {"generation": _class_generation, "entries": {}, "hits": 0, "misses": 0}
+    description = cache["entries"].get(obj["_id"])
+    if description is None:
+        cache["misses"] += 1
+        version = management.get("_version")
+        description = _describe_device(obj)
+        lock = management.get("_lock")
+        if lock is None:
+            cache["entries"][obj["_id"]] = description
+        elif lock.acquire(blocking = False): # thread safe: only cache what no writer could have torn, and never wait for one
+            if management["_version"] == version and version % 2 == 0:
+                cache["entries"][obj["_id"]] = description
+            lock.release()
+    else:
+        cache["hits"] += 1
+    return description
+
+def description_cache_stats(obj):
+    cache = obj.get("_descriptions") or {"entries": {}, "hits": 0, "misses": 0}
+    return {"hits": cache["hits"], "misses": cache["misses"], "size": len(cache["entries"])}
+
+def _describe_device(obj):
+    device_type = DEVICE_TYPES.get(obj["_classname"]) # see register_device_type()
+    if device_type is None or device_type["description"] is None:
+        raise ValueError("Unknown device type")
+    values = {**obj, "classname": obj["_classname"]}
+    for name, extra in device_type["extras"].items():
+        values[name] = extra(obj)
+    return device_type["description"].format_map(values)
 
 # abstract methods
 def abstract_describe_device(obj):
@@ -66,20 +112,25 @@ Device = {
     "_classname":"Device",
     "_parent":None,
     "toggle_status":toggle_status,
+    "relocate":relocate,
+    "rename":rename,
     "get_power_consumption":abstract_get_power_consumption,
     "describe_device": abstract_describe_device
 }
 
 def connect(obj,ip):
-    if obj["connected"]==True:
-        print(f"{obj['name']} is now connected to {obj['ip']}.")
-    obj["ip"]=ip
-    obj["connected"]=True
+    def connected(obj):
+        if obj["connected"]==True:
+            print(f"{obj['name']} is now connected to {obj['ip']}.")
+        return {"ip": ip, "connected": True}
+    _update_device_from(obj, connected)
 
 def disconnect(obj):
-    if obj["connected"]==False:
-        print(f"{obj} is already disconnected.")
-    obj["connected"]=False
+    def disconnected(obj):
+        if obj["connected"]==False:
+            print(f"{obj['name']} is already disconnected.") # printing the whole dict would also print its management
+        return {"connected": False}
+    _update_device_from(obj, disconnected)
 
 def is_connected(obj):
     return obj["connected"]
@@ -101,6 +152,7 @@ Light = {
     "brightness":None,
     "get_power_consumption":get_power_consumption,
     "describe_device":describe_device,
+    "set_brightness":set_brightness,
     "_classname":"Light",
     "_parent":Device,
 }
@@ -113,7 +165,8 @@ Thermostat = {
     "get_power_consumption": get_power_consumption,
     "describe_device":describe_device,
     "set_target_temperature": set_target_temperature,
-    "get_target_temperature": get_target_temperature
+    "get_target_temperature": get_target_temperature,
+    "set_room_temperature": set_room_temperature
 }
 
 Camera = {
@@ -121,53 +174,918 @@ Camera = {
     "_classname":"Camera",
     "resolution_factor": None,
     "get_power_consumption": get_power_consumption,
-    "describe_device":describe_device
+    "describe_device":describe_device,
+    "set_resolution_factor": set_resolution_factor
 }
 
-def filter_helper(obj,condition):
-    devices = [device for device in obj["devices"] if condition(device)]
-    total_power = 0
-    descriptions = []
+# location hierarchy: a location is a path like "Site A/Building B/Floor 3/Room 301" (a plain room name is a path of
+# one part). Every prefix of it is a node of the location tree, the indexes and running totals keep a bucket and a
+# roll-up per node, so a subtree query (select_devices(within = ...), search_room(..., subtree = True)) reads one bucket
+LOCATION_SEPARATOR = "/"
+_nodes_cache = {} # location -> its nodes, from the root down to itself
+
+def _location_nodes(location):
+    nodes = _nodes_cache.get(location)
+    if nodes is None:
+        if not isinstance(location, str):
+            nodes = (location,)
+        else:
+            parts = location.split(LOCATION_SEPARATOR)
+            nodes = tuple(LOCATION_SEPARATOR.join(parts[:depth]) for depth in range(1, len(parts) + 1))
+        nodes = _nodes_cache[location] = nodes
+    return nodes
+
+def _is_within(location, node):
+    return location == node or (isinstance(location, str) and location.startswith(node + LOCATION_SEPARATOR))
+
+# secondary indexes: field -> value -> {device id: device}, built on the first indexed query and kept up to date by
+# make() and _update_device(), so a room/type/IP lookup only touches the matching devices. "within" is the location
+# tree: node -> every device at or below it
+INDEXED_FIELDS = ("_classname", "location", "ip", "status")
+
+def _device_index(management):
+    index = management.get("_index")
+    if index is None:
+        with _writing(management):
+            if management.get("_index") is not None: # another thread built it while this one waited
+                return management["_index"]
+            index = {field: {} for field in INDEXED_FIELDS + ("within",)}
+            for device in management["devices"]:
+                _index_add(index, device, INDEXED_FIELDS)
+            management["_index"] = index
+    return index
+
+def _index_add(index, device, fields):
+    for field in fields:
+        if field in index:
+            index[field].setdefault(device.get(field), {})[device["_id"]] = device
+    if "location" in fields:
+        for node in _location_nodes(device["location"]):
+            index["within"].setdefault(node, {})[device["_id"]] = device
+
+def _index_remove(index, device, fields):
+    for field in fields:
+        if field in index:
+            bucket = index[field].get(device.get(field))
+            if bucket is not None:
+                bucket.pop(device["_id"], None)
+                if not bucket:
+                    del index[field][device.get(field)]
+    if "location" in fields:
+        for node in _location_nodes(device["location"]):
+            bucket = index["within"].get(node)
+            if bucket is not None:
+                bucket.pop(device["_id"], None)
+                if not bucket:
+                    del index["within"][node]
+
+# running power totals (house, per room, per type, per (room, type), per location tree node and per (node, type)),
+# built on the first total query and then updated by subtracting a device's old power and adding its new power
+# whenever a field the power or its groups depend on changes (register_device_type() adds the fields each power
+# formula reads). Every group also counts its devices, and a group whose count drops to 0 is dropped, so the float
+# rounding of the subtractions doesn't outlive the devices that caused it and rooms or types that come and go don't
+# pile up in the totals
+POWER_FIELDS = {"_classname", "location", "status", "base_power", "brightness", "room_temperature", "target_temperature", "resolution_factor"}
+_BUILTIN_POWER_FIELDS = frozenset(POWER_FIELDS)
+
+def _power_value(device):
+    power = call(device, "get_power_consumption")
+    return power if isinstance(power, (int,float)) else 0
+
+def _power_totals(management):
+    totals = management.get("_totals")
+    if totals is None or totals["generation"] != _class_generation:
+        with _writing(management):
+            totals = management.get("_totals")
+            if totals is not None and totals["generation"] == _class_generation: # another thread rebuilt them while this one waited
+                return totals
+            totals = _empty_totals(_class_generation)
+            for device in _devices(management):
+                _totals_add(totals, device, _power_value(device)) # a device without a power method raises here, like a scan would
+            management["_totals"] = totals
+    return totals
+
+TOTAL_GROUPS = ("room", "type", "room_type", "node", "node_type")
+
+def _empty_totals(generation = None):
+    return {"generation": generation, "all": 0, "all_count": 0, **{group: {} for group in TOTAL_GROUPS}, "count": {group: {} for group in TOTAL_GROUPS}}
+
+def _totals_add(totals, device, power, count = 1): # count: -1 when the device leaves its groups
+    room, type = device["location"], device["_classname"]
+    totals["all_count"] += count
+    totals["all"] = totals["all"] + power if totals["all_count"] else 0
+    counts = totals["count"]
+    _group_add(totals["room"], counts["room"], room, power, count)
+    _group_add(totals["type"], counts["type"], type, power, count)
+    _group_add(totals["room_type"], counts["room_type"], (room, type), power, count)
+    for node in _location_nodes(room):
+        _group_add(totals["node"], counts["node"], node, power, count)
+        _group_add(totals["node_type"], counts["node_type"], (node, type), power, count)
+
+def _group_add(powers, counts, key, power, count):
+    remaining = counts.get(key, 0) + count
+    if remaining:
+        counts[key] = remaining
+        powers[key] = powers.get(key, 0) + power
+    else: # its last device left
+        counts.pop(key, None)
+        powers.pop(key, None)
+
+def _totals_update(management, obj, fields, sign):
+    if management.get("_totals") is None or not any(field in POWER_FIELDS for field in fields):
+        return
+    try:
+        _totals_add(management["_totals"], obj, sign * _power_value(obj), sign)
+    except NotImplementedError: # can't be maintained, drop them and let the next query rebuild (and raise) as a scan would
+        management["_totals"] = None
+
+def check_power_totals(obj): # consistency check: the running totals must match a full recomputation
+    totals = _power_totals(obj)
+    expected = _empty_totals(totals["generation"])
+    for device in _devices(obj):
+        _totals_add(expected, device, _power_value(device))
+    for group in TOTAL_GROUPS:
+        for key in set(totals[group]) | set(expected[group]):
+            if not math.isclose(totals[group].get(key, 0), expected[group].get(key, 0), abs_tol = 1e-6):
+                raise AssertionError(f"Running {group} total for {key} is {totals[group].get(key, 0)}, expected {expected[group].get(key, 0)}")
+            if totals["count"][group].get(key, 0) != expected["count"][group].get(key, 0):
+                raise AssertionError(f"Running {group} count for {key} is {totals['count'][group].get(key, 0)}, expected {expected['count'][group].get(key, 0)}")
+    if not math.isclose(totals["all"], expected["all"], abs_tol = 1e-6):
+        raise AssertionError(f"Running house total is {totals['all']}, expected {expected['all']}")
+    return True
+
+# columnar store: one array per numeric field plus interned type and room codes, one row per device. The device dicts
+# stay the API (call() keeps working on them); enable_columns() mirrors them into rows that _track() keeps up to date
+COLUMN_FIELDS = ("base_power", "brightness", "room_temperature", "target_temperature", "resolution_factor")
+
+# device type registry: a device class declares its constructor fields, its power formula and its description once,
+# and make(), get_power_consumption() and describe_device() look the type up in DEVICE_TYPES instead of matching
+# class names. The power formula's parameter names are the device fields it reads; when they are all COLUMN_FIELDS
+# the same formula (or the vectorized one given) also evaluates whole columns, so the type gets batched power too
+DEVICE_TYPES = {} # classname -> registration
+DEVICE_CLASSES = {} # classname -> class dict
+CONSTRUCTOR_FIELDS = {} # classname -> fields filled from make()'s extra arguments, in order
+_column_formulas = {} # classname -> (formula over numpy columns, formula over plain row values in COLUMN_FIELDS order)
+
+def register_device_type(cls, fields = (), defaults = None, power = None, description = None, extras = None, vectorized = None):
+    # fields: make()'s extra arguments, defaults: fields every new device starts with, power: formula(field, ...) of an
+    # "on" device, description: a str.format template over the device fields, classname and extras (name -> function(obj)),
+    # with {connection} available to connectable types. vectorized(columns) overrides the formula for numpy columns
+    classname = cls["_classname"]
+    params = tuple(inspect.signature(power).parameters) if power is not None else ()
+    extras = dict(extras or {})
+    if description is not None and "{connection}" in description and "connection" not in extras:
+        extras["connection"] = lambda obj: call(obj, "describe_connection")
+    read = operator.itemgetter(*params) if params else None
+    template_fields = {field.split(".")[0].split("[")[0] for _, field, _, _ in string.Formatter().parse(description or "") if field}
+    methods = {"get_power_consumption": get_power_consumption, "describe_device": describe_device}
+    previous = DEVICE_TYPES[classname]["methods"] if DEVICE_CLASSES.get(classname) is cls else {} # registered again
+    DEVICE_TYPES[classname] = {
+        "class": cls,
+        "fields": tuple(fields),
+        "defaults": dict(defaults or {}),
+        "power": (lambda obj: power(read(obj))) if len(params) == 1 else (lambda obj: power(*read(obj))) if params else (lambda obj: 0),
+        "formula": power,
+        "params": params,
+        "description": description,
+        "extras": extras,
+        "description_fields": (template_fields - set(extras)) | set(fields) | set(params),
+        "methods": {name: method for name, method in methods.items() if name not in cls or cls[name] is previous.get(name)}, # what unregistering takes back
+    }
+    DEVICE_CLASSES[classname] = cls
+    CONSTRUCTOR_FIELDS[classname] = tuple(fields)
+    POWER_FIELDS.update(params) # so the running totals and the columns follow changes of them
+    DESCRIPTION_FIELDS.update(DEVICE_TYPES[classname]["description_fields"])
+    _column_formulas.pop(classname, None)
+    if params and all(param in COLUMN_FIELDS for param in params):
+        positions = operator.itemgetter(*(COLUMN_FIELDS.index(param) for param in params))
+        row = (lambda *values: power(positions(values))) if len(params) == 1 else (lambda *values: power(*positions(values)))
+        _column_formulas[classname] = (vectorized or _vectorize(power, params), row)
+    for name, method in methods.items():
+        cls.setdefault(name, method)
+    invalidate_method_cache(cls) # a new formula makes cached totals and descriptions stale
+
+def _vectorize(power, params): # the scalar formula over whole numpy columns, or row by row if it can't take arrays
+    def vectorized(columns):
+        values = [columns[param] for param in params]
+        try:
+            return power(*values)
+        except TypeError: # e.g. round() of an array
+            return numpy.fromiter(map(power, *values), dtype = numpy.float64, count = len(values[0]))
+    return vectorized
+
+def unregister_device_type(classname): # undoes everything register_device_type() did, fields other types use stay known
+    cls = DEVICE_CLASSES.pop(classname)
+    device_type = DEVICE_TYPES.pop(classname)
+    del CONSTRUCTOR_FIELDS[classname]
+    _column_formulas.pop(classname, None)
+    for name, method in device_type["methods"].items():
+        if cls.get(name) is method: # unless it was replaced since
+            del cls[name]
+    POWER_FIELDS.intersection_update(_BUILTIN_POWER_FIELDS.union(*(other["params"] for other in DEVICE_TYPES.values())))
+    DESCRIPTION_FIELDS.intersection_update(_BUILTIN_DESCRIPTION_FIELDS.union(*(other["description_fields"] for other in DEVICE_TYPES.values())))
+    invalidate_method_cache(cls)
+
+
+def enable_columns(obj):
+    columns = obj.get("_columns")
+    if columns is None:
+        with _writing(obj):
+            if obj.get("_columns") is not None: # another thread built them while this one waited
+                return obj["_columns"]
+            columns = {field: array("d") for field in COLUMN_FIELDS}
+            columns.update({"status": array("b"), "type": array("H"), "room": array("I"), "rows": {}, "devices": list(obj.get("devices", [])),
+                            "type_names": [], "type_codes": {}, "room_names": [], "room_codes": {}})
+            if obj.get("_compact"): # the columns are the only copy of the devices, see make_management(compact = True)
+                columns.update({"rows": None, "devices": None, "name": [], "ip": array("I"), "connected": array("b"), "float_mask": array("B"),
+                                "ip_names": [], "ip_codes": {}, "type_classes": [], "type_fields": [], "fields": {}})
+            devices = obj.get("devices", [])
+            for field in COLUMN_FIELDS: # filled a column at a time, much faster than _columns_write() per device
+                columns[field].extend(_column_value(device.get(field)) for device in devices)
+            columns["status"].extend(1 if device.get("status") == "on" else 0 for device in devices)
+            columns["type"].extend(_intern(columns, "type", device["_classname"]) for device in devices)
+            columns["room"].extend(_intern(columns, "room", device["location"]) for device in devices)
+            if columns["rows"] is not None:
+                columns["rows"].update((device["_id"], row) for row, device in enumerate(devices))
+            obj["_columns"] = columns
+    return columns
+
+def _intern(columns, kind, value):
+    codes = columns[kind + "_codes"]
+    code = codes.get(value)
+    if code is None:
+        code = codes[value] = len(columns[kind + "_names"])
+        columns[kind + "_names"].append(value)
+    return code
+
+def _column_value(value):
+    return float(value) if isinstance(value, (int,float)) else 0.0
+
+def _columns_write(columns, device):
+    rows = columns["rows"]
+    if rows is not None:
+        row = rows.get(device["_id"])
+    else: # compact: ids are handed out in row order
+        row = device["_id"] if device["_id"] < len(columns["type"]) else None
+    values = [_column_value(device.get(field)) for field in COLUMN_FIELDS]
+    status = 1 if device.get("status") == "on" else 0
+    type, room = _intern(columns, "type", device["_classname"]), _intern(columns, "room", device["location"])
+    if rows is None:
+        _compact_write(columns, device, row)
+    if row is None:
+        if rows is not None:
+            rows[device["_id"]] = len(columns["devices"])
+            columns["devices"].append(device)
+        for field, value in zip(COLUMN_FIELDS, values):
+            columns[field].append(value)
+        columns["status"].append(status)
+        columns["type"].append(type)
+        columns["room"].append(room)
+    else:
+        for field, value in zip(COLUMN_FIELDS, values):
+            columns[field][row] = value
+        columns["status"][row] = status
+        columns["type"][row] = type
+        columns["room"][row] = room
+
+def _columns_remove(columns, device): # swap-remove: the last row moves into the device's row. Returns that row
+    row = columns["rows"].pop(device["_id"], None)
+    if row is None:
+        return None
+    moved = columns["devices"].pop()
+    for field in COLUMN_FIELDS + ("status", "type", "room"):
+        value = columns[field].pop()
+        if moved is not device:
+            columns[field][row] = value
+    if moved is not device:
+        columns["devices"][row] = moved
+        columns["rows"][moved["_id"]] = row
+    return row
+
+# compact mode: besides the numeric columns, a compact management keeps names, interned IPs, the connected flag,
+# which numeric fields were floats and, for registered types with fields outside the columns, those fields per row
+# ("fields": row -> {field: value}), so a device can be rebuilt from its row. make() returns such a rebuilt row view,
+# call() refreshes it from the row before dispatching and _track() writes changes back
+_VIEW_KEYS = ("_class", "_classname", "name", "location", "base_power", "status", "_management", "_id", "_view")
+
+def _compact_write(columns, device, row):
+    code = columns["type_codes"][device["_classname"]]
+    if code == len(columns["type_classes"]): # the first device of a type decides which fields its rows have
+        columns["type_classes"].append(device["_class"])
+        columns["type_fields"].append(tuple(key for key in device if key not in _VIEW_KEYS))
+    other = {field: device.get(field) for field in columns["type_fields"][code] if field not in COLUMN_FIELDS and field not in ("ip", "connected")}
+    if other:
+        columns["fields"][len(columns["name"]) if row is None else row] = other
+    float_mask = sum(1 << bit for bit, field in enumerate(COLUMN_FIELDS) if isinstance(device.get(field), float))
+    values = (device.get("name"), _intern(columns, "ip", device.get("ip")), 1 if device.get("connected") else 0, float_mask)
+    for column, value in zip(("name", "ip", "connected", "float_mask"), values):
+        if row is None:
+            columns[column].append(value)
+        else:
+            columns[column][row] = value
+
+def _row_number(columns, field, row):
+    value = columns[field][row]
+    return value if columns["float_mask"][row] >> COLUMN_FIELDS.index(field) & 1 else int(value)
+
+def row_view(obj, row):
+    columns = obj["_columns"]
+    code = columns["type"][row]
+    view = {
+        "_class": columns["type_classes"][code],
+        "_classname": columns["type_names"][code],
+        "name": columns["name"][row],
+        "location": columns["room_names"][columns["room"][row]],
+        "base_power": _row_number(columns, "base_power", row),
+        "status": "on" if columns["status"][row] else "off",
+        "_management": obj,
+        "_id": row,
+        "_view": True
+    }
+    for field in columns["type_fields"][code]:
+        if field == "ip":
+            view["ip"] = columns["ip_names"][columns["ip"][row]]
+        elif field == "connected":
+            view["connected"] = columns["connected"][row] == 1
+        elif field in COLUMN_FIELDS:
+            view[field] = _row_number(columns, field, row)
+        else: # a registered type's own field
+            view[field] = columns["fields"][row][field]
+    return view
+
+def _compact_rows(columns, criteria):
+    rows = range(len(columns["type"]))
+    for field, value in criteria.items():
+        if field == "status":
+            column, code = columns["status"], 1 if value == "on" else 0
+        elif field == "within": # the room codes under the node, then one pass like the other fields
+            codes = {code for code, room in enumerate(columns["room_names"]) if _is_within(room, value)}
+            rows = [row for row in rows if columns["room"][row] in codes]
+            continue
+        else:
+            kind = {"_classname": "type", "location": "room", "ip": "ip"}[field]
+            column, code = columns[kind], columns[kind + "_codes"].get(value)
+            if code is None:
+                return []
+        rows = [row for row in rows if column[row] == code]
+    return rows
+
+def _devices(obj): # the device dicts, or fresh row views for a compact management
+    if not obj.get("_compact"):
+        return obj["devices"]
+    return (row_view(obj, row) for row in range(len(obj["_columns"]["type"])))
+
+def _column_power(obj): # power of every row, in one pass over the arrays
+    columns = obj["_columns"]
+    formulas = {columns["type_codes"][name]: formula for name, formula in _column_formulas.items() if name in columns["type_codes"]}
+    others = [row for row, code in enumerate(columns["type"]) if code not in formulas] if len(formulas) < len(columns["type_names"]) else []
+    if numpy is not None:
+        arrays = {field: numpy.frombuffer(columns[field], dtype = numpy.float64) if len(columns[field]) else numpy.zeros(0) for field in COLUMN_FIELDS}
+        types = numpy.frombuffer(columns["type"], dtype = numpy.uint16) if len(columns["type"]) else numpy.zeros(0, dtype = numpy.uint16)
+        try:
+            power = numpy.zeros(len(types))
+            for code, (vectorized, _) in formulas.items():
+                mask = types == code
+                power[mask] = vectorized({field: values[mask] for field, values in arrays.items()})
+            power *= numpy.frombuffer(columns["status"], dtype = numpy.int8) if len(columns["status"]) else 0
+        finally:
+            del arrays, types # release the buffer exports so the arrays can grow again, also when a formula raised
+    else: # per type: the formula mapped over the type's "on" rows of just the columns it reads
+        power = [0.0] * len(columns["type"])
+        for code in formulas:
+            device_type = DEVICE_TYPES[columns["type_names"][code]]
+            if len(columns["type_names"]) == 1: # a single type, status alone picks the rows
+                on = columns["status"]
+            else:
+                on = [type == code and status for type, status in zip(columns["type"], columns["status"])]
+            values = map(device_type["formula"], *(itertools.compress(columns[param], on) for param in device_type["params"]))
+            for row, value in zip(itertools.compress(range(len(on)), on), values):
+                power[row] = value
+    for row in others: # types without a column formula go through their own get_power_consumption
+        power[row] = _power_value(columns["devices"][row] if columns["rows"] is not None else row_view(obj, row))
+    return power
+
+def power_breakdown(obj, group_by = None): # whole-fleet total, or totals per "room", "type" or "room_type", from the columns
+    columns = enable_columns(obj)
+    return _group_power(columns, _column_power(obj), group_by)
+
+def _group_power(columns, power, group_by): # power: one value per row, as _column_power() returns it
+    if group_by is None:
+        return float(sum(power)) if numpy is None else float(power.sum())
+    if group_by == "room_type":
+        width = max(len(columns["type_names"]), 1)
+        codes = [room * width + type for room, type in zip(columns["room"], columns["type"])]
+        names = [(room, type) for room in columns["room_names"] for type in columns["type_names"]]
+    elif group_by in ("room", "type"):
+        codes, names = columns[group_by], columns[group_by + "_names"]
+    else:
+        raise ValueError(f"Can't group power by {group_by}")
+    if numpy is not None:
+        sums = numpy.bincount(numpy.asarray(codes, dtype = numpy.int64), weights = power, minlength = len(names)).tolist()
+    else:
+        sums = [0.0] * len(names)
+        for code, value in zip(codes, power):
+            sums[code] += value
+    present = set(codes)
+    return {name: total for code, (name, total) in enumerate(zip(names, sums)) if code in present}
+
+def _track(management, obj, fields): # obj has (new) values for fields
+    columns = management.get("_columns")
+    if columns is not None and (columns["rows"] is None or any(field in POWER_FIELDS for field in fields)):
+        _columns_write(columns, obj) # first, a compact view that gets call()ed below is refreshed from this row
+    index = management.get("_index")
+    if index is not None:
+        _index_add(index, obj, fields)
+    _totals_update(management, obj, fields, 1)
+
+def _track_batch(management, objs): # _track() for many new devices, each structure is updated in one go
+    columns = management.get("_columns")
+    if columns is not None:
+        for obj in objs:
+            _columns_write(columns, obj)
+    index = management.get("_index")
+    if index is not None:
+        for obj in objs:
+            _index_add(index, obj, INDEXED_FIELDS)
+    totals = management.get("_totals")
+    if totals is not None:
+        batch = _empty_totals()
+        try:
+            for obj in objs:
+                _totals_add(batch, obj, _power_value(obj))
+        except NotImplementedError:
+            management["_totals"] = None
+        else:
+            totals["all"] += batch["all"]
+            totals["all_count"] += batch["all_count"]
+            for group in TOTAL_GROUPS:
+                for key, power in batch[group].items():
+                    _group_add(totals[group], totals["count"][group], key, power, batch["count"][group][key])
+    for obj in objs:
+        _notify(management, "make", obj)
+
+def _untrack(management, obj, fields): # obj still has the old values for fields
+    index = management.get("_index")
+    if index is not None:
+        _index_remove(index, obj, fields)
+    _totals_update(management, obj, fields, -1)
+    descriptions = management.get("_descriptions")
+    if descriptions is not None and any(field in DESCRIPTION_FIELDS for field in fields):
+        descriptions["entries"].pop(obj["_id"], None)
+
+def _update_device(obj, **changes): # every state change of a device goes through here so the management stays in sync
+    management = obj.get("_management")
+    if management is None:
+        obj.update(changes)
+        return
+    if management.get("_lock") is not None: # thread safe, see _writing()
+        with _writing(management):
+            _apply_update(management, obj, changes)
+    else:
+        _apply_update(management, obj, changes)
+
+def _update_device_from(obj, changes_of): # changes_of(obj) -> changes, read under the same write as the update, so two
+    # threads toggling one device can't both read "off" and both write "on"
+    management = obj.get("_management")
+    if management is None:
+        obj.update(changes_of(obj))
+        return
+    if management.get("_lock") is not None: # thread safe, see _writing()
+        with _writing(management):
+            _apply_update(management, obj, changes_of(obj))
+    else:
+        _apply_update(management, obj, changes_of(obj))
+
+def _apply_update(management, obj, changes):
+    batch = management.get("_batch")
+    if batch is not None and not management.get("_compact"): # compact views re-read their row, so they can't wait
+        entry = batch.get(obj["_id"])
+        if entry is None:
+            entry = batch[obj["_id"]] = (obj, dict(obj), set()) # the state before the batch touched it
+        entry[2].update(changes)
+        descriptions = management.get("_descriptions")
+        if descriptions is not None and any(field in DESCRIPTION_FIELDS for field in changes): # the device itself is already changed
+            descriptions["entries"].pop(obj["_id"], None)
+        obj.update(changes)
+        _notify(management, "update", obj, changes)
+        return
+    _untrack(management, obj, changes)
+    obj.update(changes)
+    _track(management, obj, changes)
+    _notify(management, "update", obj, changes)
+
+# observers: functions called as observer(management, event, device, changes) after every "make" (changes is None)
+# and every "update" of a device in the management, e.g. to journal or forward the changes. A "batch" event (device
+# and changes None) follows the end of a batch_updates() block, once the indexes and totals caught up with it.
+# A "remove" event comes after the device left everything, changes is {"row": the columns row it had, or None}
+def add_observer(obj, observer):
+    obj["_observers"] = obj.get("_observers", ()) + (observer,) # replaced, not mutated, so a running _notify() isn't affected
+
+def remove_observer(obj, observer):
+    obj["_observers"] = tuple(registered for registered in obj.get("_observers", ()) if registered is not observer)
+
+def _notify(management, event, device, changes = None):
+    for observer in management.get("_observers", ()):
+        observer(management, event, device, changes)
+
+@contextlib.contextmanager
+def batch_updates(obj): # changes inside the block update the indexes, totals and caches once per device at the end,
+    # queries inside the block still see them as they were before it
+    with _writing(obj): # thread safe: the whole block is one write, readers see all of it or none of it
+        if obj.get("_batch") is not None: # nested, the outer batch flushes
+            yield obj
+            return
+        obj["_batch"] = {}
+        try:
+            yield obj
+        finally:
+            batch = obj.pop("_batch")
+            for entry in batch.values():
+                if entry is None: # removed inside the batch
+                    continue
+                device, before, fields = entry
+                _untrack(obj, before, fields)
+                _track(obj, device, fields)
+            if batch:
+                _notify(obj, "batch", None)
+
+# thread safe managements (make_management(thread_safe = True)): the indexes and running totals span every room, so
+# writers take one lock and bump _version to odd before and back to even after they change anything. Readers don't
+# take it, they run optimistically and retry when _version moved meanwhile (a seqlock), so a query never returns
+# torn state and never waits behind a single device update. After READ_RETRIES a reader waits for the lock instead
+READ_RETRIES = 8
+READ_METHODS = ("search_type", "search_room", "calculate_total_power_consumption", "get_all_device_descriptions", "get_all_connected_devices",
+                "location_rollup", "select_devices", "query", "power_breakdown", "check_power_totals")
+
+@contextlib.contextmanager
+def _writing(management):
+    lock = management.get("_lock")
+    if lock is None:
+        yield
+        return
+    with lock:
+        management["_writers"] += 1
+        if management["_writers"] == 1:
+            management["_version"] += 1
+        try:
+            yield
+        finally:
+            management["_writers"] -= 1
+            if management["_writers"] == 0:
+                management["_version"] += 1
+
+def consistent_read(obj, function, *args, **kwargs):
+    lock = obj.get("_lock")
+    if lock is None:
+        return function(obj, *args, **kwargs)
+    for _ in range(READ_RETRIES):
+        version = obj["_version"]
+        if version % 2 == 0:
+            try:
+                result = function(obj, *args, **kwargs)
+            except Exception: # e.g. a dict resized under the read, only an error if nothing was written meanwhile
+                if obj["_version"] == version:
+                    raise
+                continue
+            if obj["_version"] == version:
+                return result
+        time.sleep(0) # let the writer finish
+    with lock:
+        return function(obj, *args, **kwargs)
+
+def _consistent(function):
+    return lambda obj, *args, **kwargs: consistent_read(obj, function, *args, **kwargs)
+
+# bulk mutations: the same methods a caller would call() per device, applied to everything matching a
+# select_devices() selector (type, room, ip, status) inside one batch. They return how many devices they changed
+def set_status_many(obj, status, where = None):
+    if status not in ("on", "off"):
+        raise ValueError(f"Status must be on or off, not {status}")
+    changed = 0
+    with batch_updates(obj):
+        for device in select_devices(obj, **(where or {})):
+            if device.get("status", "off") != status:
+                call(device, "toggle_status")
+                changed += 1
+    return changed
+
+def connect_many(obj, ip, where = None):
+    changed = 0
+    with batch_updates(obj):
+        for device in select_devices(obj, **(where or {})):
+            if resolve(device["_class"], "connect") is not None and not (device["connected"] and device["ip"] == ip):
+                call(device, "connect", ip)
+                changed += 1
+    return changed
+
+def disconnect_many(obj, where = None):
+    changed = 0
+    with batch_updates(obj):
+        for device in select_devices(obj, **(where or {})):
+            if resolve(device["_class"], "disconnect") is not None and device["connected"]:
+                call(device, "disconnect")
+                changed += 1
+    return changed
+
+def set_target_temperature_many(obj, temperature, where = None):
+    changed = 0
+    with batch_updates(obj):
+        for device in select_devices(obj, **(where or {})):
+            if resolve(device["_class"], "set_target_temperature") is not None and device.get("target_temperature") != temperature:
+                call(device, "set_target_temperature", temperature)
+                changed += 1
+    return changed
+
+def relocate_many(obj, location, where = None):
+    changed = 0
+    with batch_updates(obj):
+        for device in select_devices(obj, **(where or {})):
+            if device["location"] != location:
+                call(device, "relocate", location)
+                changed += 1
+    return changed
+
+# removal: a device leaves the indexes, totals and description cache through _untrack() like any other change, then
+# the last device takes its place in the devices list (and the last row its row in the columns), so removing is O(1)
+# and every other device keeps its id. The devices list is in creation order only until the first removal, the
+# indexed queries still return creation order (they sort by id). Compact managements can't remove, their ids are rows
+def remove_device(obj, device):
+    if obj.get("_compact"):
+        raise ValueError("Devices can't be removed from a compact management, their ids are their rows")
+    with _writing(obj):
+        devices, positions = obj["devices"], _device_positions(obj)
+        position = positions.get(device["_id"])
+        if position is None or devices[position] is not device:
+            raise ValueError(f"{device['name']} is not in this management")
+        batch = obj.get("_batch")
+        entry = None
+        if batch is not None:
+            entry = batch.get(device["_id"])
+            batch[device["_id"]] = None # nothing left to flush, but the batch still ends with a "batch" event
+        before = device if entry is None else entry[1] # inside a batch the structures still have the state from before it
+        _untrack(obj, before, before)
+        moved = devices.pop()
+        del positions[device["_id"]]
+        if moved is not device:
+            devices[position] = moved
+            positions[moved["_id"]] = position
+        columns = obj.get("_columns")
+        row = _columns_remove(columns, device) if columns is not None else None
+        device["_management"] = None # detached, calls on it only change the dict from now on
+        _notify(obj, "remove", device, {"row": row})
+
+def remove_many(obj, where = None):
+    with batch_updates(obj):
+        removed = select_devices(obj, **(where or {}))
+        for device in removed:
+            remove_device(obj, device)
+    return len(removed)
+
+def _device_positions(management): # device id -> position in the devices list, built on the first removal
+    positions = management.get("_positions")
+    if positions is None or len(positions) != len(management["devices"]): # devices were appended behind its back (e.g. a restore)
+        positions = management["_positions"] = {device["_id"]: position for position, device in enumerate(management["devices"])}
+    return positions
+
+def _append_devices(management, devices):
+    positions = management.get("_positions")
+    if positions is not None and len(positions) == len(management["devices"]):
+        positions.update((device["_id"], len(management["devices"]) + offset) for offset, device in enumerate(devices))
+    management["devices"].extend(devices)
+
+def _iter_selected(obj, type = None, room = None, ip = None, status = None, within = None): # lazy version of select_devices()
+    criteria = {field: value for field, value in zip(INDEXED_FIELDS + ("within",), (type, room, ip, status, within)) if value is not None}
+    if not criteria:
+        yield from _devices(obj)
+        return
+    if obj.get("_compact"): # no per-device indexes here, they would cost more memory than the rows
+        for row in _compact_rows(obj["_columns"], criteria):
+            yield row_view(obj, row)
+        return
+    index = _device_index(obj)
+    bucket = min((index[field].get(value, {}) for field, value in criteria.items()), key = len)
+    for device_id in sorted(bucket): # sorted ids = creation order, same as the full scan
+        device = bucket.get(device_id) # may have left the bucket while a stream was paused
+        if device is not None and (len(criteria) == 1 or all(_matches(device, field, value) for field, value in criteria.items())):
+            yield device
+
+def _matches(device, field, value):
+    return _is_within(device["location"], value) if field == "within" else device.get(field) == value
+
+def select_devices(obj, type = None, room = None, ip = None, status = None, within = None):
+    # within: a location tree node, every device at it or below it
+    return list(_iter_selected(obj, type, room, ip, status, within))
+
+# streaming variants of the queries: devices or descriptions are produced one at a time (or in lists of chunk_size),
+# so a caller that pages through the results never pays for the ones it doesn't read
+def stream_devices(obj, where = None, condition = None, output = "devices", offset = 0, limit = None, chunk_size = None):
+    if output not in ("devices", "descriptions"):
+        raise ValueError(f"Can't stream {output}, only devices or descriptions")
+    devices = _iter_selected(obj, **where) if where else iter(_devices(obj))
+    if condition is not None:
+        devices = filter(condition, devices)
+    devices = itertools.islice(devices, offset, None if limit is None else offset + limit)
+    items = devices if output == "devices" else (call(device, "describe_device") for device in devices)
+    if chunk_size is None:
+        return items
+    return _chunked(items, chunk_size)
+
+def _chunked(items, chunk_size):
+    while True:
+        chunk = list(itertools.islice(items, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+def stream_search_type(obj, type, output = "devices", offset = 0, limit = None, chunk_size = None):
+    return stream_devices(obj, {"type": type}, output = output, offset = offset, limit = limit, chunk_size = chunk_size)
+
+def stream_search_room(obj, room, output = "devices", offset = 0, limit = None, chunk_size = None):
+    return stream_devices(obj, {"room": room}, output = output, offset = offset, limit = limit, chunk_size = chunk_size)
+
+def stream_device_descriptions(obj, search_type = None, search_room = None, offset = 0, limit = None, chunk_size = None):
+    return stream_devices(obj, {"type": search_type, "room": search_room}, output = "descriptions", offset = offset, limit = limit, chunk_size = chunk_size)
+
+def stream_connected_devices(obj, ip = None, output = "devices", offset = 0, limit = None, chunk_size = None):
+    return stream_devices(obj, {"ip": ip, "status": "on"}, lambda x: x.get("connected") is True, output, offset, limit, chunk_size)
+
+# single pass aggregation: every requested output (and only those) is computed while walking the devices once
+QUERY_OUTPUTS = ("power", "count", "descriptions", "devices")
+_GROUP_FIELDS = {"type": "_classname", "room": "location"} # same names as select_devices(), other names are device fields
+
+def _group_key(group_by):
+    if group_by is None:
+        return None
+    if callable(group_by):
+        return group_by
+    if isinstance(group_by, (tuple, list)):
+        fields = [_GROUP_FIELDS.get(field, field) for field in group_by]
+        return lambda device: tuple(device.get(field) for field in fields)
+    field = _GROUP_FIELDS.get(group_by, group_by)
+    return lambda device: device.get(field)
+
+def _aggregate(devices, condition = None, group_by = None, outputs = ("power",)):
+    unknown = [output for output in outputs if output not in QUERY_OUTPUTS]
+    if unknown:
+        raise ValueError(f"Unknown query outputs: {unknown}")
+    want_power, want_count, want_descriptions, want_devices = (output in outputs for output in QUERY_OUTPUTS)
+    key_of = _group_key(group_by)
+    groups = {}
     for device in devices:
-        power = call(device, "get_power_consumption")
-        if isinstance(power, (int,float)):
-            total_power += power
-        descriptions.append(call(device, "describe_device"))
-    return [total_power, descriptions]
+        if condition is not None and not condition(device):
+            continue
+        key = key_of(device) if key_of is not None else None
+        result = groups.get(key)
+        if result is None:
+            result = groups[key] = {"power": 0, "count": 0, "descriptions": [], "devices": []}
+        if want_power:
+            power = call(device, "get_power_consumption")
+            if isinstance(power, (int,float)):
+                result["power"] += power
+        if want_count:
+            result["count"] += 1
+        if want_descriptions:
+            result["descriptions"].append(call(device, "describe_device"))
+        if want_devices:
+            result["devices"].append(device)
+    groups = {key: {output: result[output] for output in outputs} for key, result in groups.items()}
+    if key_of is None:
+        return groups.get(None, {output: [] if output in ("descriptions", "devices") else 0 for output in outputs})
+    return groups
+
+def query(obj, where = None, condition = None, group_by = None, outputs = ("power",)):
+    # where: select_devices() criteria (type, room, ip, status), answered by the indexes; condition: any predicate on top
+    # group_by: None, a field ("room", "type", "ip", "status" or any device field), a tuple of fields, or a key function
+    devices = select_devices(obj, **where) if where else _devices(obj)
+    return _aggregate(devices, condition, group_by, outputs)
+
+def filter_helper(obj,condition = None,devices = None): # devices narrows the scan to index candidates
+    devices = _devices(obj) if devices is None else devices
+    result = _aggregate(devices, condition, outputs = ("power", "descriptions"))
+    return [result["power"], result["descriptions"]]
 
 def search_type(obj, type):
-    return filter_helper(obj, lambda x: x["_classname"] == type)
+    return filter_helper(obj, devices = select_devices(obj, type = type))
 
-def search_room(obj, room):
-    return filter_helper(obj, lambda x: x["location"] == room)
+def search_room(obj, room, subtree = False): # subtree: room is a location tree node, everything below it counts too
+    return filter_helper(obj, devices = select_devices(obj, within = room) if subtree else select_devices(obj, room = room))
 
-def calculate_total_power_consumption(obj, search_type = None, search_room = None):
+def calculate_total_power_consumption(obj, search_type = None, search_room = None, subtree = False):
+    totals = _power_totals(obj)
+    room_group, room_type_group = ("node", "node_type") if subtree else ("room", "room_type")
     if search_type is not None and search_room is not None:
-        return filter_helper(obj, lambda x: x["_classname"] == search_type and x["location"] == search_room)[0]
+        total = totals[room_type_group].get((search_room, search_type), 0)
     elif search_type is not None:
-        return filter_helper(obj, lambda x: x["_classname"] == search_type)[0]
+        total = totals["type"].get(search_type, 0)
     elif search_room is not None:
-        return filter_helper(obj, lambda x: x["location"] == search_room)[0]
+        total = totals[room_group].get(search_room, 0)
     else:
-        return filter_helper(obj, lambda x: True)[0]
+        total = totals["all"]
+    if obj.get("_check_totals") and obj.get("_batch") is None: # inside a batch the totals are behind the devices until it ends
+        check_power_totals(obj)
+    return total
     
 
-def get_all_device_descriptions(obj, search_type = None, search_room = None):
-    if search_type is not None and search_room is not None:
-        return filter_helper(obj, lambda x: x["_classname"] == search_type and x["location"] == search_room)[1]
-    elif search_type is not None:
-        return filter_helper(obj, lambda x: x["_classname"] == search_type)[1]
-    elif search_room is not None:
-        return filter_helper(obj, lambda x: x["location"] == search_room)[1]
-    else:
-        return filter_helper(obj, lambda x: True)[1]
+def get_all_device_descriptions(obj, search_type = None, search_room = None, subtree = False):
+    where = {"type": search_type, "within" if subtree else "room": search_room}
+    return query(obj, where, outputs = ("descriptions",))["descriptions"]
+
+def location_rollup(obj, node = None, depth = None):
+    # the location tree below node (the whole house if None) from the running totals: {"power", "count", "children":
+    # {child node: {...}}}, depth levels deep (None for all). Only walks the nodes, never the devices
+    totals = _power_totals(obj)
+    counts = totals["count"]["node"]
+    children = {}
+    for path, count in counts.items():
+        if count <= 0 or not isinstance(path, str):
+            continue
+        parent = path.rpartition(LOCATION_SEPARATOR)[0] if LOCATION_SEPARATOR in path else None
+        children.setdefault(parent, []).append(path)
+    def rollup(path, level):
+        if path is None:
+            result = {"power": totals["all"], "count": totals["all_count"]}
+        else:
+            result = {"power": totals["node"].get(path, 0), "count": counts.get(path, 0)}
+        if depth is None or level < depth:
+            result["children"] = {child: rollup(child, level + 1) for child in sorted(children.get(path, ()))}
+        return result
+    return rollup(node, 0)
     
 
 def get_all_connected_devices(obj, ip = None):
-    if ip is not None:
-        return filter_helper(obj,lambda x: ("connected" in x and x["connected"] is True and x["ip"] == ip and x["status"] == "on"))
+    return filter_helper(obj, lambda x: x.get("connected") is True, select_devices(obj, ip = ip, status = "on"))
+
+# dispatch instrumentation: while enabled, call() counts every invocation per (classname, method), times one call in
+# sample_every into a latency histogram of power-of-two nanosecond buckets (inclusive of nested calls), and resolve()
+# records how deep find() had to walk on each cache miss. While disabled call() pays one global None check
+_instrumentation = None
+
+def enable_instrumentation(obj = None, sample_every = 1): # obj: so it can be call()ed on a management too
+    global _instrumentation
+    _instrumentation = {"sample_every": sample_every, "calls": 0, "counts": {}, "histograms": {},
+                        "find_misses": 0, "not_found": 0, "find_depths": {}, "started": time.perf_counter()}
+
+def disable_instrumentation(obj = None):
+    global _instrumentation
+    _instrumentation = None
+
+def _instrumented_call(obj, method_name, args, kwargs):
+    stats = _instrumentation
+    key = (obj.get("_classname"), method_name)
+    stats["counts"][key] = stats["counts"].get(key, 0) + 1
+    stats["calls"] += 1
+    if "_class" in obj:
+        if "_view" in obj:
+            obj.update(row_view(obj["_management"], obj["_id"]))
+        method = resolve(obj["_class"], method_name)
     else:
-        return filter_helper(obj,lambda x: ("connected" in x and x["connected"] is True and x["status"] == "on"))
+        method = obj.get(method_name)
+    if method is None:
+        raise NotImplementedError(f"Method {method_name} not implemented!")
+    if stats["calls"] % stats["sample_every"]:
+        return method(obj, *args, **kwargs)
+    start = time.perf_counter_ns()
+    try:
+        return method(obj, *args, **kwargs)
+    finally:
+        histogram = stats["histograms"].get(key)
+        if histogram is None:
+            histogram = stats["histograms"][key] = [0] * 64
+        histogram[min((time.perf_counter_ns() - start).bit_length(), 63)] += 1
+
+def _record_find(cls, method_name, method):
+    _instrumentation["find_misses"] += 1
+    if method is None:
+        _instrumentation["not_found"] += 1
+        return
+    depth = next(depth for depth, ancestor in enumerate(linearize(cls)) if method_name in ancestor) # 0: cls itself
+    _instrumentation["find_depths"][depth] = _instrumentation["find_depths"].get(depth, 0) + 1
+
+def dispatch_stats(obj = None):
+    # snapshot of the instrumentation: per "Class.method" the count and, from the sampled calls, approximate latency
+    # percentiles (upper bounds of their buckets) and the histogram itself. None while disabled
+    stats = _instrumentation
+    if stats is None:
+        return None
+    methods = {}
+    for (classname, method_name), count in sorted(stats["counts"].items(), key = lambda item: -item[1]):
+        histogram = stats["histograms"].get((classname, method_name), [0] * 64)
+        sampled = sum(histogram)
+        entry = {"count": count, "sampled": sampled, "histogram_ns": {1 << bucket: n for bucket, n in enumerate(histogram) if n}}
+        for name, share in [("p50_ns", 0.5), ("p90_ns", 0.9), ("p99_ns", 0.99)]:
+            entry[name] = _histogram_percentile(histogram, sampled, share)
+        methods[f"{classname}.{method_name}"] = entry
+    return {"calls": stats["calls"], "sample_every": stats["sample_every"], "seconds": time.perf_counter() - stats["started"],
+            "methods": methods, "find": {"misses": stats["find_misses"], "not_found": stats["not_found"], "depths": dict(sorted(stats["find_depths"].items()))}}
+
+def _histogram_percentile(histogram, total, share):
+    if not total:
+        return None
+    seen = 0
+    for bucket, count in enumerate(histogram):
+        seen += count
+        if seen >= share * total:
+            return 1 << bucket
 
 SmartHouseManagement = {
     "_classname": "SmartHouseManagement",
@@ -177,12 +1095,54 @@ SmartHouseManagement = {
     "search_room": search_room,
     "calculate_total_power_consumption": calculate_total_power_consumption,
     "get_all_device_descriptions": get_all_device_descriptions,
-    "get_all_connected_devices": get_all_connected_devices
+    "get_all_connected_devices": get_all_connected_devices,
+    "location_rollup": location_rollup,
+    "select_devices": select_devices,
+    "check_power_totals": check_power_totals,
+    "enable_columns": enable_columns,
+    "power_breakdown": power_breakdown,
+    "row_view": row_view,
+    "query": query,
+    "add_observer": add_observer,
+    "remove_observer": remove_observer,
+    "set_status_many": set_status_many,
+    "connect_many": connect_many,
+    "disconnect_many": disconnect_many,
+    "set_target_temperature_many": set_target_temperature_many,
+    "relocate_many": relocate_many,
+    "remove_device": remove_device,
+    "remove_many": remove_many,
+    "description_cache_stats": description_cache_stats,
+    "dispatch_stats": dispatch_stats,
+    "enable_instrumentation": enable_instrumentation,
+    "disable_instrumentation": disable_instrumentation,
+    "stream_devices": stream_devices,
+    "stream_search_type": stream_search_type,
+    "stream_search_room": stream_search_room,
+    "stream_device_descriptions": stream_device_descriptions,
+    "stream_connected_devices": stream_connected_devices
 }
 
+def make_management(classname = "SmartHouseManagement", check_totals = False, compact = False, thread_safe = False): # a fresh, empty management with the same methods as SmartHouseManagement
+    management = {key: value for key, value in SmartHouseManagement.items() if callable(value)}
+    management.update({"_classname": classname, "_parent": None, "devices": [], "_check_totals": check_totals})
+    if thread_safe: # see _writing() and consistent_read()
+        management.update({"_lock": threading.RLock(), "_version": 0, "_writers": 0})
+        for name in READ_METHODS:
+            management[name] = _consistent(management[name])
+    if compact: # devices only live as rows in the columnar store, make() hands out row views
+        del management["devices"]
+        management["_compact"] = True
+        enable_columns(management)
+    return management
+
 def call(obj,method_name,*args, **kwargs): #i had to add **kwargs because calculate_total_consumption needs it
+    if _instrumentation is not None: # off unless enable_instrumentation() was called, then see _instrumented_call()
+        return _instrumented_call(obj, method_name, args, kwargs)
     if "_class" in obj: #i had to make the change here to make the SmartHouseManagement work as it does not have "_class", if you see a better way, pls correct
-        method = find(obj["_class"],method_name)
+        if "_view" in obj: # a compact row view, the row may have changed since it was built
+            obj.update(row_view(obj["_management"], obj["_id"]))
+        method = resolve(obj["_class"],method_name)
     else: 
         method = obj.get(method_name)
 
@@ -205,33 +1165,174 @@ def find(cls, method_name):
         return find(parents, method_name)
     return None # so it enters the next for iteration
 
+# method resolution cache: find() walks the whole _parent chain on every call, so call() goes through resolve(),
+# which remembers the result per (class, method_name). Class dicts are plain dicts and can't tell us when they
+# change, so mutate them through set_class_attribute() (or call invalidate_method_cache() after editing one by hand)
+_mro_cache = {} # id(cls) -> linearized class list, cls first, in the order find() visits them
+_method_cache = {} # id(cls) -> {method_name: whatever find() returned}
+_class_generation = 0 # bumped on every invalidation, so state derived from class methods (e.g. power totals) knows it's stale
+
+def linearize(cls):
+    mro = _mro_cache.get(id(cls))
+    if mro is None or mro[0] is not cls:
+        mro = []
+        _linearize_into(cls, mro)
+        _mro_cache[id(cls)] = mro # mro[0] is cls, so the cache keeps cls alive and its id can't be reused
+        _method_cache[id(cls)] = {}
+    return mro
+
+def _linearize_into(cls, mro):
+    if cls is None or any(seen is cls for seen in mro):
+        return
+    mro.append(cls)
+    parents = cls.get("_parent")
+    for parent in (parents if isinstance(parents, list) else [parents]):
+        _linearize_into(parent, mro)
+
+def resolve(cls, method_name):
+    methods = _method_cache.get(id(cls))
+    if methods is None:
+        if cls is None:
+            return None
+        linearize(cls)
+        methods = _method_cache[id(cls)]
+    try:
+        return methods[method_name]
+    except KeyError:
+        method = methods[method_name] = find(cls, method_name) # same semantics as the uncached walk, just done once
+        if _instrumentation is not None:
+            _record_find(cls, method_name, method)
+        return method
+
+def invalidate_method_cache(cls = None):
+    global _class_generation
+    _class_generation += 1
+    if cls is None:
+        _mro_cache.clear()
+        _method_cache.clear()
+        return
+    for key, mro in list(_mro_cache.items()): # drop cls itself and every class that inherits from it
+        if any(ancestor is cls for ancestor in mro):
+            del _mro_cache[key]
+            del _method_cache[key]
+
+def set_class_attribute(cls, name, value):
+    cls[name] = value
+    invalidate_method_cache(cls)
+
+
 def make(cls,name,location,base_power,status,*args,management = SmartHouseManagement):
+    # until there is something to keep in sync with a new device (the lock, indexes and totals, which appear with the
+    # first query that needs them, columns, observers, positions after a removal) it only has to be appended
+    if not ("_index" in management or "_totals" in management or "_observers" in management or "_columns" in management
+            or "_lock" in management or "_positions" in management):
+        obj = _new_device(cls, name, location, base_power, status, args, management)
+        management["devices"].append(obj) #every Device gets immediately added to the SmartHouseManagement system at its creation
+        return obj
+    with _writing(management):
+        obj = _new_device(cls, name, location, base_power, status, args, management)
+        if not management.get("_compact"): # in compact mode only the row is kept, obj is a view of it
+            _append_devices(management, [obj]) #every Device gets immediately added to the SmartHouseManagement system at its creation
+        _track(management, obj, obj)
+        _notify(management, "make", obj)
+
+    return obj
+
+def _new_device(cls, name, location, base_power, status, args, management):
     obj = {
         "_class":cls,
         "_classname": cls["_classname"],
         "name":name,
         "location":location,
         "base_power":base_power,
-        "status":status
+        "status":status,
+        "_management":management,
+        "_id":management.get("_next_id", 0) # creation order, used by the indexes
     }
-    if cls["_classname"] == "Light":
-        obj["brightness"] = args[0]
-    
-    elif cls["_classname"] == "Thermostat":
-        obj["room_temperature"] = args[0]
-        obj["target_temperature"] = args[1]
-        obj["connected"] = False
-        obj["ip"] = None
-
-    elif cls["_classname"] == "Camera":
-        obj["resolution_factor"] = args[0]
-        obj["connected"] = False
-        obj["ip"] = None
-    
-    management["devices"].append(obj) #every Device gets immediately added to the SmartHouseManagement system at its creation
+    management["_next_id"] = obj["_id"] + 1
+    device_type = DEVICE_TYPES.get(cls["_classname"])
+    if device_type is not None:
+        fields = device_type["fields"]
+        if len(args) < len(fields):
+            raise TypeError(f"{cls['_classname']} needs {', '.join(fields)}")
+        for field, value in zip(fields, args):
+            obj[field] = value
+        if device_type["defaults"]:
+            obj.update(device_type["defaults"])
 
+    if management.get("_compact"):
+        obj["_view"] = True
     return obj
 
+# the built-in device types
+def _resolution_label(obj):
+    if obj.get("resolution_factor") < 5: return "low"
+    elif obj.get("resolution_factor") < 10: return "medium"
+    else: return "high"
+
+register_device_type(Light, ("brightness",),
+    power = lambda base_power, brightness: round(base_power * brightness / 100),
+    vectorized = lambda columns: numpy.round(columns["base_power"] * columns["brightness"] / 100),
+    description = "The {name} {classname} is located in {location}, is currently {status}, and is currently set to {brightness}% brightness")
+register_device_type(Thermostat, ("room_temperature", "target_temperature"), {"connected": False, "ip": None},
+    power = lambda base_power, room_temperature, target_temperature: base_power * abs(target_temperature - room_temperature),
+    vectorized = lambda columns: columns["base_power"] * numpy.abs(columns["target_temperature"] - columns["room_temperature"]),
+    description = "The {name} {classname} is located in {location}, is currently set to {target_temperature} degree Celsius in a {room_temperature} degree room. {connection}")
+register_device_type(Camera, ("resolution_factor",), {"connected": False, "ip": None},
+    power = lambda base_power, resolution_factor: base_power * resolution_factor,
+    description = "The {name} {classname} is located in {location}, is currently {status}, and has a {resolution} resolution sensor. {connection}",
+    extras = {"resolution": _resolution_label})
+
+# bulk provisioning: devices are built in batches and the indexes, totals and columns are updated once per batch.
+# Rows are matched to classes and fields through DEVICE_CLASSES and CONSTRUCTOR_FIELDS, see register_device_type()
+
+def make_many(cls, rows, management = SmartHouseManagement, batch_size = 10000):
+    # rows: (name, location, base_power, status, *args) like make(), or dicts with those keys and the constructor fields
+    fields = CONSTRUCTOR_FIELDS.get(cls["_classname"], ())
+    rows = iter(rows)
+    devices = []
+    while True:
+        rows_batch = [[row["name"], row["location"], row["base_power"], row["status"], *(row[field] for field in fields)] if isinstance(row, dict) else row
+                      for row in itertools.islice(rows, batch_size)]
+        if not rows_batch:
+            return devices
+        with _writing(management):
+            batch = [_new_device(cls, row[0], row[1], row[2], row[3], row[4:], management) for row in rows_batch]
+            if not management.get("_compact"):
+                _append_devices(management, batch)
+            _track_batch(management, batch)
+        devices.extend(batch)
+
+def _parse_number(text):
+    try:
+        return int(text)
+    except ValueError:
+        return float(text)
+
+def load_devices(source, format = "jsonl", cls = None, management = SmartHouseManagement, batch_size = 10000):
+    # source: an open file or any iterable of lines, one device per CSV row (with a header) or JSON line.
+    # The class comes from cls or from each record's "type" field. Returns the number of devices created
+    if format == "csv":
+        records = csv.DictReader(source)
+    elif format == "jsonl":
+        records = (json.loads(line) for line in source if line.strip())
+    else:
+        raise ValueError(f"Unknown device file format {format}")
+    count = 0
+    records = iter(records)
+    while True:
+        by_class = {}
+        for record in itertools.islice(records, batch_size):
+            record_cls = cls if cls is not None else DEVICE_CLASSES[record["type"]]
+            if format == "csv": # CSV only has strings
+                for field in ("base_power", *CONSTRUCTOR_FIELDS.get(record_cls["_classname"], ())):
+                    record[field] = _parse_number(record[field])
+            by_class.setdefault(record_cls["_classname"], (record_cls, []))[1].append(record)
+        if not by_class:
+            return count
+        for record_cls, batch in by_class.values():
+            count += len(make_many(record_cls, batch, management, batch_size))
+
 '''lamp1 = make(Light, "ZEST Smart Lamp", "living room", 300, "off", 70)
 call(lamp1, "toggle_status")
 print(call(lamp1, "get_power_consumption"))
@@ -0,0 +1,143 @@
+from smart_house import *
+from smart_house import POWER_FIELDS, _power_totals, _power_value
+
+# threshold alerting: rules on a group's total power (the house, a room, a type or a room's devices of one type, read
+# from the running power totals) or on each device's own power (one device, or every device of a room or type, e.g.
+# thermostat demand). Rules are indexed by the group or device they watch, and an observer of the management
+# re-evaluates only the rules of the groups and the device whose power just changed. Alerts are edge triggered: a rule
+# (per device for device rules) fires when its value crosses the threshold and resolves when it crosses back
+def make_alert_engine(management, on_alert = None):
+    engine = {
+        "_classname": "AlertEngine",
+        "_parent": None,
+        "management": management,
+        "on_alert": on_alert, # called with every alert dict, None keeps them in alerts
+        "alerts": [],
+        "rules": {}, # rule id -> rule
+        "group_rules": {}, # ("all", None) / ("room", room) / ("type", type) / ("room_type", (room, type)) -> {rule ids}
+        "device_rules": {}, # ("device", id) / ("room", room) / ("type", type) / ("all", None) -> {rule ids}
+        "firing": set(), # rule ids, or (rule id, device id) for device rules
+        "rooms": {}, # device id -> room as last evaluated, moving a device changes the totals of both rooms
+        "deferred": {}, # device id -> device, changed inside a batch, evaluated at its end
+        "_next_rule": 0,
+        "add_rule": add_rule,
+        "remove_rule": remove_rule,
+        "close": close_alert_engine,
+    }
+    for device in select_devices(management):
+        engine["rooms"][device["_id"]] = device["location"]
+    engine["observer"] = lambda management, event, device, changes: _on_change(engine, event, device, changes)
+    add_observer(management, engine["observer"])
+    return engine
+
+def add_rule(obj, threshold, room = None, type = None, device = None, per_device = False, below = False, name = None):
+    # a group rule on the total of room and/or type (the house if neither), or with per_device (or device) a rule on
+    # the power of every matching device. Fires above the threshold, or below it with below = True
+    rule_id = obj["_next_rule"]
+    obj["_next_rule"] += 1
+    if device is not None or per_device:
+        scope = ("device", device["_id"]) if device is not None else ("room", room) if room is not None else ("type", type) if type is not None else ("all", None)
+        rules = obj["device_rules"]
+    else:
+        scope = ("room_type", (room, type)) if room is not None and type is not None else ("room", room) if room is not None else ("type", type) if type is not None else ("all", None)
+        rules = obj["group_rules"]
+    rule = {"id": rule_id, "name": name or f"rule {rule_id}", "scope": scope, "threshold": threshold, "below": below,
+            "per_device": rules is obj["device_rules"], "type": type}
+    obj["rules"][rule_id] = rule
+    rules.setdefault(scope, set()).add(rule_id)
+    if rule["per_device"]: # evaluated against the devices that match it now
+        where = {"room": room, "type": type} if scope[0] != "device" else {}
+        for matching in ([device] if device is not None else select_devices(obj["management"], **where)):
+            _evaluate(obj, rule, _power_value(matching), matching)
+    else:
+        _evaluate(obj, rule, _group_total(obj, scope))
+    return rule_id
+
+def remove_rule(obj, rule_id):
+    rule = obj["rules"].pop(rule_id)
+    rules = obj["device_rules"] if rule["per_device"] else obj["group_rules"]
+    rules[rule["scope"]].discard(rule_id)
+    if not rules[rule["scope"]]:
+        del rules[rule["scope"]]
+    obj["firing"] = {key for key in obj["firing"] if key != rule_id and not (isinstance(key, tuple) and key[0] == rule_id)}
+
+def _group_total(obj, scope):
+    totals = _power_totals(obj["management"])
+    kind, key = scope
+    return totals["all"] if kind == "all" else totals[kind].get(key, 0)
+
+def _evaluate(obj, rule, value, device = None):
+    key = rule["id"] if device is None else (rule["id"], device["_id"])
+    breached = value < rule["threshold"] if rule["below"] else value > rule["threshold"]
+    if breached == (key in obj["firing"]):
+        return
+    if breached:
+        obj["firing"].add(key)
+    else:
+        obj["firing"].discard(key)
+    alert = {"rule": rule["name"], "state": "firing" if breached else "resolved", "value": value, "threshold": rule["threshold"],
+             "device": None if device is None else device["name"]}
+    if obj["on_alert"] is None:
+        obj["alerts"].append(alert)
+    else:
+        obj["on_alert"](alert)
+
+def _on_change(obj, event, device, changes):
+    if event == "batch": # the totals only caught up now
+        deferred, obj["deferred"] = obj["deferred"], {}
+        for changed in deferred.values():
+            if changed.get("_management") is None: # removed inside the batch
+                _forget_device(obj, changed)
+            else:
+                _evaluate_device(obj, changed)
+        return
+    if event == "remove":
+        if obj["management"].get("_batch") is not None:
+            obj["deferred"][device["_id"]] = device
+        else:
+            _forget_device(obj, device)
+        return
+    if changes is not None and not any(field in POWER_FIELDS for field in changes):
+        return
+    if obj["management"].get("_batch") is not None:
+        obj["deferred"][device["_id"]] = device
+        return
+    _evaluate_device(obj, device)
+
+def _evaluate_device(obj, device):
+    room, type = device["location"], device["_classname"]
+    rooms = {room, obj["rooms"].get(device["_id"], room)}
+    obj["rooms"][device["_id"]] = room
+    _evaluate_groups(obj, rooms, type)
+    device_rules = obj["device_rules"]
+    if device_rules:
+        rule_ids = set()
+        for scope in [("device", device["_id"]), ("room", room), ("type", type), ("all", None)]:
+            rule_ids.update(device_rules.get(scope, ()))
+        power = _power_value(device) if rule_ids else None
+        for rule_id in rule_ids:
+            rule = obj["rules"][rule_id]
+            if rule["scope"][0] == "room" and rule["type"] is not None and rule["type"] != type:
+                continue
+            _evaluate(obj, rule, power, device)
+
+def _evaluate_groups(obj, rooms, type):
+    group_rules = obj["group_rules"]
+    if group_rules:
+        scopes = [("all", None), ("type", type)]
+        for changed_room in rooms:
+            scopes += [("room", changed_room), ("room_type", (changed_room, type))]
+        for scope in scopes:
+            for rule_id in group_rules.get(scope, ()):
+                _evaluate(obj, obj["rules"][rule_id], _group_total(obj, scope))
+
+def _forget_device(obj, device): # a removed device: its groups lost its power, its own alerts go away without resolving
+    room = obj["rooms"].pop(device["_id"], device["location"])
+    _evaluate_groups(obj, {room, device["location"]}, device["_classname"])
+    obj["firing"] = {key for key in obj["firing"] if not (isinstance(key, tuple) and key[1] == device["_id"])}
+    scope = ("device", device["_id"])
+    for rule_id in obj["device_rules"].pop(scope, ()):
+        del obj["rules"][rule_id]
+
+def close_alert_engine(obj):
+    remove_observer(obj["management"], obj["observer"])
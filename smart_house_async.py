@@ -0,0 +1,103 @@
+from smart_house import *
+import asyncio
+
+# asyncio facade for device I/O: connect() and disconnect() only flip flags, the network side lives in a transport,
+# a dict of coroutine functions connect(device, ip), disconnect(device) and poll(device) -> "on"/"off".
+# Every transport call gets its own timeout and at most `concurrency` of them run at once. The management only
+# changes once the transport call succeeded, through the same methods call() would use. The bulk functions return
+# one result dict per selected device (in selection order) instead of raising, so one dead camera doesn't stop a site
+def make_async_management(management, transport = None, concurrency = 100, timeout = 5.0):
+    return {
+        "_classname": "AsyncSmartHouseManagement",
+        "_parent": None,
+        "management": management,
+        "transport": make_fake_transport() if transport is None else transport,
+        "concurrency": concurrency,
+        "timeout": timeout, # seconds per transport call
+        "connect_many": async_connect_many,
+        "disconnect_many": async_disconnect_many,
+        "poll_status": async_poll_status,
+    }
+
+def make_fake_transport(latency = 0.0, failures = (), hangs = ()):
+    # in-process transport for tests: devices named in failures raise ConnectionError, the ones named in hangs never
+    # answer. poll() reports remote_status[device id] if set, otherwise what the device already has
+    transport = {"latency": latency, "failures": set(failures), "hangs": set(hangs), "remote_status": {},
+                 "calls": 0, "in_flight": 0, "max_in_flight": 0}
+
+    async def request(device):
+        transport["calls"] += 1
+        transport["in_flight"] += 1
+        transport["max_in_flight"] = max(transport["max_in_flight"], transport["in_flight"])
+        try:
+            if device["name"] in transport["hangs"]:
+                await asyncio.Event().wait()
+            await asyncio.sleep(transport["latency"])
+            if device["name"] in transport["failures"]:
+                raise ConnectionError(f"{device['name']} did not answer the handshake")
+        finally:
+            transport["in_flight"] -= 1
+
+    async def connect(device, ip):
+        await request(device)
+
+    async def disconnect(device):
+        await request(device)
+
+    async def poll(device):
+        await request(device)
+        return transport["remote_status"].get(device["_id"], device["status"])
+
+    transport.update({"connect": connect, "disconnect": disconnect, "poll": poll})
+    return transport
+
+async def _run_many(obj, devices, request, apply, concurrency, timeout):
+    semaphore = asyncio.Semaphore(obj["concurrency"] if concurrency is None else concurrency)
+    timeout = obj["timeout"] if timeout is None else timeout
+
+    async def run(device):
+        result = {"name": device["name"], "_id": device["_id"], "ok": False, "value": None, "error": None}
+        try:
+            async with semaphore:
+                result["value"] = await asyncio.wait_for(request(device), timeout)
+            apply(device, result["value"])
+        except Exception as error: # a failed or timed out request, or an update that raised: reported per device, the others carry on
+            result["error"] = error
+            return result
+        result["ok"] = True
+        return result
+
+    return await asyncio.gather(*(run(device) for device in devices))
+
+async def async_connect_many(obj, ip, where = None, concurrency = None, timeout = None):
+    # ip is one address for every device or a function device -> address, called once per device. value is the address
+    address = ip if callable(ip) else (lambda device: ip)
+    devices = [device for device in select_devices(obj["management"], **(where or {}))
+               if resolve(device["_class"], "connect") is not None]
+
+    async def request(device): # the device is connected to the address its handshake went to
+        device_ip = address(device)
+        await obj["transport"]["connect"](device, device_ip)
+        return device_ip
+
+    return await _run_many(obj, devices, request,
+                           lambda device, device_ip: call(device, "connect", device_ip),
+                           concurrency, timeout)
+
+async def async_disconnect_many(obj, where = None, concurrency = None, timeout = None):
+    devices = [device for device in select_devices(obj["management"], **(where or {}))
+               if resolve(device["_class"], "disconnect") is not None and device["connected"]]
+    return await _run_many(obj, devices,
+                           lambda device: obj["transport"]["disconnect"](device),
+                           lambda device, value: call(device, "disconnect"),
+                           concurrency, timeout)
+
+async def async_poll_status(obj, where = None, concurrency = None, timeout = None):
+    # asks every selected device for its status and toggles the ones whose status drifted, value is the polled status
+    def apply(device, status):
+        if status != device["status"]:
+            call(device, "toggle_status")
+
+    return await _run_many(obj, select_devices(obj["management"], **(where or {})),
+                           lambda device: obj["transport"]["poll"](device),
+                           apply, concurrency, timeout)
@@ -0,0 +1,146 @@
+from smart_house import *
+from smart_house import _append_devices, _devices, _track, _update_device
+from smart_house_snapshot import _check_registered, save_snapshot, restore_snapshot
+import json
+import os
+import threading
+
+# write-ahead event log: an observer turns every make/update/remove of a management into one JSON line. Lines are
+# buffered and group-committed: one write + fsync per group_size events, or max_delay seconds after the first
+# uncommitted event at the latest (a timer thread commits it), so that is how long an event can stay unwritten. A checkpoint writes a snapshot and starts
+# an empty log, and recover() rebuilds a management from the last checkpoint plus the log written after it.
+# Events carry absolute values, so replaying an event that the checkpoint already contains changes nothing.
+# Replay finds a device's class by its name, so like snapshots the log only takes registered classes: opening it over
+# a device of an ad-hoc class, or make()ing one while it's open, raises a ValueError instead of writing a log that
+# recover() couldn't get through
+CHECKPOINT_FILE = "checkpoint.snapshot"
+LOG_FILE = "events.log"
+
+def open_event_log(management, directory, group_size = 1000, checkpoint_every = None, max_delay = 0.05):
+    for device in _devices(management):
+        _check_registered(device)
+    os.makedirs(directory, exist_ok = True)
+    log = {
+        "_classname": "EventLog",
+        "_parent": None,
+        "management": management,
+        "directory": directory,
+        "file": open(os.path.join(directory, LOG_FILE), "a", encoding = "utf-8"),
+        "pending": [],
+        "group_size": group_size,
+        "checkpoint_every": checkpoint_every, # events between automatic checkpoints, None for manual ones only
+        "max_delay": max_delay, # seconds, None to only commit full groups and on flush_event_log()
+        "timer": None,
+        "lock": threading.RLock(), # the timer thread commits too
+        "since_checkpoint": 0,
+        "commits": 0,
+        "flush": flush_event_log,
+        "checkpoint": checkpoint,
+        "close": close_event_log
+    }
+    log["observer"] = lambda management, event, device, changes: _record(log, event, device, changes)
+    add_observer(management, log["observer"])
+    return log
+
+def _record(log, event, device, changes):
+    if event == "batch": # its updates are already logged
+        return
+    if event == "make":
+        _check_registered(device) # the device is already made, but it never reaches the log
+        fields = {key: value for key, value in device.items() if key not in ("_class", "_management", "_view")}
+        line = json.dumps(["m", fields], separators = (",", ":"))
+    elif event == "remove":
+        line = json.dumps(["r", device["_id"]], separators = (",", ":"))
+    else:
+        line = json.dumps(["u", device["_id"], changes], separators = (",", ":"))
+    with log["lock"]:
+        log["pending"].append(line + "\n")
+        log["since_checkpoint"] += 1
+        if len(log["pending"]) >= log["group_size"]:
+            flush_event_log(log)
+            if log["checkpoint_every"] is not None and log["since_checkpoint"] >= log["checkpoint_every"]:
+                checkpoint(log)
+        elif log["timer"] is None and log["max_delay"] is not None:
+            log["timer"] = threading.Timer(log["max_delay"], _commit_due, (log,))
+            log["timer"].daemon = True
+            log["timer"].start()
+
+def _commit_due(log):
+    with log["lock"]:
+        if not log["file"].closed:
+            flush_event_log(log)
+
+def flush_event_log(obj): # group commit: everything pending in one write and one fsync
+    with obj["lock"]:
+        if obj["timer"] is not None:
+            obj["timer"].cancel()
+            obj["timer"] = None
+        if not obj["pending"]:
+            return
+        obj["file"].write("".join(obj["pending"]))
+        obj["file"].flush()
+        os.fsync(obj["file"].fileno())
+        obj["pending"].clear()
+        obj["commits"] += 1
+
+def checkpoint(obj):
+    with obj["lock"]: # the timer can't commit into the log that is about to be replaced
+        flush_event_log(obj)
+        path = os.path.join(obj["directory"], CHECKPOINT_FILE)
+        save_snapshot(obj["management"], path + ".tmp")
+        with open(path + ".tmp", "rb") as file:
+            os.fsync(file.fileno())
+        os.replace(path + ".tmp", path) # a crash before this keeps the old checkpoint and the full log
+        obj["file"].close()
+        obj["file"] = open(os.path.join(obj["directory"], LOG_FILE), "w", encoding = "utf-8") # a crash before this replays events twice, which is harmless
+        obj["since_checkpoint"] = 0
+
+def close_event_log(obj):
+    remove_observer(obj["management"], obj["observer"])
+    with obj["lock"]:
+        flush_event_log(obj)
+        obj["file"].close()
+
+def recover(directory, management = None):
+    path = os.path.join(directory, CHECKPOINT_FILE)
+    if os.path.exists(path):
+        management = restore_snapshot(path, management)
+    elif management is None:
+        management = make_management()
+    compact = management.get("_compact")
+    devices = {} if compact else {device["_id"]: device for device in _devices(management)}
+    log_path = os.path.join(directory, LOG_FILE)
+    if not os.path.exists(log_path):
+        return management
+    with open(log_path, encoding = "utf-8") as file, batch_updates(management):
+        for line in file:
+            try:
+                event = json.loads(line)
+            except ValueError: # a torn last line from a crash in the middle of a commit
+                break
+            if event[0] == "m":
+                fields = event[1]
+                if fields["_id"] in devices or (compact and fields["_id"] < management.get("_next_id", 0)):
+                    continue
+                device = _replay_make(management, fields)
+                if not compact:
+                    devices[device["_id"]] = device
+            elif event[0] == "r":
+                device = devices.pop(event[1], None)
+                if device is not None:
+                    remove_device(management, device)
+            else:
+                device = row_view(management, event[1]) if compact else devices.get(event[1])
+                if device is not None:
+                    _update_device(device, **event[2])
+    return management
+
+def _replay_make(management, fields):
+    device = {"_class": DEVICE_CLASSES[fields["_classname"]], **fields, "_management": management}
+    management["_next_id"] = max(management.get("_next_id", 0), device["_id"] + 1)
+    if management.get("_compact"):
+        device["_view"] = True
+    else:
+        _append_devices(management, [device])
+    _track(management, device, device)
+    return device
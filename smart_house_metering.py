@@ -0,0 +1,125 @@
+from smart_house import *
+from smart_house import _column_power, _group_power
+from array import array
+import math
+import time
+
+# energy metering: sample() reads every device's power from the columnar store once per tick. The raw samples go to a
+# fixed-size ring per device (capacity float32 slots per row, all rows in one array, one shared cursor), and the energy
+# of the tick (power * tick) is added to per (room, type) rollups at 1 minute, 1 hour and 1 day granularity. Each
+# granularity keeps a fixed number of buckets, so energy() answers "kWh in the bedroom over the last 24h" from at most
+# a few dozen buckets instead of the raw samples. Removing a device moves the last row into its row, the meter moves
+# that row's ring along (see _on_remove())
+ROLLUPS = {60: 1440, 3600: 24 * 31, 86400: 366} # bucket size in seconds -> buckets kept (a day of minutes, a month of hours, a year of days)
+
+def make_meter(management, tick = 10.0, capacity = 360, clock = time.time):
+    enable_columns(management)
+    meter = {
+        "_classname": "EnergyMeter",
+        "_parent": None,
+        "management": management,
+        "tick": tick, # seconds between samples, each sample stands for tick seconds of energy
+        "capacity": capacity, # raw samples kept per device
+        "clock": clock,
+        "samples": array("f"),
+        "rows": 0,
+        "first": array("Q"), # per row, the number of the sample its device was first in
+        "cursor": 0,
+        "taken": 0,
+        "rollups": {size: {} for size in ROLLUPS}, # size -> bucket start -> room -> type -> Wh
+        "sample": sample,
+        "energy": energy,
+        "device_samples": device_samples,
+        "close": close_meter,
+    }
+    meter["observer"] = lambda management, event, device, changes: _on_remove(meter, changes["row"]) if event == "remove" else None
+    add_observer(management, meter["observer"])
+    return meter
+
+def sample(obj, now = None):
+    now = obj["clock"]() if now is None else now
+    columns = obj["management"]["_columns"]
+    power = _column_power(obj["management"])
+    capacity = obj["capacity"]
+    if len(power) > obj["rows"]: # devices made since the last sample start with an empty ring
+        obj["samples"].extend(array("f", bytes(4 * capacity * (len(power) - obj["rows"]))))
+        obj["first"].extend([obj["taken"]] * (len(power) - obj["rows"]))
+        obj["rows"] = len(power)
+    if len(power):
+        obj["samples"][obj["cursor"]::capacity] = array("f", power)
+    obj["cursor"] = (obj["cursor"] + 1) % capacity
+    obj["taken"] += 1
+
+    watt_hours = obj["tick"] / 3600
+    energy_by_group = {key: value * watt_hours for key, value in _group_power(columns, power, "room_type").items()}
+    for size, kept in ROLLUPS.items():
+        buckets = obj["rollups"][size]
+        start = math.floor(now / size) * size
+        bucket = buckets.get(start)
+        if bucket is None:
+            bucket = buckets[start] = {}
+            while len(buckets) > kept: # starts only grow, so the first one is the oldest
+                del buckets[next(iter(buckets))]
+        for (room, type), value in energy_by_group.items():
+            by_type = bucket.get(room)
+            if by_type is None:
+                by_type = bucket[room] = {}
+            by_type[type] = by_type.get(type, 0.0) + value
+
+def energy(obj, start, end = None, room = None, type = None):
+    # kWh between start and end (seconds, same clock as sample()), the coarsest buckets that fit, finer ones at the edges.
+    # Edges older than the finer rollups keep (e.g. the partial hour at the start of last week) count as nothing
+    end = obj["clock"]() if end is None else end
+    sizes = sorted(ROLLUPS, reverse = True)
+    return _energy(obj, start, end, sizes, room, type) / 1000
+
+def _energy(obj, start, end, sizes, room, type):
+    if start >= end or not sizes:
+        return 0.0
+    size = sizes[0]
+    if len(sizes) == 1: # the finest buckets are taken whole when they start inside the range
+        first, last = math.floor(start / size) * size, end
+    else:
+        first, last = math.ceil(start / size) * size, math.floor(end / size) * size
+        if first >= last:
+            return _energy(obj, start, end, sizes[1:], room, type)
+    total = 0.0
+    buckets = obj["rollups"][size]
+    for bucket_start in range(int(first), int(math.ceil(last / size) * size), size): # only the buckets in range are looked at
+        bucket = buckets.get(bucket_start)
+        if bucket is None:
+            continue
+        for by_type in (bucket.values() if room is None else [bucket.get(room, {})]):
+            total += sum(by_type.values()) if type is None else by_type.get(type, 0.0)
+    if len(sizes) == 1:
+        return total
+    return total + _energy(obj, start, first, sizes[1:], room, type) + _energy(obj, last, end, sizes[1:], room, type)
+
+def _on_remove(obj, row):
+    if row is None:
+        return
+    capacity, last = obj["capacity"], len(obj["management"]["_columns"]["type"]) # the row that moved into row
+    if last < obj["rows"]: # it has a ring, which moves along and the last ring goes
+        if row != last:
+            obj["samples"][row * capacity:(row + 1) * capacity] = obj["samples"][last * capacity:(last + 1) * capacity]
+            obj["first"][row] = obj["first"][last]
+        del obj["samples"][last * capacity:]
+        del obj["first"][last:]
+        obj["rows"] = last
+    elif row < obj["rows"]: # it was made since the last sample, so its ring starts empty
+        obj["samples"][row * capacity:(row + 1) * capacity] = array("f", bytes(4 * capacity))
+        obj["first"][row] = obj["taken"]
+
+def device_samples(obj, device): # the device's raw power samples, oldest first
+    rows = obj["management"]["_columns"]["rows"]
+    row = device["_id"] if rows is None else rows[device["_id"]]
+    if row >= obj["rows"]:
+        return []
+    capacity = obj["capacity"]
+    ring = obj["samples"][row * capacity:(row + 1) * capacity]
+    count = min(obj["taken"] - obj["first"][row], capacity) # none from before the device was made
+    ordered = ring[obj["cursor"]:] + ring[:obj["cursor"]] if obj["taken"] >= capacity else ring[:obj["cursor"]]
+    return list(ordered[len(ordered) - count:])
+
+def close_meter(obj):
+    remove_observer(obj["management"], obj["observer"])
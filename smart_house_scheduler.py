@@ -0,0 +1,107 @@
+from smart_house import *
+import heapq
+import math
+import time
+
+# automation scheduler: timed actions ("toggle_status on this lamp at 22:00", "set_target_temperature 18 on the
+# bedroom thermostats every night") sit in one heap of (due tick, action id, method, args, target, every) tuples, so
+# scheduling is O(log n) and a million pending actions cost one tuple each. Cancelling only records the id (O(1)), the
+# entry is dropped when it comes up. Due times are rounded up to the tick, and every action due at the same tick runs
+# in one batch_updates() block, grouped per method, arguments and room/type, so the indexes and totals are updated
+# once per touched device. The clock is injectable, tests drive run_due() with their own times
+def make_scheduler(management, tick = 1.0, clock = time.time):
+    return {
+        "_classname": "Scheduler",
+        "_parent": None,
+        "management": management,
+        "tick": tick,
+        "clock": clock,
+        "heap": [],
+        "live": set(), # ids of the actions still to run
+        "cancelled": set(), # cancelled ids whose heap entries are still there
+        "errors": [], # (action id, exception) of actions that raised, the others in the tick still run
+        "_next_action": 0,
+        "schedule": schedule,
+        "cancel": cancel,
+        "run_due": run_due,
+        "pending_count": pending_count,
+    }
+
+def schedule(obj, at, method, *args, device = None, room = None, type = None, every = None):
+    # calls method(*args) at time at on one device, or on every device of room and/or type (or the whole house) as
+    # they are when it fires. every repeats it that many seconds later. Returns the action id for cancel()
+    action = obj["_next_action"]
+    obj["_next_action"] += 1
+    target = device if device is not None else (room, type)
+    obj["live"].add(action)
+    heapq.heappush(obj["heap"], (math.ceil(at / obj["tick"]) * obj["tick"], action, method, args, target, every))
+    return action
+
+def cancel(obj, action): # False if it already ran (or was cancelled)
+    if action not in obj["live"]:
+        return False
+    obj["live"].discard(action)
+    obj["cancelled"].add(action)
+    if len(obj["cancelled"]) > 1000 and len(obj["cancelled"]) * 2 > len(obj["heap"]): # mostly dead entries, rebuild
+        obj["heap"] = [entry for entry in obj["heap"] if entry[1] not in obj["cancelled"]]
+        heapq.heapify(obj["heap"])
+        obj["cancelled"].clear()
+    return True
+
+def pending_count(obj):
+    return len(obj["live"])
+
+def run_due(obj, now = None): # runs everything due up to now, a tick at a time. Returns the number of device calls
+    now = obj["clock"]() if now is None else now
+    heap, cancelled = obj["heap"], obj["cancelled"]
+    calls = 0
+    while heap and heap[0][0] <= now:
+        due = heap[0][0]
+        groups = {} # (method, args, room, type) -> [(action, device or None for a selector)]
+        while heap and heap[0][0] == due:
+            entry = heapq.heappop(heap)
+            due, action, method, args, target, every = entry
+            if action in cancelled:
+                cancelled.discard(action)
+                continue
+            if isinstance(target, dict) and target.get("_management") is None: # the device was removed, so is the action
+                obj["live"].discard(action)
+                continue
+            if every is None:
+                obj["live"].discard(action)
+            else: # same id, so cancel() stops the whole series
+                heapq.heappush(heap, (due + math.ceil(every / obj["tick"]) * obj["tick"], action, method, args, target, every))
+            room, type = (target["location"], target["_classname"]) if isinstance(target, dict) else target
+            try:
+                hash(args)
+                key = (method, args, room, type)
+            except TypeError: # e.g. a list argument, the action gets a group of its own
+                key = (method, ("unhashable", action), room, type)
+            groups.setdefault(key, (args, []))[1].append((action, target if isinstance(target, dict) else None))
+        calls += _run_tick(obj, groups)
+    return calls
+
+def _run_tick(obj, groups):
+    management = obj["management"]
+    calls = 0
+    with batch_updates(management):
+        for (method, _, room, type), (args, actions) in groups.items():
+            for action, device in actions:
+                devices = [device] if device is not None else select_devices(management, room = room, type = type)
+                try:
+                    for target in devices:
+                        call(target, method, *args)
+                        calls += 1
+                except Exception as error:
+                    obj["errors"].append((action, error))
+    return calls
+
+def run_scheduler(obj, until = None, sleep = time.sleep):
+    # runs actions as they come due until the clock passes until (or nothing is left)
+    while obj["heap"] and (until is None or obj["clock"]() < until):
+        wait = obj["heap"][0][0] - obj["clock"]()
+        if until is not None:
+            wait = min(wait, until - obj["clock"]())
+        if wait > 0:
+            sleep(wait)
+        run_due(obj)
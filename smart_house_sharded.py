@@ -0,0 +1,158 @@
+from smart_house import *
+import heapq
+import multiprocessing
+
+# sharded management: devices live in worker processes, one plain management per shard, and every room belongs to
+# exactly one shard (new rooms go to the shard with the fewest devices). Devices are sent as pickled batches of rows,
+# queries are sent to every shard at once (or only to the room's shard when the query names a room) and the
+# partial sums, counts and description lists are merged here. Every device gets a global sequence number, so merged
+# descriptions come back in creation order like they do from a single management
+def make_sharded_management(shards = None, classname = "ShardedSmartHouseManagement"):
+    shards = shards or multiprocessing.cpu_count()
+    workers = []
+    for _ in range(shards):
+        connection, worker_connection = multiprocessing.Pipe()
+        process = multiprocessing.Process(target = _shard_worker, args = (worker_connection,), daemon = True)
+        process.start()
+        worker_connection.close()
+        workers.append({"process": process, "connection": connection, "devices": 0})
+    return {
+        "_classname": classname,
+        "_parent": None,
+        "workers": workers,
+        "rooms": {}, # location -> shard number
+        "_next_id": 0,
+        "make_many": sharded_make_many,
+        "search_type": sharded_search_type,
+        "search_room": sharded_search_room,
+        "calculate_total_power_consumption": sharded_total_power_consumption,
+        "get_all_device_descriptions": sharded_device_descriptions,
+        "get_all_connected_devices": sharded_connected_devices,
+        "set_status_many": lambda obj, status, where = None: _fan_out_count(obj, "set_status_many", where, status),
+        "connect_many": lambda obj, ip, where = None: _fan_out_count(obj, "connect_many", where, ip),
+        "disconnect_many": lambda obj, where = None: _fan_out_count(obj, "disconnect_many", where),
+        "set_target_temperature_many": lambda obj, temperature, where = None: _fan_out_count(obj, "set_target_temperature_many", where, temperature),
+        "close": close_sharded_management,
+    }
+
+def _shard_worker(connection):
+    management = make_management()
+    sequence = [] # global sequence number of each local device id
+    while True:
+        message = connection.recv()
+        if message is None:
+            break
+        name, args, kwargs = message
+        try:
+            if name == "make_many":
+                classname, rows, numbers = args
+                count, next_id = len(management["devices"]), management.get("_next_id", 0)
+                try:
+                    make_many(DEVICE_CLASSES[classname], rows, management)
+                except Exception: # all or nothing, the caller takes these rows back out of its routing
+                    for device in reversed(management["devices"][count:]):
+                        remove_device(management, device)
+                    management["_next_id"] = next_id # sequence is indexed by local ids
+                    raise
+                sequence.extend(numbers)
+                result = len(rows)
+            elif name == "describe":
+                result = _shard_describe(management, sequence, *args, **kwargs)
+            else:
+                result = call(management, name, *args, **kwargs)
+        except Exception as error: # sent back and raised by the caller
+            connection.send(("error", error))
+        else:
+            connection.send(("ok", result))
+    connection.close()
+
+def _shard_describe(management, sequence, where, connected_only = False):
+    # power and (sequence number, description) pairs of the selected devices, in creation order
+    power, descriptions = 0, []
+    for device in select_devices(management, **where):
+        if connected_only and device.get("connected") is not True:
+            continue
+        value = call(device, "get_power_consumption")
+        if isinstance(value, (int,float)):
+            power += value
+        descriptions.append((sequence[device["_id"]], call(device, "describe_device")))
+    return power, descriptions
+
+def _shards_for(obj, room): # all shards, only the room's one, or none for a room nobody has
+    if room is None:
+        return range(len(obj["workers"]))
+    shard = obj["rooms"].get(room)
+    return [] if shard is None else [shard]
+
+def _ask(obj, shards, name, *args, **kwargs): # sends to every shard first so they work in parallel, then collects
+    shards = list(shards)
+    for shard in shards:
+        obj["workers"][shard]["connection"].send((name, args, kwargs))
+    return _ask_results(obj, shards)
+
+def _ask_results(obj, shards, received = None): # received: shard -> reply, for replies already read
+    results = [obj["workers"][shard]["connection"].recv() if received is None else received[shard] for shard in shards]
+    for status, result in results:
+        if status == "error":
+            raise result
+    return [result for _, result in results]
+
+def _merge_descriptions(parts):
+    return [description for _, description in heapq.merge(*parts)]
+
+def sharded_make_many(obj, cls, rows):
+    # rows like make_many()'s, routed by location. Returns the number of devices created. A shard that fails creates
+    # none of its rows and they leave the routing again (rooms it was just given, its device count), then the error
+    # is raised here; the rows of the other shards are created, like make_many() keeps the batches before a bad row
+    batches = {}
+    new_rooms = []
+    for row in rows:
+        location = row["location"] if isinstance(row, dict) else row[1]
+        shard = obj["rooms"].get(location)
+        if shard is None:
+            shard = obj["rooms"][location] = min(range(len(obj["workers"])), key = lambda shard: obj["workers"][shard]["devices"])
+            new_rooms.append(location)
+        batch = batches.setdefault(shard, ([], []))
+        batch[0].append(row)
+        batch[1].append(obj["_next_id"]) # the numbers of failed rows are never used, the order of the others stays the same
+        obj["_next_id"] += 1
+        obj["workers"][shard]["devices"] += 1
+    for shard, (batch_rows, numbers) in batches.items():
+        obj["workers"][shard]["connection"].send(("make_many", (cls["_classname"], batch_rows, numbers), {}))
+    results = {shard: obj["workers"][shard]["connection"].recv() for shard in batches}
+    failed = {shard for shard, (status, _) in results.items() if status == "error"}
+    for shard in failed:
+        obj["workers"][shard]["devices"] -= len(batches[shard][0])
+    for location in new_rooms:
+        if obj["rooms"][location] in failed:
+            del obj["rooms"][location]
+    return sum(_ask_results(obj, batches, results))
+
+def _describe(obj, where, connected_only = False):
+    parts = _ask(obj, _shards_for(obj, where.get("room")), "describe", where, connected_only = connected_only)
+    return [sum(power for power, _ in parts), _merge_descriptions([descriptions for _, descriptions in parts])]
+
+def sharded_search_type(obj, type):
+    return _describe(obj, {"type": type})
+
+def sharded_search_room(obj, room):
+    return _describe(obj, {"room": room})
+
+def sharded_total_power_consumption(obj, search_type = None, search_room = None):
+    return sum(_ask(obj, _shards_for(obj, search_room), "calculate_total_power_consumption", search_type = search_type, search_room = search_room))
+
+def sharded_device_descriptions(obj, search_type = None, search_room = None):
+    return _describe(obj, {"type": search_type, "room": search_room})[1]
+
+def sharded_connected_devices(obj, ip = None):
+    return _describe(obj, {"ip": ip, "status": "on"}, connected_only = True)
+
+def _fan_out_count(obj, name, where, *args):
+    return sum(_ask(obj, _shards_for(obj, (where or {}).get("room")), name, *args, where = where))
+
+def close_sharded_management(obj):
+    for worker in obj["workers"]:
+        worker["connection"].send(None)
+    for worker in obj["workers"]:
+        worker["process"].join()
+        worker["connection"].close()
@@ -0,0 +1,232 @@
+from smart_house import *
+from smart_house import _column_formulas, _devices, _track_batch, numpy
+import itertools
+import json
+import mmap
+import os
+import struct
+
+# snapshot file: a header, one fixed-width record per device and five string tables (types, rooms, ips, names, and
+# the fields of registered types that have no column, as JSON, "" for most devices). Records only hold numbers and
+# string table indexes, so a mapped snapshot can answer power queries by reading the records in place, long before
+# restore_snapshot() has rebuilt the device dicts
+MAGIC = b"SHSNAP\x00\x02"
+HEADER = struct.Struct("<8sIQ5Q") # magic, record size, device count, offsets of the types, rooms, ips, names and fields tables
+RECORD = struct.Struct("<q5dIIIHBBB") # id, COLUMN_FIELDS, name, room, ip, type, status, connected, float mask
+NO_IP = 0xFFFFFFFF
+NOT_CONNECTABLE = 2
+TABLES = ("types", "rooms", "ips", "names", "fields")
+_STORED_KEYS = {"_class", "_classname", "name", "location", "base_power", "status", "_management", "_id", "_view", "connected", "ip", *COLUMN_FIELDS}
+
+def _intern(table, codes, value):
+    code = codes.get(value)
+    if code is None:
+        code = codes[value] = len(table)
+        table.append(value)
+    return code
+
+def _write_table(file, strings):
+    blobs = [string.encode("utf-8") for string in strings]
+    offsets = [0]
+    for blob in blobs:
+        offsets.append(offsets[-1] + len(blob))
+    file.write(struct.pack(f"<Q{len(offsets)}Q", len(strings), *offsets))
+    file.write(b"".join(blobs))
+
+def _check_registered(device): # a stored device gets its class back by name, so it must be the registered one
+    if DEVICE_CLASSES.get(device["_classname"]) is not device["_class"]:
+        raise ValueError(f"{device['_classname']} is not a registered device type, see register_device_type()")
+
+def save_snapshot(management, path):
+    try:
+        return _save_snapshot(management, path)
+    except BaseException:
+        os.remove(path) # a half written snapshot would only fail later, in open_snapshot()
+        raise
+
+def _save_snapshot(management, path):
+    tables = {name: [] for name in TABLES}
+    codes = {name: {} for name in TABLES}
+    other_fields = {} # classname -> fields outside the records
+    with open(path, "wb") as file:
+        file.write(b"\0" * HEADER.size) # filled in once the table offsets are known
+        count = 0
+        for device in _devices(management):
+            _check_registered(device)
+            numbers = [device.get(field) for field in COLUMN_FIELDS]
+            float_mask = sum(1 << bit for bit, value in enumerate(numbers) if isinstance(value, float))
+            numbers = [float(value) if isinstance(value, (int,float)) else 0.0 for value in numbers]
+            if "connected" in device:
+                connected = 1 if device["connected"] else 0
+                ip = NO_IP if device["ip"] is None else _intern(tables["ips"], codes["ips"], device["ip"])
+            else:
+                connected, ip = NOT_CONNECTABLE, NO_IP
+            file.write(RECORD.pack(
+                device["_id"], *numbers,
+                len(tables["names"]), # names are rarely shared, so they aren't interned
+                _intern(tables["rooms"], codes["rooms"], device["location"]),
+                ip,
+                _intern(tables["types"], codes["types"], device["_classname"]),
+                1 if device["status"] == "on" else 0,
+                connected,
+                float_mask))
+            tables["names"].append(device["name"])
+            other = other_fields.get(device["_classname"]) # like compact rows, a type's first device decides its fields
+            if other is None:
+                other = other_fields[device["_classname"]] = tuple(key for key in device if key not in _STORED_KEYS)
+            tables["fields"].append(json.dumps({key: device.get(key) for key in other}, separators = (",", ":")) if other else "") # same position as the name
+            count += 1
+        offsets = []
+        for name in TABLES:
+            offsets.append(file.tell())
+            _write_table(file, tables[name])
+        file.seek(0)
+        file.write(HEADER.pack(MAGIC, RECORD.size, count, *offsets))
+    return count
+
+def _read_table(buffer, offset, decode = True):
+    count = struct.unpack_from("<Q", buffer, offset)[0]
+    offsets = struct.unpack_from(f"<{count + 1}Q", buffer, offset + 8)
+    start = offset + 8 * (count + 2)
+    if not decode: # names: only kept as (start, offsets) and decoded one at a time
+        return (start, offsets)
+    return [bytes(buffer[start + offsets[i]:start + offsets[i + 1]]).decode("utf-8") for i in range(count)]
+
+def open_snapshot(path):
+    with open(path, "rb") as file:
+        buffer = mmap.mmap(file.fileno(), 0, access = mmap.ACCESS_READ)
+    magic, record_size, count, *offsets = HEADER.unpack_from(buffer, 0)
+    if magic != MAGIC or record_size != RECORD.size:
+        buffer.close()
+        raise ValueError(f"{path} is not a smart house snapshot")
+    types, rooms, ips = (_read_table(buffer, offset) for offset in offsets[:3])
+    return {
+        "_classname": "SmartHouseSnapshot",
+        "_parent": None,
+        "buffer": buffer,
+        "count": count,
+        "types": types,
+        "rooms": rooms,
+        "ips": ips,
+        "names": _read_table(buffer, offsets[3], decode = False),
+        "fields": _read_table(buffer, offsets[4], decode = False),
+        "calculate_total_power_consumption": snapshot_total_power_consumption,
+        "get_all_device_descriptions": snapshot_device_descriptions,
+        "snapshot_device": snapshot_device,
+    }
+
+def close_snapshot(snapshot):
+    snapshot["buffer"].close()
+
+def _records(snapshot): # record tuples straight from the mapped file
+    view = memoryview(snapshot["buffer"])[HEADER.size:HEADER.size + snapshot["count"] * RECORD.size]
+    try:
+        yield from RECORD.iter_unpack(view)
+    finally:
+        view.release()
+
+def _name(snapshot, index, table = "names"):
+    start, offsets = snapshot[table]
+    return snapshot["buffer"][start + offsets[index]:start + offsets[index + 1]].decode("utf-8")
+
+def _record_device(snapshot, record, management = None): # the device dict of one record, same layout as make()'s
+    device_id, base_power, name, room, ip, type, status, connected, float_mask = record[0], record[1], *record[6:]
+    classname = snapshot["types"][type]
+    device = {
+        "_class": DEVICE_CLASSES[classname],
+        "_classname": classname,
+        "name": _name(snapshot, name),
+        "location": snapshot["rooms"][room],
+        "base_power": base_power if float_mask & 1 else int(base_power),
+        "status": "on" if status else "off",
+        "_management": management,
+        "_id": device_id
+    }
+    for field in CONSTRUCTOR_FIELDS.get(classname, ()):
+        if field in COLUMN_FIELDS:
+            bit = COLUMN_FIELDS.index(field)
+            device[field] = record[1 + bit] if float_mask >> bit & 1 else int(record[1 + bit])
+    other = _name(snapshot, name, "fields")
+    if other:
+        device.update(json.loads(other))
+    if connected != NOT_CONNECTABLE:
+        device["connected"] = connected == 1
+        device["ip"] = None if ip == NO_IP else snapshot["ips"][ip]
+    return device
+
+def snapshot_device(snapshot, index):
+    return _record_device(snapshot, RECORD.unpack_from(snapshot["buffer"], HEADER.size + index * RECORD.size))
+
+def _matches(snapshot, search_type, search_room): # (type code, room code) to compare with, None means any, False means nothing matches
+    type = None if search_type is None else (snapshot["types"].index(search_type) if search_type in snapshot["types"] else False)
+    room = None if search_room is None else (snapshot["rooms"].index(search_room) if search_room in snapshot["rooms"] else False)
+    return type, room
+
+def snapshot_total_power_consumption(obj, search_type = None, search_room = None):
+    type, room = _matches(obj, search_type, search_room)
+    if type is False or room is False or not obj["count"]:
+        return 0
+    formulas = {code: _column_formulas.get(name) for code, name in enumerate(obj["types"])}
+    if numpy is not None and all(formulas.values()):
+        dtype = numpy.dtype([("id", "<i8"), *((field, "<f8") for field in COLUMN_FIELDS), ("name", "<u4"), ("room", "<u4"),
+                             ("ip", "<u4"), ("type", "<u2"), ("status", "u1"), ("connected", "u1"), ("float_mask", "u1")])
+        records = numpy.frombuffer(obj["buffer"], dtype = dtype, count = obj["count"], offset = HEADER.size)
+        mask = records["status"] == 1
+        if type is not None:
+            mask &= records["type"] == type
+        if room is not None:
+            mask &= records["room"] == room
+        total = 0.0
+        for code, (vectorized, _) in formulas.items():
+            selected = records[mask & (records["type"] == code)]
+            total += float(vectorized({field: selected[field] for field in COLUMN_FIELDS}).sum())
+        del records, selected, mask # the mapping can't be closed while numpy still looks at it
+        return total
+    total = 0
+    for record in _records(obj):
+        device_type, status, device_room = record[9], record[10], record[7]
+        if not status or (type is not None and device_type != type) or (room is not None and device_room != room):
+            continue
+        formula = formulas[device_type]
+        if formula is not None:
+            total += formula[1](*record[1:6])
+        else: # no column formula, ask the class
+            power = call(_record_device(obj, record), "get_power_consumption")
+            total += power if isinstance(power, (int,float)) else 0
+    return total
+
+def snapshot_device_descriptions(obj, search_type = None, search_room = None):
+    type, room = _matches(obj, search_type, search_room)
+    if type is False or room is False:
+        return []
+    return [call(_record_device(obj, record), "describe_device") for record in _records(obj)
+            if (type is None or record[9] == type) and (room is None or record[7] == room)]
+
+def restore_snapshot(snapshot, management = None, batch_size = 10000):
+    # builds the device dicts of a snapshot (a path or an open_snapshot() result) into management, keeping their ids
+    opened = not isinstance(snapshot, dict)
+    if opened:
+        snapshot = open_snapshot(snapshot)
+    management = make_management() if management is None else management
+    compact = management.get("_compact")
+    records = _records(snapshot)
+    try:
+        while True:
+            batch = [_record_device(snapshot, record, management) for record in itertools.islice(records, batch_size)]
+            if not batch:
+                break
+            if compact: # compact ids are row numbers, so they are handed out again
+                for device in batch:
+                    device["_id"] = management["_next_id"] = management.get("_next_id", 0)
+                    management["_next_id"] += 1
+                    device["_view"] = True
+            else:
+                management["_next_id"] = max(management.get("_next_id", 0), max(device["_id"] for device in batch) + 1)
+            if not compact:
+                management["devices"].extend(batch)
+            _track_batch(management, batch)
+    finally:
+        records.close() # releases the memoryview so the mapping can be closed
+        if opened:
+            close_snapshot(snapshot)
+    return management
@@ -0,0 +1,128 @@
+from smart_house import *
+import time
+
+# subscription bus: an observer of the management routes every make/update to the subscriptions on that device, its
+# room, its type or its IP (or on everything), and keeps one pending entry per (subscription, device) with the latest
+# value of every changed field. Pending changes are delivered together, as one callback(notifications) per subscription,
+# when interval seconds passed since the first of them, when max_pending piled up, or on flush_subscriptions(). The
+# interval is only checked when a change arrives or poll_subscriptions() is called, so callers with quiet periods
+# call that from their loop or a timer. A callback that raises doesn't stop the others, its error lands in errors.
+# A notification is (device, changes), changes None for a device made since the last delivery and {"removed": True}
+# for one removed since
+SELECTORS = ("device", "room", "type", "ip")
+
+def make_bus(management, interval = 1.0, max_pending = 10000, clock = time.monotonic):
+    bus = {
+        "_classname": "SubscriptionBus",
+        "_parent": None,
+        "management": management,
+        "interval": interval,
+        "max_pending": max_pending,
+        "clock": clock,
+        "subscriptions": {}, # subscription id -> (callback, selector, key, fields)
+        "routes": {selector: {} for selector in SELECTORS}, # selector -> key -> {subscription ids}
+        "everything": set(),
+        "keys": {}, # device id -> {"room": ..., "ip": ...} as last routed, so moving away still reaches the old subscribers
+        "pending": {}, # subscription id -> {device id: (device, changes)}
+        "pending_count": 0,
+        "since": None,
+        "errors": [], # (subscription id, exception) of callbacks that raised
+        "_next_subscription": 0,
+        "subscribe": subscribe,
+        "unsubscribe": unsubscribe,
+        "flush": flush_subscriptions,
+        "poll": poll_subscriptions,
+        "close": close_bus,
+    }
+    for device in select_devices(management):
+        bus["keys"][device["_id"]] = {"room": device["location"], "ip": device.get("ip")}
+    bus["observer"] = lambda management, event, device, changes: _route(bus, event, device, changes)
+    add_observer(management, bus["observer"])
+    return bus
+
+def subscribe(obj, callback, device = None, room = None, type = None, ip = None, fields = None):
+    # at most one of device, room, type, ip; none subscribes to every device. fields limits it to changes of those fields
+    chosen = [(selector, value) for selector, value in zip(SELECTORS, (device, room, type, ip)) if value is not None]
+    if len(chosen) > 1:
+        raise ValueError(f"Subscribe to one of {', '.join(SELECTORS)}, not {len(chosen)}")
+    subscription = obj["_next_subscription"]
+    obj["_next_subscription"] += 1
+    selector, key = chosen[0] if chosen else (None, None)
+    if selector == "device":
+        key = key["_id"]
+    obj["subscriptions"][subscription] = (callback, selector, key, None if fields is None else frozenset(fields))
+    if selector is None:
+        obj["everything"].add(subscription)
+    else:
+        obj["routes"][selector].setdefault(key, set()).add(subscription)
+    return subscription
+
+def unsubscribe(obj, subscription):
+    callback, selector, key, fields = obj["subscriptions"].pop(subscription)
+    if selector is None:
+        obj["everything"].discard(subscription)
+    else:
+        subscribers = obj["routes"][selector][key]
+        subscribers.discard(subscription)
+        if not subscribers:
+            del obj["routes"][selector][key]
+    obj["pending_count"] -= len(obj["pending"].pop(subscription, {}))
+
+def _route(obj, event, device, changes):
+    if event == "batch": # its updates were routed one by one
+        return
+    routes = obj["routes"]
+    keys = obj["keys"].get(device["_id"])
+    current = {"room": device["location"], "ip": device.get("ip")}
+    if event == "remove":
+        changes = {"removed": True}
+    subscribers = set(obj["everything"])
+    subscribers.update(routes["device"].get(device["_id"], ()))
+    subscribers.update(routes["type"].get(device["_classname"], ()))
+    for selector in ("room", "ip"):
+        subscribers.update(routes[selector].get(current[selector], ()))
+        if keys is not None and keys[selector] != current[selector]: # moved away, the old room/IP hears about it too
+            subscribers.update(routes[selector].get(keys[selector], ()))
+    if event == "remove":
+        obj["keys"].pop(device["_id"], None)
+    else:
+        obj["keys"][device["_id"]] = current
+    for subscription in subscribers:
+        fields = obj["subscriptions"][subscription][3]
+        if fields is not None and changes is not None and event != "remove" and fields.isdisjoint(changes):
+            continue
+        pending = obj["pending"].setdefault(subscription, {})
+        entry = pending.get(device["_id"])
+        if entry is None:
+            obj["pending_count"] += 1
+            pending[device["_id"]] = (device, None if changes is None else dict(changes))
+        elif event == "remove": # whatever changed before, it's gone now
+            pending[device["_id"]] = (device, dict(changes))
+        elif entry[1] is not None: # coalesced: the latest value of every field changed since the last delivery
+            entry[1].update(changes or {})
+    if obj["pending_count"] and obj["since"] is None:
+        obj["since"] = obj["clock"]()
+    if obj["pending_count"] >= obj["max_pending"]:
+        flush_subscriptions(obj)
+    else:
+        poll_subscriptions(obj)
+
+def poll_subscriptions(obj, now = None): # delivers what's pending if the interval passed, returns the number of notifications
+    now = obj["clock"]() if now is None else now
+    if obj["since"] is None or now - obj["since"] < obj["interval"]:
+        return 0
+    return flush_subscriptions(obj)
+
+def flush_subscriptions(obj): # delivers everything pending, returns the number of notifications
+    pending, obj["pending"] = obj["pending"], {}
+    delivered, obj["pending_count"], obj["since"] = obj["pending_count"], 0, None
+    for subscription, notifications in pending.items():
+        try:
+            obj["subscriptions"][subscription][0](list(notifications.values()))
+        except Exception as error: # never raised: this runs inside the management's observers, after the change was applied
+            obj["errors"].append((subscription, error))
+    return delivered
+
+def close_bus(obj):
+    flush_subscriptions(obj)
+    remove_observer(obj["management"], obj["observer"])
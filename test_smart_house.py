@@ -1,6 +1,22 @@
 from smart_house import *
+import smart_house
+from smart_house_snapshot import save_snapshot, open_snapshot, close_snapshot, restore_snapshot
+from smart_house_async import make_async_management, make_fake_transport
+from smart_house_sharded import make_sharded_management, close_sharded_management
+from smart_house_metering import make_meter, sample, energy, device_samples
+from smart_house_subscriptions import make_bus, subscribe, unsubscribe, flush_subscriptions, poll_subscriptions, close_bus
+from smart_house_alerts import make_alert_engine, add_rule, remove_rule
+from smart_house_scheduler import make_scheduler, schedule, cancel, run_due, pending_count, run_scheduler
+from smart_house_eventlog import open_event_log, flush_event_log, checkpoint, close_event_log, recover
+import math
+import os
+import tempfile
+import asyncio
+import threading
+import concurrent.futures
 import time
 import sys
+import io
 
 def test_toggle_status():
     for name, obj in globals().items():
@@ -324,11 +340,992 @@ def test_make():
             raise AssertionError("Object of class Thermostat doesn't have the necessary temperature attributes")
         if obj.get('_classname') == "Camera" and "resolution_factor" not in obj:
             raise AssertionError("Object of class Camera doesn't have resolution_factor attribute")
+
+    management = make_management() # nothing to keep in sync yet, the indexes and totals are built from the devices later
+    lamps = [make(Light, f"Plain Lamp {i}", "Attic", 100, "on", 50, management=management) for i in range(3)]
+    if "_index" in management or "_totals" in management or [lamp["_id"] for lamp in lamps] != [0, 1, 2]:
+        raise AssertionError("make() on a plain management should only append numbered devices")
+    if call(management, "select_devices", room = "Attic") != lamps or call(management, "calculate_total_power_consumption") != 150:
+        raise AssertionError("Devices made before the indexes and totals should be in them")
+    if make(Light, "Indexed Lamp", "Attic", 100, "on", 50, management=management) not in call(management, "select_devices", room = "Attic"):
+        raise AssertionError("make() should keep existing indexes up to date")
       
 
+def test_method_cache():
+    for cls in [Light, Thermostat, Camera]:
+        for method_name in ["toggle_status", "describe_device", "connect", "wrong_method"]:
+            if resolve(cls, method_name) is not find(cls, method_name):
+                raise AssertionError(f"Cached lookup of {method_name} on {cls['_classname']} differs from find()")
+    if linearize(Thermostat) != [Thermostat, Device, Connectable]:
+        raise AssertionError("Thermostat should be linearized as Thermostat, Device, Connectable")
+
+    base = {"_classname": "Base", "_parent": None, "greet": lambda obj: "base"}
+    child = {"_classname": "Child", "_parent": [Device, base]}
+    obj = {"_class": child}
+    if call(obj, "greet") != "base":
+        raise AssertionError("Method inherited from the second parent was not found")
+    set_class_attribute(base, "greet", lambda obj: "changed")
+    if call(obj, "greet") != "changed":
+        raise AssertionError("Mutating an ancestor did not invalidate the cached method")
+    set_class_attribute(child, "greet", lambda obj: "child")
+    if call(obj, "greet") != "child":
+        raise AssertionError("Mutating the class itself did not invalidate the cached method")
+
+def test_select_devices():
+    management = make_management()
+    lamp = make(Light, "Index Lamp", "Kitchen", 100, "on", 50, management=management)
+    therm = make(Thermostat, "Index Thermostat", "Kitchen", 100, "off", 18, 21, management=management)
+    cam = make(Camera, "Index Camera", "Hall", 100, "on", 3, management=management)
+    call(management, "search_room", "Kitchen") # builds the indexes
+
+    call(therm, "toggle_status")
+    call(therm, "connect", "10.0.0.1")
+    call(cam, "connect", "10.0.0.1")
+    call(lamp, "toggle_status")
+    call(cam, "disconnect")
+
+    checks = [
+        ({"room": "Kitchen"}, lambda x: x["location"] == "Kitchen"),
+        ({"type": "Camera"}, lambda x: x["_classname"] == "Camera"),
+        ({"ip": "10.0.0.1"}, lambda x: x.get("ip") == "10.0.0.1"),
+        ({"status": "on"}, lambda x: x["status"] == "on"),
+        ({"room": "Kitchen", "status": "on"}, lambda x: x["location"] == "Kitchen" and x["status"] == "on"),
+    ]
+    for criteria, condition in checks:
+        expected = [device for device in management["devices"] if condition(device)]
+        if call(management, "select_devices", **criteria) != expected:
+            raise AssertionError(f"Index lookup for {criteria} does not match a full scan")
+    if call(management, "get_all_connected_devices", "10.0.0.1")[1] != [call(therm, "describe_device")]:
+        raise AssertionError("Only the connected thermostat should be returned for 10.0.0.1")
+
+def test_power_totals():
+    management = make_management(check_totals = True)
+    lamp = make(Light, "Totals Lamp", "Kitchen", 100, "on", 50, management=management)
+    therm = make(Thermostat, "Totals Thermostat", "Kitchen", 100, "off", 18, 21, management=management)
+    cam = make(Camera, "Totals Camera", "Hall", 100, "on", 3, management=management)
+    if call(management, "calculate_total_power_consumption") != 350:
+        raise AssertionError("Initial house total should be 350")
+
+    call(therm, "toggle_status")
+    call(therm, "set_target_temperature", 22.5)
+    call(therm, "set_room_temperature", 20)
+    call(lamp, "set_brightness", 80)
+    call(cam, "set_resolution_factor", 12)
+    call(cam, "toggle_status")
+    make(Light, "Totals Lamp 2", "Hall", 40, "on", 25, management=management)
+
+    expected = {
+        (None, None): 80 + 250 + 10,
+        ("Light", None): 90,
+        (None, "Kitchen"): 330,
+        ("Thermostat", "Kitchen"): 250,
+        ("Camera", "Hall"): 0,
+    }
+    for (type, room), value in expected.items():
+        total = call(management, "calculate_total_power_consumption", search_type = type, search_room = room)
+        if total != value:
+            raise AssertionError(f"Total for type {type} in room {room} should be {value}, got {total}")
+    check_power_totals(management)
+
+    drift = make_management()
+    cams = [make(Camera, f"Drift Camera {i}", "Attic", 1, "on", factor, management=drift) for i, factor in enumerate([0.1, 0.1])]
+    call(drift, "calculate_total_power_consumption")
+    call(cams[1], "set_resolution_factor", 0.2) # 0.1 + 0.1 - 0.1 + 0.2 - 0.2 - 0.1 - 0.1 leaves 2.8e-17 in floats
+    call(cams[1], "set_resolution_factor", 0.1)
+    for cam_device in cams:
+        call(drift, "remove_device", cam_device)
+    if call(drift, "calculate_total_power_consumption") != 0 or call(drift, "calculate_total_power_consumption", search_room = "Attic") != 0:
+        raise AssertionError("Emptied groups should be exactly 0, not float residue")
+    lamp = make(Light, "Wandering Lamp", "Room 0", 100, "on", 50, management=drift)
+    for i in range(1, 50):
+        call(lamp, "relocate", f"Room {i}")
+    totals = drift["_totals"]
+    if set(totals["room"]) | set(totals["count"]["room"]) != {"Room 49"} or set(totals["type"]) != {"Light"} or len(totals["node_type"]) != 1:
+        raise AssertionError("Groups whose last device left should be dropped from the totals")
+
+    set_class_attribute(Camera, "get_power_consumption", lambda obj: 1)
+    try:
+        if call(management, "calculate_total_power_consumption", search_type = "Camera") != 1:
+            raise AssertionError("Totals were not rebuilt after the power method changed")
+    finally:
+        set_class_attribute(Camera, "get_power_consumption", get_power_consumption)
+
+def test_power_breakdown():
+    management = make_management()
+    lamp = make(Light, "Column Lamp", "Kitchen", 100, "on", 55, management=management)
+    make(Thermostat, "Column Thermostat", "Kitchen", 100, "on", 18, 21.5, management=management)
+    call(management, "enable_columns")
+    cam = make(Camera, "Column Camera", "Hall", 100, "off", 3, management=management)
+    heater = {"_classname": "Heater", "_parent": Device, "get_power_consumption": lambda obj: 7 if obj["status"] == "on" else 0}
+    make(heater, "Column Heater", "Hall", 7, "on", management=management)
+    call(cam, "toggle_status")
+    call(lamp, "set_brightness", 25)
+
+    if call(management, "power_breakdown") != call(management, "calculate_total_power_consumption"):
+        raise AssertionError("Columnar house total differs from the running total")
+    expected = {
+        "room": {room: call(management, "calculate_total_power_consumption", search_room = room) for room in ["Kitchen", "Hall"]},
+        "type": {type: call(management, "calculate_total_power_consumption", search_type = type) for type in ["Light", "Thermostat", "Camera", "Heater"]},
+        "room_type": {(device["location"], device["_classname"]): call(management, "calculate_total_power_consumption", search_type = device["_classname"], search_room = device["location"]) for device in management["devices"]},
+    }
+    for group_by in expected:
+        actual = call(management, "power_breakdown", group_by)
+        if actual != expected[group_by]:
+            raise AssertionError(f"Columnar breakdown by {group_by} is {actual}, expected {expected[group_by]}")
+
+def test_power_breakdown_numpy():
+    # the same breakdown through the NumPy columns and through the plain arrays, whichever is installed
+    try:
+        import numpy
+    except ImportError:
+        numpy = None
+    Dimmer = {"_parent": Device, "_classname": "Dimmer"}
+    register_device_type(Dimmer, ("brightness",), power = lambda base_power, brightness: round(base_power * brightness / 300)) # round() can't take arrays
+    try:
+        management = make_management()
+        make(Light, "Numpy Lamp", "Kitchen", 75, "on", 33, management=management)
+        make(Thermostat, "Numpy Thermostat", "Kitchen", 100, "on", 22, 19.5, management=management)
+        make(Camera, "Numpy Camera", "Hall", 100, "on", 3, management=management)
+        make(Light, "Off Lamp", "Hall", 100, "off", 80, management=management)
+        make(Dimmer, "Numpy Dimmer", "Hall", 100, "on", 50, management=management)
+        expected = {room: call(management, "calculate_total_power_consumption", search_room = room) for room in ["Kitchen", "Hall"]}
+        for module in [numpy, None]:
+            smart_house.numpy = module
+            actual = call(management, "power_breakdown", "room")
+            if actual != expected:
+                raise AssertionError(f"Breakdown {'with' if module else 'without'} NumPy is {actual}, expected {expected}")
+    finally:
+        smart_house.numpy = numpy
+        unregister_device_type("Dimmer")
+
+def test_compact_management():
+    managements = [make_management(), make_management(compact = True)]
+    for management in managements:
+        lamp = make(Light, "Compact Lamp", "Kitchen", 100, "on", 55, management=management)
+        therm = make(Thermostat, "Compact Thermostat", "Kitchen", 100, "off", 18, 21.5, management=management)
+        cam = make(Camera, "Compact Camera", "Hall", 120, "on", 7, management=management)
+        call(therm, "toggle_status")
+        call(therm, "connect", "10.0.0.2")
+        call(cam, "connect", "10.0.0.2")
+        call(lamp, "set_brightness", 30)
+        if call(cam, "is_connected") is not True or find(cam["_class"], "connect") is not connect:
+            raise AssertionError("A compact device should dispatch like a dict device")
+
+    dict_management, compact_management = managements
+    if "devices" in compact_management:
+        raise AssertionError("A compact management should not keep device dicts")
+    queries = [
+        ("search_type", ["Thermostat"], {}),
+        ("search_room", ["Kitchen"], {}),
+        ("calculate_total_power_consumption", [], {"search_room": "Kitchen"}),
+        ("get_all_device_descriptions", [], {}),
+        ("get_all_connected_devices", ["10.0.0.2"], {}),
+        ("power_breakdown", ["room_type"], {}),
+    ]
+    for method_name, args, kwargs in queries:
+        expected = call(dict_management, method_name, *args, **kwargs)
+        actual = call(compact_management, method_name, *args, **kwargs)
+        if actual != expected:
+            raise AssertionError(f"{method_name} on the compact management returned {actual}, expected {expected}")
+
+    first = row_view(compact_management, 0)
+    second = row_view(compact_management, 0)
+    call(first, "toggle_status")
+    if call(second, "get_power_consumption") != "No power is consumed, Compact Lamp is off!":
+        raise AssertionError("A compact row view should see changes made through another view")
+
+def test_query():
+    management = make_management()
+    make(Light, "Query Lamp", "Kitchen", 100, "on", 50, management=management)
+    make(Light, "Query Lamp 2", "Hall", 60, "off", 50, management=management)
+    make(Camera, "Query Camera", "Kitchen", 100, "on", 3, management=management)
+    broken = {"_classname": "Broken", "_parent": Device, "get_power_consumption": lambda obj: 5}
+    make(broken, "Query Broken", "Hall", 5, "on", management=management) # has no describe_device
+
+    if call(management, "query", outputs = ["power", "count"]) != {"power": 355, "count": 4}:
+        raise AssertionError("Power and count over all devices should not need any description")
+    by_room = call(management, "query", where = {"type": "Light"}, group_by = "room", outputs = ["count", "descriptions"])
+    lights = management["devices"][:2]
+    expected = {lamp["location"]: {"count": 1, "descriptions": [call(lamp, "describe_device")]} for lamp in lights}
+    if by_room != expected:
+        raise AssertionError(f"Lights grouped by room should be {expected}, got {by_room}")
+    on_devices = call(management, "query", condition = lambda x: x["status"] == "on", group_by = ("room", "type"), outputs = ["devices"])
+    if sorted(on_devices) != [("Hall", "Broken"), ("Kitchen", "Camera"), ("Kitchen", "Light")]:
+        raise AssertionError("Grouping by (room, type) did not return the expected groups")
+    if call(management, "query", where = {"room": "Cellar"}, outputs = ["power", "devices"]) != {"power": 0, "devices": []}:
+        raise AssertionError("An empty query should return empty outputs")
+    try:
+        call(management, "query", outputs = ["watts"])
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("Expected ValueError for an unknown output")
+
+def test_stream_devices():
+    management = make_management()
+    for i in range(10):
+        make(Light, f"Stream Lamp {i}", "Kitchen" if i % 2 else "Hall", 100, "on", 10 * i, management=management)
+    kitchen = search_room(management, "Kitchen")[1]
+
+    page = list(call(management, "stream_search_room", "Kitchen", output = "descriptions", offset = 1, limit = 2))
+    if page != kitchen[1:3]:
+        raise AssertionError(f"Second page of kitchen descriptions should be {kitchen[1:3]}, got {page}")
+    chunks = list(call(management, "stream_device_descriptions", search_room = "Kitchen", chunk_size = 2))
+    if [len(chunk) for chunk in chunks] != [2, 2, 1] or sum(chunks, []) != kitchen:
+        raise AssertionError("Kitchen descriptions should come in chunks of 2, 2 and 1")
+    if [device["name"] for device in call(management, "stream_search_type", "Light", limit = 3)] != ["Stream Lamp 0", "Stream Lamp 1", "Stream Lamp 2"]:
+        raise AssertionError("The first three lights should be streamed in creation order")
+
+    described = []
+    set_class_attribute(Light, "describe_device", lambda obj: described.append(obj["name"]) or obj["name"])
+    try:
+        stream = call(management, "stream_device_descriptions", limit = 2)
+        if described:
+            raise AssertionError("Streaming should not describe anything before it is consumed")
+        list(stream)
+        if described != ["Stream Lamp 0", "Stream Lamp 1"]:
+            raise AssertionError(f"Only the two streamed devices should be described, got {described}")
+    finally:
+        set_class_attribute(Light, "describe_device", describe_device)
+    if list(call(management, "stream_connected_devices")) != []:
+        raise AssertionError("Lights are never connected")
+
+def test_description_cache():
+    management = make_management()
+    lamp = make(Light, "Cached Lamp", "Kitchen", 100, "on", 50, management=management)
+    therm = make(Thermostat, "Cached Thermostat", "Kitchen", 100, "on", 18, 21, management=management)
+
+    first = call(management, "get_all_device_descriptions")
+    if call(management, "get_all_device_descriptions") != first:
+        raise AssertionError("Cached descriptions differ from the first ones")
+    if call(management, "description_cache_stats") != {"hits": 2, "misses": 2, "size": 2}:
+        raise AssertionError(f"Expected 2 hits and 2 misses, got {call(management, 'description_cache_stats')}")
+
+    changes = [(therm, "connect", ["10.0.0.3"]), (therm, "set_target_temperature", [25]), (lamp, "set_brightness", [70]), (lamp, "toggle_status", [])]
+    for device, method_name, args in changes:
+        call(device, method_name, *args)
+        detached = {key: value for key, value in device.items() if key != "_management"} # not cached
+        if call(device, "describe_device") != call(detached, "describe_device"):
+            raise AssertionError(f"Description of {device['name']} is stale after {method_name}")
+    if call(management, "description_cache_stats")["misses"] != 6:
+        raise AssertionError("Every change should have caused exactly one miss")
+
+def test_make_many():
+    one_by_one = make_management()
+    bulk = make_management(check_totals = True)
+    call(bulk, "search_room", "Kitchen") # indexes and totals exist before the batch, so the batch has to update them
+    call(bulk, "calculate_total_power_consumption")
+
+    rows = [("Bulk Lamp", "Kitchen", 100, "on", 50), ("Bulk Lamp 2", "Hall", 80, "off", 20)]
+    for row in rows:
+        make(Light, *row, management=one_by_one)
+    make(Thermostat, "Bulk Thermostat", "Kitchen", 100, "on", 18, 21, management=one_by_one)
+    make_many(Light, rows, management=bulk, batch_size = 1)
+    make_many(Thermostat, [{"name": "Bulk Thermostat", "location": "Kitchen", "base_power": 100, "status": "on", "room_temperature": 18, "target_temperature": 21}], management=bulk)
+
+    for method_name, args in [("search_room", ["Kitchen"]), ("search_type", ["Light"]), ("calculate_total_power_consumption", [])]:
+        if call(bulk, method_name, *args) != call(one_by_one, method_name, *args):
+            raise AssertionError(f"{method_name} differs between make_many() and make()")
+
+def test_load_devices():
+    lines = [
+        '{"type": "Camera", "name": "File Camera", "location": "Hall", "base_power": 100, "status": "on", "resolution_factor": 4}',
+        '{"type": "Light", "name": "File Lamp", "location": "Hall", "base_power": 100, "status": "on", "brightness": 25}',
+        '',
+    ]
+    management = make_management()
+    if load_devices(lines, management = management) != 2:
+        raise AssertionError("Expected two devices from the JSON lines")
+    table = io.StringIO("name,location,base_power,status,room_temperature,target_temperature\nFile Thermostat,Hall,100,on,18,20.5\n")
+    load_devices(table, "csv", Thermostat, management)
+    if call(management, "calculate_total_power_consumption", search_room = "Hall") != 400 + 25 + 250:
+        raise AssertionError("Loaded devices do not add up to the expected power")
+    if management["devices"][2]["target_temperature"] != 20.5:
+        raise AssertionError("CSV numbers should be parsed")
+
+def test_bulk_mutations():
+    management = make_management(check_totals = True)
+    lamp = make(Light, "Batch Lamp", "Kitchen", 100, "on", 50, management=management)
+    therm = make(Thermostat, "Batch Thermostat", "Kitchen", 100, "off", 18, 21, management=management)
+    cam = make(Camera, "Batch Camera", "Hall", 100, "off", 3, management=management)
+    call(management, "get_all_connected_devices") # indexes, totals and descriptions are live during the batches
+
+    if call(management, "set_status_many", "on") != 2 or call(management, "set_status_many", "off", {"room": "Kitchen"}) != 2:
+        raise AssertionError("Expected two devices switched on and then two switched off in the kitchen")
+    if call(management, "calculate_total_power_consumption") != 300:
+        raise AssertionError("Only the camera should still use power")
+    if call(management, "connect_many", "10.0.0.4") != 2 or call(management, "connect_many", "10.0.0.4") != 0:
+        raise AssertionError("Only the two connectable devices should be connected, and only once")
+    if call(management, "get_all_connected_devices", "10.0.0.4")[1] != [call(cam, "describe_device")]:
+        raise AssertionError("The camera is the only connected device that is on")
+    if call(management, "set_target_temperature_many", 24, {"type": "Thermostat"}) != 1 or therm["target_temperature"] != 24:
+        raise AssertionError("The thermostat should be set to 24 degrees")
+    if call(management, "set_target_temperature_many", 24) != 0:
+        raise AssertionError("A thermostat already at 24 degrees is not a change")
+    if call(management, "disconnect_many", {"ip": "10.0.0.4", "room": "Hall"}) != 1 or therm["connected"] is not True:
+        raise AssertionError("Only the camera in the hall should be disconnected")
+    if "connected to server" in call(cam, "describe_device") or lamp["status"] != "off":
+        raise AssertionError("Descriptions should be up to date after a batch")
+    with batch_updates(management):
+        call(cam, "toggle_status")
+        if "is currently off" not in call(cam, "describe_device"):
+            raise AssertionError("Descriptions inside a batch should follow the device, like its fields and its power")
+        if call(management, "calculate_total_power_consumption") != 300: # checked totals, still from before the batch
+            raise AssertionError("Totals inside a batch should be the ones from before it")
+    if call(management, "calculate_total_power_consumption") != 0:
+        raise AssertionError("The camera's power should leave the totals when the batch ends")
+    check_power_totals(management)
+
+def test_snapshot():
+    management = make_management()
+    make(Light, "Snapshot Lamp", "Kitchen", 100, "on", 55, management=management)
+    therm = make(Thermostat, "Snapshot Thermostat", "Kitchen", 100, "on", 18, 21.5, management=management)
+    make(Camera, "Snapshot Camera", "Hall", 120, "off", 7, management=management)
+    call(therm, "connect", "10.0.0.5")
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "house.snapshot")
+        if save_snapshot(management, path) != 3:
+            raise AssertionError("Expected three devices in the snapshot")
+        snapshot = open_snapshot(path)
+        try:
+            for kwargs in [{}, {"search_room": "Kitchen"}, {"search_type": "Camera"}, {"search_room": "Cellar"}]:
+                if call(snapshot, "calculate_total_power_consumption", **kwargs) != call(management, "calculate_total_power_consumption", **kwargs):
+                    raise AssertionError(f"Snapshot total for {kwargs} differs from the live total")
+            if call(snapshot, "get_all_device_descriptions", search_room = "Kitchen") != call(management, "get_all_device_descriptions", search_room = "Kitchen"):
+                raise AssertionError("Snapshot descriptions differ from the live ones")
+        finally:
+            close_snapshot(snapshot)
+        restored = restore_snapshot(path)
+
+    strip = lambda devices: [{key: value for key, value in device.items() if key != "_management"} for device in devices]
+    if strip(restored["devices"]) != strip(management["devices"]):
+        raise AssertionError("Restored devices differ from the saved ones")
+    if call(restored["devices"][1], "describe_device") != call(therm, "describe_device"):
+        raise AssertionError("Restored thermostat is not dispatchable like the original")
+
+    heater = {"_classname": "Heater", "_parent": Device, "get_power_consumption": lambda obj: 7} # make() takes it, but it has no registry entry
+    make(heater, "Snapshot Heater", "Hall", 7, "on", management=management)
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "house.snapshot")
+        try:
+            save_snapshot(management, path)
+        except ValueError as error:
+            if "Heater" not in str(error) or os.path.exists(path):
+                raise AssertionError("A failed save should name the type and leave no snapshot behind")
+        else:
+            raise AssertionError("Saving a device of an unregistered class should fail")
+
+def test_event_log():
+    strip = lambda devices: [{key: value for key, value in device.items() if key != "_management"} for device in devices]
+    with tempfile.TemporaryDirectory() as directory:
+        management = make_management()
+        log = open_event_log(management, directory, group_size = 4, max_delay = None) # commits only where the test says
+        lamp = make(Light, "Logged Lamp", "Kitchen", 100, "on", 55, management=management)
+        therm = make(Thermostat, "Logged Thermostat", "Hall", 100, "on", 18, 21, management=management)
+        call(lamp, "toggle_status")
+        checkpoint(log)
+        call(therm, "connect", "10.0.0.9")
+        call(therm, "set_target_temperature", 23)
+        make(Camera, "Logged Camera", "Hall", 120, "off", 7, management=management)
+        flush_event_log(log)
+        if log["pending"]:
+            raise AssertionError("Flushed log still has pending events")
+
+        recovered = recover(directory)
+        if strip(recovered["devices"]) != strip(management["devices"]):
+            raise AssertionError("Checkpoint + replay did not rebuild the logged devices")
+        if call(recovered, "calculate_total_power_consumption") != call(management, "calculate_total_power_consumption"):
+            raise AssertionError("Recovered totals differ from the live ones")
+
+        call(lamp, "toggle_status") # stays pending: lost in a crash, like any event after the last commit
+        with open(os.path.join(directory, "events.log"), "a") as file:
+            file.write('["u",0,{"sta') # torn write
+        recovered = recover(directory)
+        if recovered["devices"][0]["status"] != "off":
+            raise AssertionError("Uncommitted or torn events should not be replayed")
+
+    with tempfile.TemporaryDirectory() as directory:
+        management = make_management()
+        log = open_event_log(management, directory, max_delay = None)
+        lamp = make(Light, "Logged Lamp", "Kitchen", 100, "on", 55, management=management)
+        heater = {"_classname": "Heater", "_parent": Device, "get_power_consumption": lambda obj: 7} # not registered, replay couldn't rebuild it
+        try:
+            make(heater, "Unlogged Heater", "Kitchen", 7, "on", management=management)
+        except ValueError as error:
+            if "Heater" not in str(error):
+                raise AssertionError("The error should name the unregistered type")
+        else:
+            raise AssertionError("Logging a device of an unregistered class should fail")
+        call(lamp, "toggle_status")
+        close_event_log(log)
+        recovered = recover(directory)
+        if [(device["name"], device["status"]) for device in recovered["devices"]] != [("Logged Lamp", "off")]:
+            raise AssertionError("Recovery should get through the events around a refused device")
+        try:
+            open_event_log(management, directory)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError("A log can't be opened over a device of an unregistered class")
+        close_event_log(log)
+        call(lamp, "toggle_status")
+        if log["pending"]:
+            raise AssertionError("Closed log still records events")
+
+    with tempfile.TemporaryDirectory() as directory:
+        management = make_management()
+        log = open_event_log(management, directory, max_delay = 0.01)
+        make(Light, "Quiet Lamp", "Kitchen", 100, "on", 55, management=management) # far from a full group
+        deadline = time.time() + 5
+        while log["commits"] == 0 and time.time() < deadline:
+            time.sleep(0.005)
+        if [device["name"] for device in recover(directory)["devices"]] != ["Quiet Lamp"]:
+            raise AssertionError("A lone event should be committed within max_delay")
+        close_event_log(log)
+
+def test_async_management():
+    management = make_management()
+    cameras = [make(Camera, f"Async Camera {i}", "Yard", 120, "on", 5, management=management) for i in range(20)]
+    make(Light, "Async Lamp", "Yard", 100, "on", 50, management=management)
+    transport = make_fake_transport(latency = 0.001, failures = {"Async Camera 3"}, hangs = {"Async Camera 4"})
+    house = make_async_management(management, transport, concurrency = 5, timeout = 0.05)
+
+    results = asyncio.run(call(house, "connect_many", lambda device: f"10.0.1.{device['_id']}"))
+    if len(results) != 20: # the lamp can't connect
+        raise AssertionError(f"Expected one result per camera, got {len(results)}")
+    if transport["max_in_flight"] > 5:
+        raise AssertionError(f"Concurrency limit of 5 exceeded: {transport['max_in_flight']}")
+    failed = {result["name"]: result["error"] for result in results if not result["ok"]}
+    if set(failed) != {"Async Camera 3", "Async Camera 4"} or not isinstance(failed["Async Camera 4"], asyncio.TimeoutError):
+        raise AssertionError(f"Unexpected failures {failed}")
+    if cameras[3]["connected"] or not cameras[5]["connected"] or cameras[5]["ip"] != f"10.0.1.{cameras[5]['_id']}":
+        raise AssertionError("Only successful handshakes should connect devices")
+    if len(select_devices(management, ip = cameras[5]["ip"])) != 1:
+        raise AssertionError("Async connects should keep the ip index up to date")
+
+    transport["remote_status"][cameras[0]["_id"]] = "off"
+    results = asyncio.run(call(house, "poll_status", where = {"type": "Camera"}))
+    if cameras[0]["status"] != "off" or cameras[1]["status"] != "on" or results[0]["value"] != "off":
+        raise AssertionError("Polling should apply drifted statuses only")
+
+    results = asyncio.run(call(house, "disconnect_many", where = {"room": "Yard"}))
+    if len(results) != 18 or any(camera["connected"] for camera in cameras):
+        raise AssertionError("Every connected camera should be disconnected")
+
+    handshakes = {}
+    connect = transport["connect"]
+    async def recording_connect(device, ip):
+        handshakes[device["name"]] = ip
+        await connect(device, ip)
+    transport.update({"connect": recording_connect, "failures": set(), "hangs": set()})
+    counter = iter(range(100))
+    def refuse(management, event, device, changes): # an update that fails after a successful handshake
+        if device is not None and device["name"] == "Async Camera 7":
+            raise RuntimeError("refused")
+    add_observer(management, refuse)
+    results = asyncio.run(call(house, "connect_many", lambda device: f"10.0.2.{next(counter)}"))
+    remove_observer(management, refuse)
+    if any(camera["ip"] != handshakes[camera["name"]] for camera in cameras if camera["name"] != "Async Camera 7"):
+        raise AssertionError("Devices should record the address their handshake went to")
+    failed = {result["name"]: result["error"] for result in results if not result["ok"]}
+    if list(failed) != ["Async Camera 7"] or not isinstance(failed["Async Camera 7"], RuntimeError):
+        raise AssertionError(f"A failing update should be reported per device, got {failed}")
+
+def test_thread_safe_management():
+    management = make_management(thread_safe = True)
+    rooms = [f"Stress Room {i}" for i in range(4)]
+    for room in rooms:
+        make_many(Light, [(f"{room} Lamp {i}", room, 100, "on", 50) for i in range(50)], management=management)
+    errors = []
+    done = threading.Event()
+
+    def writer(seed): # whole rooms switch at once, so a room's total is always 0 or 50 * 50
+        for i in range(150):
+            set_status_many(management, "off" if i % 2 else "on", {"room": rooms[(i + seed) % len(rooms)]})
+            make(Light, f"Annex Lamp {seed} {i}", "Annex", 100, "on", 50, management=management)
+
+    def reader():
+        while not done.is_set():
+            for room in rooms:
+                total = call(management, "calculate_total_power_consumption", search_room = room)
+                result = call(management, "query", {"room": room}, outputs = ("power", "count"))
+                on = len(call(management, "select_devices", room = room, status = "on"))
+                if total not in (0, 2500) or result["power"] not in (0, 2500) or result["count"] != 50 or on not in (0, 50):
+                    errors.append((room, total, result, on))
+
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-5) # switch threads often, so reads land in the middle of writes
+    try:
+        readers = [threading.Thread(target = reader) for _ in range(2)]
+        writers = [threading.Thread(target = writer, args = (seed,)) for seed in range(2)]
+        for thread in readers + writers:
+            thread.start()
+        for thread in writers:
+            thread.join()
+        done.set()
+        for thread in readers:
+            thread.join()
+    finally:
+        sys.setswitchinterval(interval)
+
+    if errors:
+        raise AssertionError(f"{len(errors)} reads saw torn state, e.g. {errors[0]}")
+    if len(call(management, "select_devices", room = "Annex")) != 300:
+        raise AssertionError("Concurrent make() calls lost devices")
+    check_power_totals(management)
+
+def test_concurrent_toggles():
+    management = make_management(thread_safe = True)
+    lamp = make(Light, "Contested Lamp", "Hall", 100, "off", 50, management=management)
+    thermostat = make(Thermostat, "Contested Thermostat", "Hall", 80, "on", 18, 21, management=management)
+
+    def toggler():
+        for i in range(2000): # an even number of toggles per thread, so the lamp must end where it started
+            call(lamp, "toggle_status")
+            if i % 2:
+                call(thermostat, "disconnect")
+            else:
+                call(thermostat, "connect", "10.0.0.9")
+
+    interval, stdout = sys.getswitchinterval(), sys.stdout
+    sys.setswitchinterval(1e-5)
+    sys.stdout = io.StringIO() # connect() and disconnect() print when the device already was
+    try:
+        threads = [threading.Thread(target = toggler) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        sys.setswitchinterval(interval)
+        sys.stdout = stdout
+
+    if lamp["status"] != "off":
+        raise AssertionError("Concurrent toggles lost an update")
+    if call(management, "select_devices", status = "on") != [thermostat] or call(management, "get_all_connected_devices") != [0, []]:
+        raise AssertionError("The indexes should match the devices after concurrent updates")
+    check_power_totals(management)
+
+def test_sharded_management():
+    single = make_management()
+    sharded = make_sharded_management(3)
+    try:
+        lights = [(f"Shard Lamp {i}", f"Shard Room {i % 7}", 100, "on", 50 + i % 3) for i in range(60)]
+        thermostats = [(f"Shard Thermostat {i}", f"Shard Room {i % 5}", 80, "on", 18, 21) for i in range(20)]
+        for cls, rows in [(Light, lights), (Thermostat, thermostats)]:
+            make_many(cls, rows, management=single)
+            if call(sharded, "make_many", cls, rows) != len(rows):
+                raise AssertionError("Sharded make_many() should report every device")
+        if len({shard for shard in sharded["rooms"].values()}) != 3:
+            raise AssertionError("Rooms should be spread over every shard")
+
+        for kwargs in [{}, {"search_room": "Shard Room 2"}, {"search_type": "Thermostat"}, {"search_room": "Nowhere"}]:
+            for method in ["calculate_total_power_consumption", "get_all_device_descriptions"]:
+                if call(sharded, method, **kwargs) != call(single, method, **kwargs):
+                    raise AssertionError(f"Sharded {method} for {kwargs} differs from a single management")
+        if call(sharded, "connect_many", "10.0.0.3", {"type": "Thermostat"}) != 20:
+            raise AssertionError("Every thermostat should be connected")
+        call(single, "connect_many", "10.0.0.3", {"type": "Thermostat"})
+        for method, args in [("get_all_connected_devices", ()), ("search_room", ("Shard Room 3",)), ("search_type", ("Light",))]:
+            if call(sharded, method, *args) != call(single, method, *args):
+                raise AssertionError(f"Sharded {method} differs from a single management")
+
+        counts = [worker["devices"] for worker in sharded["workers"]]
+        good = [(f"Good Lamp {i}", "Good Room", 100, "on", 40) for i in range(5)]
+        bad = [("Bad Lamp 0", "Bad Room", 100, "on", 40), ("Bad Lamp 1", "Bad Room", 100, "on")] # Light needs brightness
+        try:
+            call(sharded, "make_many", Light, good + bad)
+        except TypeError:
+            pass
+        else:
+            raise AssertionError("A shard's error should reach the caller")
+        make_many(Light, good, management=single) # the good rows went to another shard, which created them
+        if "Bad Room" in sharded["rooms"] or sum(worker["devices"] for worker in sharded["workers"]) != sum(counts) + 5:
+            raise AssertionError("Rows a shard failed to create should leave its routing")
+        call(sharded, "make_many", Light, [("Late Lamp", "Shard Room 1", 100, "on", 10)])
+        make(Light, "Late Lamp", "Shard Room 1", 100, "on", 10, management=single)
+        for kwargs in [{}, {"search_room": "Bad Room"}]:
+            if call(sharded, "get_all_device_descriptions", **kwargs) != call(single, "get_all_device_descriptions", **kwargs):
+                raise AssertionError(f"A failed make_many() left devices behind in the shards ({kwargs})")
+    finally:
+        close_sharded_management(sharded)
+
+def test_energy_metering():
+    management = make_management()
+    lamp = make(Light, "Metered Lamp", "Bedroom", 100, "on", 60, management=management) # 60W
+    therm = make(Thermostat, "Metered Thermostat", "Kitchen", 10, "on", 18, 21, management=management) # 30W
+    meter = make_meter(management, tick = 60, capacity = 5)
+    day = 24 * 3600
+    for minute in range(2 * 24 * 60):
+        if minute == 24 * 60:
+            call(lamp, "toggle_status")
+        sample(meter, now = minute * 60)
+    end = 2 * day
+
+    checks = [
+        (energy(meter, end - day, end, room = "Bedroom"), 0.0),
+        (energy(meter, 0, end, room = "Bedroom"), 1.44),
+        (energy(meter, 0, end), 2.88),
+        (energy(meter, end - 5 * 3600 - 90, end, type = "Thermostat"), 0.03 * (5 + 2 / 60)), # 5 hours plus the minute buckets at the edge
+    ]
+    for got, expected in checks:
+        if not math.isclose(got, expected):
+            raise AssertionError(f"Expected {expected} kWh, got {got}")
+    if device_samples(meter, therm) != [30.0] * 5 or device_samples(meter, lamp) != [0.0] * 5:
+        raise AssertionError("Raw samples should keep the last capacity readings")
+    late = make(Light, "Late Lamp", "Bedroom", 100, "on", 20, management=management)
+    sample(meter, now = end)
+    if device_samples(meter, late) != [20.0]:
+        raise AssertionError(f"A device made after sampling started has only its own readings, got {device_samples(meter, late)}")
+    if len(meter["rollups"][60]) != 24 * 60:
+        raise AssertionError("Minute rollups should keep a fixed number of buckets")
+
+def test_subscription_bus():
+    management = make_management()
+    lamp = make(Light, "Subscribed Lamp", "Office", 100, "on", 50, management=management)
+    therm = make(Thermostat, "Subscribed Thermostat", "Office", 100, "on", 18, 21, management=management)
+    now = [0.0]
+    bus = make_bus(management, interval = 1.0, clock = lambda: now[0])
+    received = {"office": [], "lamp": [], "ip": [], "status": []}
+    subscribe(bus, received["office"].append, room = "Office")
+    lamp_subscription = subscribe(bus, received["lamp"].append, device = lamp)
+    subscribe(bus, received["ip"].append, ip = "10.0.0.7")
+    subscribe(bus, received["status"].append, type = "Thermostat", fields = ("status",))
+
+    call(lamp, "toggle_status")
+    call(lamp, "toggle_status")
+    call(therm, "connect", "10.0.0.7")
+    if any(received.values()):
+        raise AssertionError("Notifications should wait for the interval")
+    now[0] = 1.5
+    call(lamp, "set_brightness", 80) # the interval passed: this change and everything pending is delivered
+    office = received["office"]
+    if len(office) != 1 or len(office[0]) != 2 or office[0][0] != (lamp, {"status": "on", "brightness": 80}):
+        raise AssertionError(f"Expected one coalesced batch for the room, got {office}")
+    if received["ip"] != [[(therm, {"ip": "10.0.0.7", "connected": True})]] or received["status"]:
+        raise AssertionError("IP and field filtered subscriptions got the wrong notifications")
+
+    unsubscribe(bus, lamp_subscription)
+    call(lamp, "toggle_status")
+    make(Camera, "Subscribed Camera", "Office", 120, "on", 5, management=management)
+    call(therm, "connect", "10.0.0.8") # leaving the subscribed IP is a change for it too
+    if flush_subscriptions(bus) != 4:
+        raise AssertionError("Expected lamp, camera, thermostat in the room and thermostat on the old IP")
+    if len(received["lamp"]) != 1 or received["office"][1][1][1] is not None or len(received["ip"]) != 2:
+        raise AssertionError("Unsubscribed, new device or moved device notifications are wrong")
+
+    def broken(notifications):
+        raise RuntimeError("subscriber bug")
+    subscribe(bus, broken, device = lamp)
+    later = []
+    add_observer(management, lambda management, event, device, changes: later.append(event)) # registered after the bus
+    call(lamp, "toggle_status")
+    now[0] = 10.0
+    if poll_subscriptions(bus) != 2 or len(received["office"]) != 3: # no further change needed for the interval to count
+        raise AssertionError("Polling should deliver once the interval passed")
+    bus["max_pending"] = 1
+    make(Light, "Second Lamp", "Office", 100, "on", 50, management=management) # max_pending reached, delivered right away
+    if [type(error) for _, error in bus["errors"]] != [RuntimeError] or later != ["update", "make"]:
+        raise AssertionError(f"A failing subscriber should be recorded, not stop the change or later observers: {bus['errors']}, {later}")
+    close_bus(bus)
+    call(lamp, "toggle_status")
+    if bus["pending_count"]:
+        raise AssertionError("A closed bus should not collect changes")
+
+def test_alert_engine():
+    management = make_management()
+    lamp = make(Light, "Alert Lamp", "Den", 100, "on", 50, management=management) # 50W
+    therm = make(Thermostat, "Alert Thermostat", "Den", 10, "on", 20, 21, management=management) # 10W
+    make(Thermostat, "Other Thermostat", "Attic", 10, "on", 20, 20, management=management)
+    engine = make_alert_engine(management)
+    add_rule(engine, 100, room = "Den", name = "den power")
+    add_rule(engine, 40, type = "Thermostat", per_device = True, name = "thermostat demand")
+    add_rule(engine, 1, room = "Attic", below = True, name = "attic idle")
+    if [alert["rule"] for alert in engine["alerts"]] != ["attic idle"]:
+        raise AssertionError(f"Only the attic rule holds at the start, got {engine['alerts']}")
+    engine["alerts"].clear()
+
+    call(therm, "set_target_temperature", 26) # 60W: the thermostat and the room cross their thresholds
+    fired = {(alert["rule"], alert["state"], alert["device"]) for alert in engine["alerts"]}
+    if fired != {("den power", "firing", None), ("thermostat demand", "firing", "Alert Thermostat")}:
+        raise AssertionError(f"Unexpected alerts {fired}")
+    call(therm, "set_target_temperature", 27) # still above: edge triggered, nothing new
+    if len(engine["alerts"]) != 2:
+        raise AssertionError("Alerts should only fire when a threshold is crossed")
+
+    engine["alerts"].clear()
+    with batch_updates(management):
+        call(lamp, "toggle_status")
+        call(therm, "set_target_temperature", 21)
+        if engine["alerts"]:
+            raise AssertionError("Rules inside a batch wait for its end")
+    resolved = {(alert["rule"], alert["state"]) for alert in engine["alerts"]}
+    if resolved != {("den power", "resolved"), ("thermostat demand", "resolved")}:
+        raise AssertionError(f"Unexpected alerts after the batch {resolved}")
+    remove_rule(engine, 0)
+    call(lamp, "toggle_status")
+    call(therm, "set_target_temperature", 30)
+    if [alert["rule"] for alert in engine["alerts"][2:]] != ["thermostat demand"]:
+        raise AssertionError("A removed rule should not fire")
+
+def test_scheduler():
+    management = make_management()
+    lamps = [make(Light, f"Scheduled Lamp {i}", "Living Room", 100, "on", 50, management=management) for i in range(3)]
+    therms = [make(Thermostat, f"Scheduled Thermostat {i}", "Bedroom", 100, "on", 20, 21, management=management) for i in range(2)]
+    now = [0.0]
+    scheduler = make_scheduler(management, tick = 60, clock = lambda: now[0])
+    ticks = []
+    add_observer(management, lambda management, event, device, changes: ticks.append(now[0]) if event == "batch" else None)
+
+    schedule(scheduler, 22 * 3600, "toggle_status", room = "Living Room", type = "Light")
+    nightly = schedule(scheduler, 23 * 3600 + 10, "set_target_temperature", 18, type = "Thermostat", every = 24 * 3600)
+    morning = schedule(scheduler, 7 * 3600, "toggle_status", device = lamps[0])
+    single = schedule(scheduler, 22 * 3600 - 30, "toggle_status", device = therms[0]) # rounded up into the 22:00 tick
+    if not cancel(scheduler, morning) or cancel(scheduler, morning) or pending_count(scheduler) != 3:
+        raise AssertionError("Cancelling should remove exactly one pending action")
+
+    if run_due(scheduler, 21 * 3600) != 0:
+        raise AssertionError("Nothing is due before 22:00")
+    now[0] = 22 * 3600 + 60
+    if run_due(scheduler) != 4 or any(lamp["status"] != "off" for lamp in lamps) or therms[0]["status"] != "off":
+        raise AssertionError("The lights and the thermostat due in the 22:00 tick should have run")
+    if ticks != [now[0]]:
+        raise AssertionError(f"Actions of one tick should run in one batch, got {ticks}")
+    if cancel(scheduler, single):
+        raise AssertionError("An action that ran can't be cancelled")
+
+    slept = []
+    def sleep(seconds):
+        slept.append(seconds)
+        now[0] += seconds
+    run_scheduler(scheduler, until = 2 * 24 * 3600, sleep = sleep)
+    if len(slept) != 3 or any(therm["target_temperature"] != 18 for therm in therms):
+        raise AssertionError(f"The nightly action should repeat, slept {slept}")
+    call(therms[1], "set_target_temperature", 21)
+    cancel(scheduler, nightly)
+    if run_due(scheduler, 10 * 24 * 3600) != 0 or pending_count(scheduler) != 0:
+        raise AssertionError("A cancelled series should not run again")
+
+    Scene = {"_parent": Device, "_classname": "Scene", "apply": lambda obj, statuses: smart_house._update_device(obj, status = statuses[0])}
+    scene = make(Scene, "Scheduled Scene", "Living Room", 0, "on", management=management)
+    schedule(scheduler, 11 * 24 * 3600, "apply", ["off"], device = scene) # a list argument can't be a group key
+    schedule(scheduler, 11 * 24 * 3600, "toggle_status", device = lamps[1])
+    if run_due(scheduler, 11 * 24 * 3600) != 2 or scene["status"] != "off" or lamps[1]["status"] != "on" or scheduler["errors"]:
+        raise AssertionError("Actions with unhashable arguments should run like the others")
+
+def test_register_device_type():
+    Heater = {"_parent": Device, "_classname": "Heater", "set_target_temperature": set_target_temperature}
+    Fan = {"_parent": [Device, Connectable], "_classname": "Fan", "set_speed": lambda obj, speed: smart_house._update_device(obj, speed = speed)}
+    register_device_type(Heater, ("target_temperature",),
+        power = lambda base_power, target_temperature: base_power * target_temperature / 10,
+        description = "The {name} {classname} in {location} heats to {target_temperature} degrees")
+    register_device_type(Fan, ("speed",), {"connected": False, "ip": None},
+        power = lambda base_power, speed: base_power * speed, # speed isn't a column, so no batched evaluation
+        description = "The {name} {classname} in {location} runs at speed {speed}. {connection}")
+    try:
+        management = make_management()
+        heater = make(Heater, "Registered Heater", "Garage", 100, "on", 20, management=management)
+        fan = make(Fan, "Registered Fan", "Garage", 10, "on", 3, management=management)
+        make_many(Heater, [("Registered Heater 2", "Garage", 50, "on", 10)], management=management)
+        if call(heater, "get_power_consumption") != 200 or call(fan, "get_power_consumption") != 30:
+            raise AssertionError("Registered power formulas were not used")
+        if call(fan, "describe_device") != "The Registered Fan Fan in Garage runs at speed 3. It is currently disconnected.":
+            raise AssertionError(f"Unexpected description {call(fan, 'describe_device')}")
+        if "Heater" not in DEVICE_CLASSES or CONSTRUCTOR_FIELDS["Fan"] != ("speed",):
+            raise AssertionError("Registered types should be known to make_many() and load_devices()")
+        if call(management, "calculate_total_power_consumption", search_room = "Garage") != 280 or power_breakdown(management, "type") != {"Heater": 250, "Fan": 30}:
+            raise AssertionError("Totals and the columnar store should include registered types")
+        call(heater, "set_target_temperature", 30)
+        if power_breakdown(management) != 380:
+            raise AssertionError("Column formulas of registered types should follow changes")
+        call(fan, "set_speed", 5) # not a built-in field, the totals and the description still depend on it
+        if call(management, "calculate_total_power_consumption", search_room = "Garage") != 400 or "runs at speed 5" not in call(fan, "describe_device"):
+            raise AssertionError("Changing a registered type's own field should update the totals and the description")
+        check_power_totals(management)
+        with tempfile.TemporaryDirectory() as directory:
+            save_snapshot(management, os.path.join(directory, "fans.snapshot"))
+            restored = restore_snapshot(os.path.join(directory, "fans.snapshot"))
+        compact = make_management(compact = True)
+        compact_fan = make(Fan, "Compact Fan", "Garage", 10, "on", 4, management=compact)
+        call(compact_fan, "set_speed", 6)
+        if [device.get("speed") for device in restored["devices"]] != [None, 5, None] or call(compact_fan, "get_power_consumption") != 60:
+            raise AssertionError("Snapshots and compact rows should keep the fields of registered types")
+    finally:
+        unregister_device_type("Heater")
+        unregister_device_type("Fan")
+    if "Fan" in DEVICE_TYPES or "Heater" in DEVICE_CLASSES:
+        raise AssertionError("Unregistered types should be gone")
+    if "speed" in smart_house.POWER_FIELDS or "speed" in smart_house.DESCRIPTION_FIELDS or "target_temperature" not in smart_house.POWER_FIELDS:
+        raise AssertionError("Unregistering should forget the type's own fields and keep the built-in ones")
+    if "get_power_consumption" in Heater or "describe_device" in Fan or "set_speed" not in Fan:
+        raise AssertionError("Unregistering should take back the methods registering added")
+
+def test_remove_and_relocate_devices():
+    management = make_management(check_totals = True)
+    lamps = make_many(Light, [(f"Lamp {i}", "Hall" if i % 2 else "Loft", 100, "on", 50) for i in range(6)], management=management)
+    therm = make(Thermostat, "Moving Thermostat", "Loft", 10, "on", 18, 21, management=management)
+    meter = make_meter(management, tick = 10.0, capacity = 4, clock = lambda: 0.0)
+    sample(meter)
+    bus = make_bus(management, clock = lambda: 0.0)
+    removals = []
+    subscribe(bus, removals.extend, room = "Hall")
+    engine = make_alert_engine(management)
+    add_rule(engine, 120, room = "Hall", name = "hall power")
+    call(management, "get_all_device_descriptions") # fills the description cache
+    call(management, "calculate_total_power_consumption", search_room = "Hall") # builds the totals and the index
+
+    call(therm, "relocate", "Hall")
+    call(therm, "rename", "Hall Thermostat")
+    if call(management, "calculate_total_power_consumption", search_room = "Hall") != 180 or therm["_id"] != 6:
+        raise AssertionError("Relocating should move the power and keep the id")
+    if "The Hall Thermostat Thermostat is located in Hall" not in call(therm, "describe_device"):
+        raise AssertionError("Renaming and relocating should refresh the cached description")
+    if [alert["state"] for alert in engine["alerts"]] != ["firing"]:
+        raise AssertionError("Moving the thermostat should push the hall over its rule")
+
+    call(management, "remove_device", lamps[1])
+    if lamps[0] not in management["devices"] or lamps[1] in management["devices"] or management["devices"][1] is not therm:
+        raise AssertionError("The last device should take the removed one's place")
+    if [device["name"] for device in select_devices(management, type = "Light")] != ["Lamp 0", "Lamp 2", "Lamp 3", "Lamp 4", "Lamp 5"]:
+        raise AssertionError("Indexed queries should still return creation order")
+    if call(management, "remove_many", {"room": "Hall", "type": "Light"}) != 2 or call(management, "calculate_total_power_consumption", search_room = "Hall") != 30:
+        raise AssertionError("Removing in bulk should leave only the thermostat in the hall")
+    if power_breakdown(management, "room") != {"Loft": 150.0, "Hall": 30.0} or len(management["_columns"]["type"]) != 4:
+        raise AssertionError("The columns should have dropped the removed rows")
+    if [alert["state"] for alert in engine["alerts"]] != ["firing", "resolved"]:
+        raise AssertionError("Removing devices should resolve the hall rule")
+    flush_subscriptions(bus)
+    if sorted(device["name"] for device, changes in removals if changes == {"removed": True}) != ["Lamp 1", "Lamp 3", "Lamp 5"]:
+        raise AssertionError(f"Subscribers of the hall should hear about the removals, got {removals}")
+    sample(meter)
+    if device_samples(meter, therm) != [30.0, 30.0] or device_samples(meter, lamps[4]) != [50.0, 50.0]:
+        raise AssertionError("The meter should move the rings of the rows that moved")
+
+    with tempfile.TemporaryDirectory() as directory:
+        log = open_event_log(management, directory)
+        checkpoint(log)
+        with batch_updates(management):
+            call(lamps[0], "toggle_status")
+            call(management, "remove_device", lamps[0])
+        close_event_log(log)
+        if sorted(device["name"] for device in recover(directory)["devices"]) != ["Hall Thermostat", "Lamp 2", "Lamp 4"]:
+            raise AssertionError("Recovery should replay the removal")
+    call(lamps[0], "toggle_status") # detached, only the dict changes
+    if call(management, "calculate_total_power_consumption") != 130 or len(call(management, "get_all_device_descriptions")) != 3:
+        raise AssertionError("A device removed inside a batch should not come back at its end")
+    try:
+        call(management, "remove_device", lamps[0])
+        raise AssertionError("Removing a device twice should fail")
+    except ValueError:
+        pass
+    for device in list(management["devices"]):
+        call(management, "remove_device", device)
+    if power_breakdown(management, "room") != {} or power_breakdown(management) != 0:
+        raise AssertionError("An emptied columnar store should break down to nothing")
+    compact = make_management(compact = True)
+    try:
+        call(compact, "remove_device", make(Light, "Compact Lamp", "Hall", 100, "on", 50, management=compact))
+        raise AssertionError("Compact managements can't remove devices")
+    except ValueError:
+        pass
+
+def test_location_tree():
+    management = make_management(check_totals = True)
+    make(Light, "Lobby Lamp", "Campus/Building A", 100, "on", 50, management=management) # 50W
+    cam = make(Camera, "Stair Camera", "Campus/Building B/Floor 3/Stairs", 10, "on", 5, management=management) # 50W
+    make(Camera, "Office Camera", "Campus/Building B/Floor 3/Room 301", 10, "on", 2, management=management) # 20W
+    lamp = make(Light, "Office Lamp", "Campus/Building B/Floor 3/Room 301", 100, "on", 40, management=management) # 40W
+    make(Light, "Floor 30 Lamp", "Campus/Building B/Floor 30", 100, "on", 10, management=management) # 10W, not on floor 3
+    call(cam, "connect", "10.0.0.9")
+
+    if call(management, "calculate_total_power_consumption", search_room = "Campus/Building B/Floor 3", subtree = True) != 110:
+        raise AssertionError("Floor 3 should roll up its rooms, and not Floor 30")
+    if call(management, "calculate_total_power_consumption", "Camera", "Campus/Building B", subtree = True) != 70:
+        raise AssertionError("Cameras of building B should total 70W")
+    if call(management, "calculate_total_power_consumption", search_room = "Campus/Building B/Floor 3") != 0:
+        raise AssertionError("Without subtree the room has to match exactly")
+    connected = query(management, {"type": "Camera", "within": "Campus/Building B"}, lambda device: device["connected"], outputs = ("devices",))["devices"]
+    if connected != [cam]:
+        raise AssertionError("Only the stair camera is a connected camera in building B")
+    if call(management, "search_room", "Campus/Building B/Floor 3", subtree = True)[0] != 110 or len(call(management, "get_all_device_descriptions", "Light", "Campus", subtree = True)) != 3:
+        raise AssertionError("search_room and descriptions should take subtrees too")
+
+    call(lamp, "relocate", "Campus/Building A/Room 101")
+    call(cam, "toggle_status")
+    rollup = call(management, "location_rollup", "Campus", 2)
+    if (rollup["power"], rollup["count"]) != (120, 5) or rollup["children"]["Campus/Building A"]["count"] != 2:
+        raise AssertionError(f"Unexpected roll-up {rollup}")
+    if list(rollup["children"]["Campus/Building B"]["children"]) != ["Campus/Building B/Floor 3", "Campus/Building B/Floor 30"] or "children" in rollup["children"]["Campus/Building B"]["children"]["Campus/Building B/Floor 3"]:
+        raise AssertionError("The roll-up should stop at the requested depth")
+    call(management, "remove_device", lamp)
+    if call(management, "location_rollup")["children"]["Campus"]["children"]["Campus/Building A"]["children"] != {}:
+        raise AssertionError("Room 101 should have left the tree with its last device")
+    check_power_totals(management)
+    compact = make_management(compact = True)
+    make(Light, "Compact Lamp", "Campus/Building B/Floor 3", 100, "on", 50, management=compact)
+    make(Light, "Other Lamp", "Campus/Building C", 100, "on", 50, management=compact)
+    if [device["name"] for device in select_devices(compact, within = "Campus/Building B")] != ["Compact Lamp"]:
+        raise AssertionError("Compact managements should answer subtree selections too")
+
+def test_dispatch_instrumentation():
+    test_management = make_management("test_management")
+    lamp = make(Light, "Instrumented Lamp", "Kitchen", 60, "on", 50, management = test_management)
+    thermostat = make(Thermostat, "Instrumented Thermostat", "Kitchen", 100, "on", 18, 21, management = test_management)
+    if dispatch_stats() is not None:
+        raise AssertionError("Instrumentation should be off by default")
+    call(test_management, "enable_instrumentation")
+    try:
+        invalidate_method_cache()
+        for _ in range(3):
+            call(lamp, "get_power_consumption")
+        call(thermostat, "is_connected")
+        try:
+            call(lamp, "no_such_method")
+        except NotImplementedError:
+            pass
+        stats = call(test_management, "dispatch_stats")
+    finally:
+        disable_instrumentation()
+    methods = stats["methods"]
+    if methods["Light.get_power_consumption"]["count"] != 3 or methods["Thermostat.is_connected"]["count"] != 1:
+        raise AssertionError(f"Unexpected call counts {methods}")
+    if methods["Light.get_power_consumption"]["sampled"] != 3 or sum(methods["Light.get_power_consumption"]["histogram_ns"].values()) != 3:
+        raise AssertionError("Every call should have been timed with sample_every 1")
+    if methods["Light.get_power_consumption"]["p99_ns"] is None or methods["Light.no_such_method"]["sampled"] != 0:
+        raise AssertionError("Only dispatched calls should have latencies")
+    # Light defines get_power_consumption itself, is_connected is on Connectable (Thermostat -> Device -> Connectable)
+    if stats["find"]["not_found"] != 1 or stats["find"]["depths"] != {0: 1, 2: 1}:
+        raise AssertionError(f"Unexpected find() statistics {stats['find']}")
+    call(lamp, "get_power_consumption")
+    if dispatch_stats() is not None:
+        raise AssertionError("Disabling should drop the statistics")
+
+SLOWEST = 5 # how many of the slowest tests the summary lists
+
 def run_tests():
     results = {"pass": 0, "fail": 0, "error": 0}
     start_time = time.time()
+    timings = []
+    for name in _selected_tests():
+        outcome, message, duration = _run_one(name)
+        _report(name, outcome, message, duration, results, timings)
+    _summary(results, timings, time.time() - start_time)
+
+def run_tests_parallel(workers = None):
+    # every test runs in a pool worker against its own setup() fixtures, so neither the order nor the other tests
+    # matter. Results are printed in discovery order
+    results = {"pass": 0, "fail": 0, "error": 0}
+    start_time = time.time()
+    timings = []
+    names = _selected_tests()
+    with concurrent.futures.ProcessPoolExecutor(workers or os.cpu_count()) as pool: # not multiprocessing.Pool, its daemonic workers can't start the shard processes
+        for name, (outcome, message, duration) in zip(names, pool.map(_run_in_fresh_fixtures, names)):
+            _report(name, outcome, message, duration, results, timings)
+    _summary(results, timings, time.time() - start_time)
+
+def _selected_tests():
+    names = []
     for (name, test) in globals().items():
         if not name.startswith("test_"):
             continue
@@ -336,21 +1333,41 @@ def run_tests():
             continue
         if select_param and select_param.lower() not in name.lower():
             continue
-        test_start = time.time()
-        try:
-            test()
-            duration = time.time() - test_start
-            print(f"[PASS] {name} ({duration:.5f}s)")
-            results["pass"] += 1
-        except AssertionError as e:
-            duration = time.time() - test_start
-            print(f"[FAIL] {name}, Error: {e} ({duration:.5f}s)")
-            results["fail"] += 1
-        except Exception as e:
-            duration = time.time() - test_start
-            print(f"[ERROR] {name}, Error: {e} ({duration:.5f}s)")
-            results["error"] += 1
-    total_time = time.time() - start_time
+        names.append(name)
+    return names
+
+def _run_one(name): # -> (outcome, message, duration)
+    test_start = time.time()
+    try:
+        globals()[name]()
+        return "pass", None, time.time() - test_start
+    except AssertionError as e:
+        return "fail", str(e), time.time() - test_start
+    except Exception as e:
+        return "error", str(e), time.time() - test_start
+
+def _run_in_fresh_fixtures(name):
+    setup()
+    try:
+        return _run_one(name)
+    finally:
+        teardown()
+
+def _report(name, outcome, message, duration, results, timings):
+    if outcome == "pass":
+        print(f"[PASS] {name} ({duration:.5f}s)")
+    else:
+        print(f"[{outcome.upper()}] {name}, Error: {message} ({duration:.5f}s)")
+    results[outcome] += 1
+    timings.append((duration, name))
+
+def _summary(results, timings, total_time):
+    test_time = sum(duration for duration, _ in timings)
+    slowest = sorted(timings, reverse = True)[:SLOWEST]
+    if slowest and test_time:
+        print(f"\nSlowest tests:")
+        for duration, name in slowest:
+            print(f"  {name}: {duration:.5f}s ({duration / test_time:.0%} of the test time)")
     print(f"\nTotal time: {total_time:.5f}s")
     print(f"pass {results['pass']}")
     print(f"fail {results['fail']}")
@@ -360,16 +1377,7 @@ def run_tests():
 def setup():
     global lamp_test, lamp_test_2, thermostat_test, thermostat_test_2, camera_test, camera_test_2, temp_management
     
-    temp_management = {
-    "_classname": "temp_management",
-    "_parent": None,
-    "devices": [],
-    "search_type": search_type,
-    "search_room": search_room,
-    "calculate_total_power_consumption": calculate_total_power_consumption,
-    "get_all_device_descriptions": get_all_device_descriptions,
-    "get_all_connected_devices": get_all_connected_devices
-    }
+    temp_management = make_management("temp_management", check_totals = True)
 
     lamp_test = make(Light, "Test Lamp", "Bedroom", 100, "off", 50, management=temp_management)
     lamp_test_2 = make(Light, "Test Lamp", "Living room", 80, "on", 40, management=temp_management)
@@ -397,7 +1405,12 @@ if __name__ == "__main__":
         select_param_index = sys.argv.index("--select") + 1
         if len(sys.argv) > select_param_index:
             select_param = sys.argv[select_param_index]
-    run_tests()
+    if "--parallel" in sys.argv: # optionally followed by the number of worker processes
+        workers_index = sys.argv.index("--parallel") + 1
+        workers = int(sys.argv[workers_index]) if len(sys.argv) > workers_index and sys.argv[workers_index].isdigit() else None
+        run_tests_parallel(workers)
+    else:
+        run_tests()
     if "--verbose" in sys.argv: # put after tun_tests() in order to also catch variables created in the run_tests() function
         test_xxx = []
         for (name, var) in list(globals().items()): # list, because else test_xxx gets changed during the iteration, which messes with globals().items() (since it's live)